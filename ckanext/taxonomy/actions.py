@@ -14,7 +14,9 @@ import ckan.plugins.toolkit as toolkit
 import ckan.logic as logic
 
 from ckan.lib.munge import munge_name
-from ckanext.taxonomy.models import Taxonomy, TaxonomyTerm
+from ckanext.taxonomy import cache, changes, hierarchy, jobs, labels, usage
+from ckanext.taxonomy.models import Taxonomy, TaxonomyTerm, \
+    TaxonomyTermPackage, TaxonomyTermCount, TaxonomyTermLabel
 from functools import reduce
 
 _check_access = logic.check_access
@@ -94,6 +96,7 @@ def taxonomy_create(context, data_dict):
     t = Taxonomy(name=name, title=title, uri=uri)
     model.Session.add(t)
     model.Session.commit()
+    cache.invalidate()
 
     return t.as_dict()
 
@@ -126,6 +129,7 @@ def taxonomy_update(context, data_dict):
 
     model.Session.add(tax)
     model.Session.commit()
+    cache.invalidate()
 
     return tax.as_dict()
 
@@ -150,10 +154,15 @@ def taxonomy_delete(context, data_dict):
 
     terms = model.Session.query(TaxonomyTerm)\
         .filter(TaxonomyTerm.taxonomy == taxonomy)
+    usage.remove_terms([t.id for t in terms])
+    labels.remove_terms([t.id for t in terms])
+    changes.record_many(changes.changes_between(
+        taxonomy.id, dict((t.id, t.as_dict()) for t in terms), {}))
     list(map(model.Session.delete, terms.all()))
 
     model.Session.delete(taxonomy)
     model.Session.commit()
+    cache.invalidate()
 
     return taxonomy.as_dict()
 
@@ -163,6 +172,13 @@ def taxonomy_term_list(context, data_dict):
     """
     Lists all of the taxonomy terms for the given taxonomy.
 
+    If 'include_counts' is true then each term also has the number of
+    datasets using it ('dataset_count') and the number using it or any
+    term beneath it ('dataset_count_rollup').
+
+    If 'lang' (or 'language') is given then terms are labelled and sorted
+    in that language, falling back to their default label.
+
     :returns: The list of terms for the specified taxonomy
     :rtype: A list of term dictionaries
     """
@@ -170,17 +186,41 @@ def taxonomy_term_list(context, data_dict):
 
     model = context['model']
     top_only = context.get('top_only', False)
+    include_counts = toolkit.asbool(data_dict.get('include_counts', False))
 
     context['with_terms'] = False
     taxonomy = logic.get_action('taxonomy_show')(context, data_dict)
-    terms = model.Session.query(TaxonomyTerm)\
-        .filter(TaxonomyTerm.taxonomy_id == taxonomy['id'])
+    if include_counts:
+        # The counts come from the same query as the terms
+        terms = model.Session.query(TaxonomyTerm, TaxonomyTermCount.direct,
+                                    TaxonomyTermCount.rollup)\
+            .outerjoin(TaxonomyTermCount,
+                       TaxonomyTermCount.term_id == TaxonomyTerm.id)
+    else:
+        terms = model.Session.query(TaxonomyTerm)
+    terms = terms.filter(TaxonomyTerm.taxonomy_id == taxonomy['id'])
 
     if top_only:
         terms = terms.filter(TaxonomyTerm.parent.is_(None))
     terms = terms.order_by(TaxonomyTerm.label).all()
 
-    return [term.as_dict() for term in terms]
+    if include_counts:
+        terms = [_with_counts(term.as_dict(), direct, rollup)
+                 for term, direct, rollup in terms]
+    else:
+        terms = [term.as_dict() for term in terms]
+
+    lang = _language(data_dict)
+    if lang:
+        _translate(terms, lang)
+        terms.sort(key=lambda t: t['label'] or '')
+    return terms
+
+
+def _with_counts(term, direct, rollup):
+    term['dataset_count'] = direct or 0
+    term['dataset_count_rollup'] = rollup or 0
+    return term
 
 
 @toolkit.side_effect_free
@@ -188,20 +228,45 @@ def taxonomy_term_tree(context, data_dict):
     """
     Returns the taxonomy terms as a tree for the given taxonomy
 
-    If 'language' is specified in data_dict (default is en) then
-    it will return the label for that language.
+    If 'lang' (or 'language') is specified in data_dict then it will
+    return the labels for that language where there are any.
+
+    'include_counts' is passed on to taxonomy_term_list to add the
+    dataset counts to every term in the tree.
+
+    If 'format' is 'flat' then the tree is returned as parallel lists of
+    'ids', 'labels' and 'uris', with 'parents' giving the position of each
+    term's parent in those lists (-1 at the top). Parents come before
+    their children. Other columns can be asked for with 'fields', from
+    description, extras, dataset_count and dataset_count_rollup.
 
     :returns: The taxonomy's terms as a tree structure
-    :rtype: A list of dictionaries.
+    :rtype: A list of dictionaries, or a dictionary of lists if flat
     """
     _check_access('taxonomy_term_tree', context, data_dict)
 
     model = context['model']
 
+    tree_format = data_dict.get('format', 'nested')
+    if tree_format not in ('nested', 'flat'):
+        raise logic.ValidationError("format must be nested or flat")
+    fields = data_dict.get('fields') or []
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = set(fields) - set(_FLAT_FIELDS)
+    if unknown:
+        raise logic.ValidationError(
+            "Unknown fields: %s" % ', '.join(sorted(unknown)))
+    if set(fields) & set(['dataset_count', 'dataset_count_rollup']):
+        data_dict = dict(data_dict, include_counts=True)
+
     context['with_terms'] = False
     taxonomy = logic.get_action('taxonomy_show')(context, data_dict)
 
     all_terms = logic.get_action('taxonomy_term_list')(context, data_dict)
+    if tree_format == 'flat':
+        return _flat_tree(all_terms, fields)
+
     top_terms = [t for t in all_terms if t['parent_id'] is None]
 
     # We definitely don't want each term to be responsible for loading
@@ -235,7 +300,11 @@ def taxonomy_term_show(context, data_dict):
     if not term:
         raise logic.NotFound()
 
-    return term.as_dict()
+    term = term.as_dict()
+    lang = _language(data_dict)
+    if lang:
+        _translate([term], lang)
+    return term
 
 
 @toolkit.side_effect_free
@@ -262,6 +331,11 @@ def taxonomy_term_show_bulk(context, data_dict):
 def taxonomy_term_create(context, data_dict):
     """ Allows for the creation of a new taxonomy term.
 
+    Translations of the label can be given as a list of 'labels', and
+    synonyms for the term as lists of 'alt_labels' and 'hidden_labels',
+    each either as strings in the language 'lang' or as dictionaries with
+    'label' and 'lang' (or 'language') keys.
+
     :returns: The newly updated term
     :rtype: A dictionary
     """
@@ -280,9 +354,18 @@ def taxonomy_term_create(context, data_dict):
             filter(TaxonomyTerm.taxonomy_id == taxonomy_id ).count() > 0:
         raise logic.ValidationError("Term uri already used in this taxonomy")
 
-    term = TaxonomyTerm(**data_dict)
+    term = TaxonomyTerm(**dict((k, v) for k, v in data_dict.items()
+                               if k not in _LABEL_KEYS))
     model.Session.add(term)
+    model.Session.flush()
+    labels.set_term_labels(term,
+                           alt_labels=data_dict.get('alt_labels'),
+                           hidden_labels=data_dict.get('hidden_labels'),
+                           translations=data_dict.get('labels'),
+                           lang=data_dict.get('lang'))
+    changes.record(changes.CREATE, term.as_dict())
     model.Session.commit()
+    cache.invalidate(term.taxonomy_id)
 
     return term.as_dict()
 
@@ -290,6 +373,10 @@ def taxonomy_term_create(context, data_dict):
 def taxonomy_term_update(context, data_dict):
     """ Allows a taxonomy term to be updated.
 
+    The term's translations and synonyms are only replaced if 'labels',
+    'alt_labels' or 'hidden_labels' are given, as for taxonomy_term_create.
+    A new 'parent_id' moves the term as taxonomy_term_move does.
+
     :returns: The newly updated term
     :rtype: A dictionary
     """
@@ -301,19 +388,89 @@ def taxonomy_term_update(context, data_dict):
     term = TaxonomyTerm.get(id)
     if not term:
         raise logic.NotFound()
+    indexed = (term.label, term.parent_id, term.uri)
+    before = term.as_dict()
 
     term.label = data_dict.get('label', term.label)
-    term.parent_id = data_dict.get('parent_id', term.parent_id)
+    _move_term(term, data_dict.get('parent_id', term.parent_id) or None)
     term.uri = logic.get_or_bust(data_dict, 'uri')
     term.description = data_dict.get('description', '')
     term.extras = data_dict.get('extras', '')
 
     model.Session.add(term)
+    labels.set_term_labels(term,
+                           alt_labels=data_dict.get('alt_labels'),
+                           hidden_labels=data_dict.get('hidden_labels'),
+                           translations=data_dict.get('labels'),
+                           lang=data_dict.get('lang'))
+    # Changes to the labels alone are still updates
+    changes.record(changes.kind_of_change(before, term.as_dict()) or
+                   changes.UPDATE, term.as_dict())
     model.Session.commit()
+    cache.invalidate(term.taxonomy_id)
+
+    # Datasets using this term or any beneath it have its label and
+    # position in the hierarchy in their search index documents.
+    if (term.label, term.parent_id, term.uri) != indexed:
+        jobs.enqueue_reindex(term_ids=[term.id])
 
     return term.as_dict()
 
 
+def taxonomy_term_move(context, data_dict):
+    """ Moves a taxonomy term, and every term beneath it, to a new parent
+    in a single transaction.
+
+    :param id: The id or uri of the term
+    :param parent_id: The id or uri of the new parent, which must be in the
+        same taxonomy and not beneath the term, or null to move the term to
+        the top of its taxonomy
+
+    :returns: The moved term
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_term_move', context, data_dict)
+    model = context['model']
+
+    id = logic.get_or_bust(data_dict, 'id')
+    if 'parent_id' not in data_dict:
+        raise logic.ValidationError("parent_id must be given, or null to "
+                                    "move the term to the top")
+
+    term = TaxonomyTerm.get(id)
+    if not term:
+        raise logic.NotFound()
+
+    if _move_term(term, data_dict['parent_id'] or None):
+        changes.record(changes.MOVE, term.as_dict())
+        model.Session.commit()
+        cache.invalidate(term.taxonomy_id)
+        # Only the datasets using the moved branch have a new position
+        # in the hierarchy in their search index documents.
+        jobs.enqueue_reindex(term_ids=[term.id])
+
+    return term.as_dict()
+
+
+def _move_term(term, parent_id):
+    """
+    Moves a term beneath another term of its taxonomy, given by id or uri,
+    or to the top. See `hierarchy.move_term`.
+    """
+    if parent_id:
+        parent = TaxonomyTerm.get(parent_id)
+        if not parent:
+            raise logic.ValidationError("The parent term was not found")
+        if parent.taxonomy_id != term.taxonomy_id:
+            raise logic.ValidationError(
+                "The parent term is in a different taxonomy")
+        parent_id = parent.id
+    try:
+        return hierarchy.move_term(term, parent_id)
+    except hierarchy.CycleError as e:
+        raise logic.ValidationError(str(e))
+
+
 def taxonomy_term_delete(context, data_dict):
     """ Deletes a taxonomy term.
 
@@ -338,12 +495,444 @@ def taxonomy_term_delete(context, data_dict):
         filter(TaxonomyTerm.id.in_(ids))
 
     if len(ids):
+        package_ids = usage.packages_for_terms(ids)
+        usage.remove_terms(ids)
+        labels.remove_terms(ids)
+        changes.record_many(changes.changes_between(
+            term['taxonomy_id'], dict((t.id, t.as_dict()) for t in todelete),
+            {}))
         list(map(model.Session.delete, todelete))
         model.Session.commit()
+        cache.invalidate(term['taxonomy_id'])
+        jobs.enqueue_reindex(package_ids=package_ids)
 
     return term
 
 
+@toolkit.side_effect_free
+def taxonomy_term_usage(context, data_dict):
+    """
+    Lists the datasets which use the given taxonomy term, ordered by name.
+    Private datasets are only included for system administrators.
+
+    :param id: The id or uri of the term
+    :param limit: The maximum number of datasets to return (default 100,
+        at most 1000)
+    :param offset: The number of datasets to skip (default 0)
+
+    :returns: The id and name of each dataset using the term
+    :rtype: A list of dictionaries
+    """
+    _check_access('taxonomy_term_usage', context, data_dict)
+    model = context['model']
+
+    try:
+        limit = min(int(data_dict.get('limit', 100)), 1000)
+        offset = int(data_dict.get('offset', 0))
+    except ValueError:
+        raise logic.ValidationError("limit and offset must be integers")
+    if limit < 1 or offset < 0:
+        raise logic.ValidationError(
+            "limit must be positive and offset must not be negative")
+
+    term = logic.get_action('taxonomy_term_show')(context, data_dict)
+
+    q = _term_usage_query(context, term['id'])\
+        .with_entities(model.Package.id, model.Package.name)\
+        .order_by(model.Package.name)\
+        .offset(offset).limit(limit)
+    return [{'id': id, 'name': name} for id, name in q]
+
+
+@toolkit.side_effect_free
+def taxonomy_term_usage_count(context, data_dict):
+    """
+    Counts the datasets which use the given taxonomy term.
+
+    :param id: The id or uri of the term
+
+    :returns: The number of datasets using the term
+    :rtype: An integer
+    """
+    _check_access('taxonomy_term_usage_count', context, data_dict)
+
+    term = logic.get_action('taxonomy_term_show')(context, data_dict)
+    return _term_usage_query(context, term['id']).count()
+
+
+@toolkit.side_effect_free
+def taxonomy_term_lookup(context, data_dict):
+    """
+    Resolves many labels to taxonomy terms at once. Each label is matched
+    exactly against the labels and synonyms of the terms, and if nothing
+    matches exactly, against their case and accent folded form.
+
+    :param labels: A list of the labels to look up
+    :param id: The id or name of a taxonomy to restrict the lookup to
+        (optional)
+    :param match: 'exact', 'normalised' or 'any' (the default), which
+        tries exact matches before normalised ones
+
+    :returns: For each label, the terms it matched, preferred labels
+        first. Each term has the 'matched_label', its 'label_kind' and the
+        type of 'match' added.
+    :rtype: A dictionary of lists of term dictionaries
+    """
+    _check_access('taxonomy_term_lookup', context, data_dict)
+    model = context['model']
+
+    values = data_dict.get('labels')
+    if isinstance(values, str):
+        values = [values]
+    if not values:
+        raise logic.ValidationError("A list of labels is required")
+
+    match = data_dict.get('match', 'any')
+    if match not in ('exact', 'normalised', 'any'):
+        raise logic.ValidationError(
+            "match must be one of exact, normalised or any")
+
+    taxonomy_id = None
+    if data_dict.get('id') or data_dict.get('name'):
+        context['with_terms'] = False
+        taxonomy_id = logic.get_action('taxonomy_show')(
+            context, data_dict)['id']
+
+    def matching(column, keys):
+        keys = list(set(keys))
+        for i in range(0, len(keys), 500):
+            q = model.Session.query(TaxonomyTermLabel, TaxonomyTerm)\
+                .join(TaxonomyTerm,
+                      TaxonomyTerm.id == TaxonomyTermLabel.term_id)\
+                .filter(column.in_(keys[i:i + 500]))
+            if taxonomy_id:
+                q = q.filter(TaxonomyTermLabel.taxonomy_id == taxonomy_id)
+            for row in q:
+                yield row
+
+    results = dict((value, []) for value in values)
+    if match in ('exact', 'any'):
+        for label, term in matching(TaxonomyTermLabel.label, values):
+            results[label.label].append(
+                _lookup_match(term, label, 'exact'))
+
+    if match in ('normalised', 'any'):
+        pending = [v for v in values
+                   if match == 'normalised' or not results[v]]
+        by_normalised = {}
+        for value in pending:
+            by_normalised.setdefault(labels.normalise(value), []).append(
+                value)
+        for label, term in matching(TaxonomyTermLabel.normalised,
+                                    by_normalised.keys()):
+            for value in by_normalised[label.normalised]:
+                results[value].append(
+                    _lookup_match(term, label, 'normalised'))
+
+    kind_order = {labels.PREF: 0, labels.ALT: 1, labels.HIDDEN: 2}
+    for value, terms in results.items():
+        unique = {}
+        for t in sorted(terms, key=lambda t: (kind_order[t['label_kind']],
+                                              t['label'])):
+            unique.setdefault(t['id'], t)
+        results[value] = list(unique.values())
+    return results
+
+
+@toolkit.side_effect_free
+def taxonomy_term_autocomplete(context, data_dict):
+    """
+    Returns the terms in a taxonomy whose labels or synonyms, or a word
+    within them, start with the query. This is served from an in-memory
+    index so is suitable for calling on every keystroke.
+
+    :param q: The text typed so far
+    :param taxonomy: The id or name of the taxonomy
+    :param limit: The maximum number of terms to return (default 10,
+        at most 100)
+    :param lang: Only match labels in this language, or with no language,
+        and label the terms in it (optional)
+
+    :returns: The matching terms with their 'id', 'uri', 'label' and the
+        label which matched ('match')
+    :rtype: A list of dictionaries
+    """
+    _check_access('taxonomy_term_autocomplete', context, data_dict)
+
+    query = data_dict.get('q', '')
+    taxonomy = logic.get_or_bust(data_dict, 'taxonomy')
+    try:
+        limit = min(int(data_dict.get('limit', 10)), 100)
+    except ValueError:
+        raise logic.ValidationError("limit must be an integer")
+
+    taxonomy_id = cache.taxonomy_id_for(taxonomy)
+    if not taxonomy_id:
+        raise logic.NotFound()
+
+    from ckanext.taxonomy.autocomplete import autocomplete
+    return autocomplete(taxonomy_id, query, limit, _language(data_dict))
+
+
+@toolkit.side_effect_free
+def taxonomy_term_search(context, data_dict):
+    """
+    Searches the labels and descriptions of terms, across all taxonomies
+    or just one. Words in labels rank higher than words in descriptions,
+    and every word of the query must match.
+
+    :param q: The words to search for
+    :param taxonomy: The id or name of a taxonomy to search (optional)
+    :param limit: The maximum number of terms to return (default 20,
+        at most 1000)
+    :param offset: The number of terms to skip (default 0)
+
+    :returns: The total number of matching terms as 'count' and the page
+        of 'results', each term having a 'score'
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_term_search', context, data_dict)
+
+    query = logic.get_or_bust(data_dict, 'q')
+    try:
+        limit = min(int(data_dict.get('limit', 20)), 1000)
+        offset = int(data_dict.get('offset', 0))
+    except ValueError:
+        raise logic.ValidationError("limit and offset must be integers")
+    if limit < 1 or offset < 0:
+        raise logic.ValidationError(
+            "limit must be positive and offset must not be negative")
+
+    taxonomy_ids = None
+    if data_dict.get('taxonomy'):
+        taxonomy_id = cache.taxonomy_id_for(data_dict['taxonomy'])
+        if not taxonomy_id:
+            raise logic.NotFound()
+        taxonomy_ids = [taxonomy_id]
+
+    from ckanext.taxonomy.search import search_terms
+    count, results = search_terms(query, taxonomy_ids, limit, offset)
+    return {'count': count, 'results': results}
+
+
+@toolkit.side_effect_free
+def taxonomy_term_reconcile(context, data_dict):
+    """
+    Suggests the terms best matching each of a batch of free text strings,
+    such as tags, by the similarity of their character trigrams to the
+    labels and synonyms of the terms.
+
+    :param strings: A list of the strings to match
+    :param taxonomy: The id or name of a taxonomy to match against
+        (optional, the default is all taxonomies)
+    :param limit: The number of candidates to return per string
+        (default 3, at most 20)
+    :param threshold: The lowest score, between 0 and 1, a candidate may
+        have (default 0)
+
+    :returns: For each string, the candidate terms best first, each with
+        its 'id', 'uri', 'label', 'taxonomy_id', the label which matched
+        ('match') and a 'score'
+    :rtype: A dictionary of lists of dictionaries
+    """
+    _check_access('taxonomy_term_reconcile', context, data_dict)
+
+    strings = data_dict.get('strings')
+    if isinstance(strings, str):
+        strings = [strings]
+    if not strings:
+        raise logic.ValidationError("A list of strings is required")
+    try:
+        limit = min(int(data_dict.get('limit', 3)), 20)
+        threshold = float(data_dict.get('threshold', 0))
+    except ValueError:
+        raise logic.ValidationError("limit and threshold must be numbers")
+
+    taxonomy_ids = None
+    if data_dict.get('taxonomy'):
+        taxonomy_id = cache.taxonomy_id_for(data_dict['taxonomy'])
+        if not taxonomy_id:
+            raise logic.NotFound()
+        taxonomy_ids = [taxonomy_id]
+
+    from ckanext.taxonomy.reconcile import reconcile
+    return reconcile(strings, taxonomy_ids, limit, threshold)
+
+
+def taxonomy_import_start(context, data_dict):
+    """
+    Queues a background job to import a taxonomy from a SKOS document or a
+    JSON Lines export, replacing the terms of any taxonomy with the same
+    name, as `taxonomy load` does.
+
+    :param url: The url of the document to import
+    :param name: The short-name of the taxonomy
+    :param uri: The uri of the taxonomy (optional for JSON Lines, where it
+        defaults to the one in the export)
+    :param title: The title of the taxonomy (optional)
+    :param lang: The language of the default labels in a SKOS document
+        (default 'en')
+    :param format: 'skos' or 'jsonl' (optional, the default is 'jsonl' for
+        urls ending in .jsonl and 'skos' otherwise)
+
+    :returns: The 'id' of the job, to pass to taxonomy_import_status
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_import_start', context, data_dict)
+
+    from ckanext.taxonomy import importer
+
+    url = logic.get_or_bust(data_dict, 'url')
+    name = logic.get_or_bust(data_dict, 'name')
+    if url.split(':', 1)[0] not in ('http', 'https'):
+        raise logic.ValidationError("url must be an http or https url")
+    format = data_dict.get('format') or importer.guess_format(url)
+    if format not in importer.FORMATS:
+        raise logic.ValidationError(
+            "format must be one of %s" % ', '.join(importer.FORMATS))
+    uri = data_dict.get('uri')
+    if not uri and format != 'jsonl':
+        raise logic.ValidationError("uri is required")
+
+    job_id = importer.start(url, name, title=data_dict.get('title'),
+                            uri=uri, lang=data_dict.get('lang') or 'en',
+                            format=format)
+    return {'id': job_id, 'name': name}
+
+
+@toolkit.side_effect_free
+def taxonomy_import_status(context, data_dict):
+    """
+    Reports the progress of an import queued by taxonomy_import_start.
+
+    :param id: The id of the import job
+
+    :returns: The job's 'status' on the queue, the 'phase' it has reached
+        (queued, parsing, waiting, deleting, inserting, linking,
+        refreshing, finished or failed), the number of 'terms' and
+        'labels' written, 'terms_per_second', when it 'started' and
+        'finished', the 'taxonomy_id' once finished and a list of 'errors'
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_import_status', context, data_dict)
+
+    from ckanext.taxonomy import importer
+
+    res = importer.status(logic.get_or_bust(data_dict, 'id'))
+    if res is None:
+        raise logic.NotFound()
+    return res
+
+
+@toolkit.side_effect_free
+def taxonomy_preload_status(context, data_dict):
+    """
+    Reports whether the taxonomies named in ckanext.taxonomy.preload have
+    been loaded by the worker answering the request. Requests are answered
+    correctly either way, but the first to need a taxonomy which hasn't
+    been loaded is slower.
+
+    :returns: 'enabled', 'ready' (true once preloading has finished, or if
+        it isn't enabled), when it 'started' and 'finished', and for each
+        taxonomy id its 'state' (pending, loaded or failed) with the number
+        of 'terms' or an 'error'
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_preload_status', context, data_dict)
+
+    from ckanext.taxonomy import preload
+    return preload.status()
+
+
+@toolkit.side_effect_free
+def taxonomy_changes_since(context, data_dict):
+    """
+    Lists the changes made to terms after a given point in the change log,
+    oldest first, so that a mirror can apply just what changed since it
+    last synced. A deleted term is listed as a 'delete' change without the
+    term, a tombstone.
+
+    :param since: The number of the last change already applied (default
+        0, for every change)
+    :param taxonomy: The id or name of a taxonomy to list the changes of
+        (optional, the default is all taxonomies)
+    :param limit: The maximum number of changes to return (default 1000,
+        at most 10000)
+
+    :returns: The 'changes', each with its 'seq', 'action' (create, update,
+        move or delete), 'taxonomy_id', 'term_id', 'uri', 'timestamp' and
+        the 'term' as it now is, whether there are 'more', the 'next'
+        number to ask for changes since, and the 'latest' change number
+    :rtype: A dictionary
+    """
+    _check_access('taxonomy_changes_since', context, data_dict)
+
+    try:
+        since = int(data_dict.get('since', 0))
+        limit = min(int(data_dict.get('limit', 1000)), 10000)
+    except ValueError:
+        raise logic.ValidationError("since and limit must be integers")
+    if since < 0 or limit < 1:
+        raise logic.ValidationError(
+            "since must not be negative and limit must be positive")
+
+    taxonomy_id = None
+    if data_dict.get('taxonomy'):
+        taxonomy_id = cache.taxonomy_id_for(data_dict['taxonomy'])
+        if not taxonomy_id:
+            raise logic.NotFound()
+
+    # Read the latest number first, so that it is never behind the changes
+    latest = changes.latest()
+    results, more = changes.changes_since(since, taxonomy_id, limit)
+    if results:
+        next_seq = results[-1]['seq']
+    else:
+        # There are no changes to this taxonomy up to the latest one
+        next_seq = max(since, latest) if taxonomy_id else since
+    return {'changes': results, 'more': more, 'next': next_seq,
+            'latest': latest}
+
+
+def _lookup_match(term, label, match):
+    d = term.as_dict()
+    d['matched_label'] = label.label
+    d['label_kind'] = label.kind
+    d['match'] = match
+    return d
+
+
+_LABEL_KEYS = ('labels', 'alt_labels', 'hidden_labels', 'lang')
+
+
+def _language(data_dict):
+    return data_dict.get('lang') or data_dict.get('language')
+
+
+def _translate(terms, lang):
+    """ Relabels term dictionaries in the given language """
+    for term in terms:
+        snapshot = cache.get_snapshot(term['taxonomy_id'])
+        i = snapshot.by_id.get(term['id'])
+        if i is not None:
+            term['label'] = snapshot.label(i, lang)
+
+
+def _term_usage_query(context, term_id):
+    import ckan.authz as authz
+
+    model = context['model']
+    q = model.Session.query(TaxonomyTermPackage)\
+        .join(model.Package,
+              model.Package.id == TaxonomyTermPackage.package_id)\
+        .filter(TaxonomyTermPackage.term_id == term_id)\
+        .filter(model.Package.state == 'active')
+    if not (context.get('ignore_auth') or
+            authz.is_sysadmin(context.get('user'))):
+        q = q.filter(model.Package.private == False)
+    return q
+
+
 def _gather(d, key):
     """
     Gather the values in d making sure we navigate down all 'children' nodes
@@ -360,6 +949,37 @@ def _gather(d, key):
     return reduce(lambda h, t: h+t, res)
 
 
+_FLAT_FIELDS = ('description', 'extras', 'dataset_count',
+                'dataset_count_rollup')
+
+
+def _flat_tree(terms, fields):
+    """
+    Lays the terms out in columns in the order of a walk down the tree,
+    with each term pointing at its parent by position.
+    """
+    children = {}
+    for t in terms:
+        children.setdefault(t['parent_id'], []).append(t)
+
+    res = dict((column, []) for column in
+               ['ids', 'labels', 'uris', 'parents'] + list(fields))
+    stack = [(t, -1) for t in reversed(children.get(None, []))]
+    while stack:
+        term, parent = stack.pop()
+        position = len(res['ids'])
+        res['ids'].append(term['id'])
+        res['labels'].append(term['label'])
+        res['uris'].append(term['uri'])
+        res['parents'].append(parent)
+        for field in fields:
+            res[field].append(term.get(field))
+        stack.extend((t, position)
+                     for t in reversed(children.get(term['id'], [])))
+    res['fields'] = list(fields)
+    return res
+
+
 def _append_children(term, terms):
     term['children'] = [t for t in terms if t['parent_id'] == term['id']]
 
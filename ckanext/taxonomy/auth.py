@@ -75,6 +75,14 @@ def taxonomy_term_show(context=None, data_dict=None):
     return {'success': True}
 
 
+@auth_allow_anonymous_access
+def taxonomy_term_lookup(context=None, data_dict=None):
+    """
+    Can a user look up taxonomy terms by their labels
+    """
+    return {'success': True}
+
+
 @auth_allow_anonymous_access
 def taxonomy_term_create(context=None, data_dict=None):
     """
@@ -104,3 +112,41 @@ def taxonomy_term_delete(context=None, data_dict=None):
     There is a shortcut where this will not be called for sysadmins
     """
     return {'success': False}
+
+
+@auth_allow_anonymous_access
+def taxonomy_term_usage(context=None, data_dict=None):
+    """
+    Can a user see which datasets use a taxonomy term. Private datasets
+    are only included for system administrators.
+    """
+    return {'success': True}
+
+
+@auth_allow_anonymous_access
+def taxonomy_changes_since(context=None, data_dict=None):
+    """
+    Can a user follow the changes made to terms, as a mirror does. This
+    is always yes, as the terms themselves are public.
+    """
+    return {'success': True}
+
+
+@auth_allow_anonymous_access
+def taxonomy_preload_status(context=None, data_dict=None):
+    """
+    Can a user see whether taxonomies have been preloaded, such as a load
+    balancer's health check. This is always yes.
+    """
+    return {'success': True}
+
+
+@auth_allow_anonymous_access
+def taxonomy_import(context=None, data_dict=None):
+    """
+    Can a user import a taxonomy in the background, or follow an import.
+    This is only available to system administrators.
+
+    There is a shortcut where this will not be called for sysadmins
+    """
+    return {'success': False}
@@ -0,0 +1,96 @@
+"""
+Prefix indexes over the labels and synonyms of taxonomy terms, used to
+answer type-ahead queries without going to the database.
+"""
+from bisect import bisect_left
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.labels import label_entries, normalise
+
+
+class PrefixIndex(object):
+    """
+    Sorted arrays of normalised labels, searched by bisection. Labels are
+    indexed from their start and from the start of each later word, so
+    that 'eco' finds 'Social economy', but matches at the start of a label
+    are returned first.
+    """
+
+    def __init__(self, entries):
+        """
+        `entries` is an iterable of (label, term) pairs, where term is any
+        value identifying the term the label belongs to.
+        """
+        starts = []
+        words = []
+        for label, term in entries:
+            key = normalise(label)
+            if not key:
+                continue
+            starts.append((key, label, term))
+            for i, c in enumerate(key):
+                if c == u' ':
+                    words.append((key[i + 1:], label, term))
+        self._starts = self._build(starts)
+        self._words = self._build(words)
+
+    def _build(self, entries):
+        entries.sort(key=lambda e: e[0])
+        return ([e[0] for e in entries], [e[1] for e in entries],
+                [e[2] for e in entries])
+
+    def __len__(self):
+        return len(self._starts[0])
+
+    def search(self, query, limit=10):
+        """
+        Returns up to `limit` (term, label) pairs for the terms which have
+        a label or a word within a label starting with `query`. Each term
+        appears once, with the first of its labels that matched.
+        """
+        prefix = normalise(query)
+        if not prefix or limit < 1:
+            return []
+
+        res = []
+        seen = set()
+        for keys, labels, terms in (self._starts, self._words):
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and keys[i].startswith(prefix):
+                if terms[i] not in seen:
+                    seen.add(terms[i])
+                    res.append((terms[i], labels[i]))
+                    if len(res) >= limit:
+                        return res
+                i += 1
+        return res
+
+
+def get_index(taxonomy_id, lang=None):
+    """
+    Returns the PrefixIndex for a taxonomy, building it when it is first
+    needed and again whenever the taxonomy changes. Terms are identified
+    by their position in the taxonomy's snapshot. Each language has an
+    index of its own.
+    """
+    snapshot = cache.get_snapshot(taxonomy_id)
+
+    def build():
+        return PrefixIndex(label_entries(snapshot, lang))
+
+    name = 'autocomplete:%s' % lang if lang else 'autocomplete'
+    return snapshot, cache.get_derived(taxonomy_id, name, build,
+                                       snapshot=snapshot)
+
+
+def autocomplete(taxonomy_id, query, limit=10, lang=None):
+    """
+    Returns the terms in a taxonomy with a label starting with `query`,
+    labelled in the given language if there is one.
+    """
+    snapshot, index = get_index(taxonomy_id, lang)
+    return [{'id': snapshot.ids[i],
+             'uri': snapshot.uris[i],
+             'label': snapshot.label(i, lang),
+             'match': label}
+            for i, label in index.search(query, limit)]
@@ -0,0 +1,376 @@
+"""
+Backends which share taxonomy cache data and invalidations between nodes.
+
+The in-process caches in `cache` are always used. A backend adds:
+
+* a version number per taxonomy which every node agrees on,
+* a store of binary snapshots, so that a node with a cold cache can fetch
+  a snapshot another node has built rather than query the database, and
+* a channel on which a node changing a taxonomy publishes its new
+  version, which every other node listens to and drops its own copy of
+  that taxonomy.
+
+The backend is chosen with ckanext.taxonomy.cache.backend, which may be
+'database' (the default), 'redis', 'memory' (for a single process, such
+as in tests), or the dotted path of a CacheBackend subclass given as
+'module:Class'.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+PREFIX = 'ckanext.taxonomy:'
+CHANNEL = PREFIX + 'invalidate'
+
+# The key of the version of the set of taxonomies, rather than of any one
+NAMES_KEY = u'*'
+# The prefix of the keys of the versions of each taxonomy's dataset counts
+COUNTS_PREFIX = u'counts:'
+
+# Identifies this process in the messages it publishes, so that it can
+# ignore its own.
+_node = '%s:%s' % (socket.gethostname(), uuid.uuid4().hex)
+
+_backend = []
+_lock = threading.Lock()
+
+
+def origin():
+    return '%s:%d' % (_node, os.getpid())
+
+
+class CacheBackend(object):
+    """
+    The interface of a backend. `shared` is False for backends which only
+    live within one process, where there is nothing to share.
+    """
+    shared = False
+
+    def version(self, taxonomy_id):
+        """ Returns the agreed version of a taxonomy """
+        raise NotImplementedError
+
+    def bump(self, taxonomy_id):
+        """ Moves a taxonomy on to a new version and returns it """
+        raise NotImplementedError
+
+    def get_snapshot(self, taxonomy_id, version):
+        """ Returns the stored binary snapshot of a version, or None """
+        raise NotImplementedError
+
+    def set_snapshot(self, taxonomy_id, version, data):
+        raise NotImplementedError
+
+    def publish(self, message):
+        """ Sends a message dictionary to every node's subscriber """
+        raise NotImplementedError
+
+    def subscribe(self, callback):
+        """
+        Calls `callback` with each message published by other processes,
+        until the process ends.
+        """
+        raise NotImplementedError
+
+    def poll(self):
+        """
+        Looks for changes made by other processes, for backends which
+        aren't told of them. The cache calls this before using its data.
+        """
+        pass
+
+    def inherit(self, previous):
+        """
+        Takes over from the backend of the process this one was forked
+        from, whose cached data the new process still holds.
+        """
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """ Keeps everything within the process, for single node sites """
+
+    def __init__(self):
+        self._versions = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def version(self, taxonomy_id):
+        return self._versions.get(taxonomy_id, 0)
+
+    def bump(self, taxonomy_id):
+        with self._lock:
+            self._versions[taxonomy_id] = self.version(taxonomy_id) + 1
+            return self._versions[taxonomy_id]
+
+    def get_snapshot(self, taxonomy_id, version):
+        # The process's own cache already holds the snapshot
+        return None
+
+    def set_snapshot(self, taxonomy_id, version, data):
+        pass
+
+    def publish(self, message):
+        message = dict(message, origin=origin())
+        for callback in self._subscribers:
+            callback(message)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+
+class DatabaseBackend(MemoryBackend):
+    """
+    Keeps snapshots within each process, as MemoryBackend does, but keeps
+    the version numbers in the taxonomy_cache_version table. Each process
+    reads the table at most once every `check_interval` seconds and drops
+    its copies of the taxonomies others have changed, so changes reach
+    every process using the database within that time.
+    """
+
+    def __init__(self, check_interval=1.0):
+        super(DatabaseBackend, self).__init__()
+        self.check_interval = check_interval
+        self._seen = None
+        self._checked = 0
+
+    def _table(self):
+        from ckanext.taxonomy.models import TaxonomyCacheVersion
+        return TaxonomyCacheVersion.__table__
+
+    def _read(self):
+        import ckan.model as model
+        from sqlalchemy import select
+        table = self._table()
+        with model.meta.engine.connect() as connection:
+            return dict(connection.execute(
+                select([table.c.key, table.c.version])).fetchall())
+
+    def version(self, taxonomy_id):
+        import ckan.model as model
+        from sqlalchemy import select
+        table = self._table()
+        with model.meta.engine.connect() as connection:
+            return connection.execute(
+                select([table.c.version]).where(table.c.key == taxonomy_id)
+            ).scalar() or 0
+
+    def _increment(self, key):
+        try:
+            return self._try_increment(key)
+        except Exception:
+            # Whatever changed has been committed, and other processes
+            # will at worst serve their copies until they expire
+            log.exception('Could not bump the cache version of %s', key)
+            return 0
+
+    def _try_increment(self, key):
+        import ckan.model as model
+        from sqlalchemy import exc, select
+        table = self._table()
+        increment = table.update().where(table.c.key == key)\
+            .values(version=table.c.version + 1)
+        with model.meta.engine.begin() as connection:
+            if not connection.execute(increment).rowcount:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(
+                            table.insert().values(key=key, version=1))
+                except exc.IntegrityError:
+                    # Another process added it first
+                    connection.execute(increment)
+            version = connection.execute(
+                select([table.c.version]).where(table.c.key == key)).scalar()
+
+        # This process already knows of its own change
+        with self._lock:
+            if self._seen is not None and \
+                    self._seen.get(key, 0) == version - 1:
+                self._seen[key] = version
+        return version
+
+    def bump(self, taxonomy_id):
+        return self._increment(taxonomy_id)
+
+    def publish(self, message):
+        if 'counts' in message:
+            for taxonomy_id in message['counts']:
+                self._increment(COUNTS_PREFIX + taxonomy_id)
+        elif message.get('taxonomy_id') is None:
+            self._increment(NAMES_KEY)
+        super(DatabaseBackend, self).publish(message)
+
+    def subscribe(self, callback):
+        super(DatabaseBackend, self).subscribe(callback)
+        if self._seen is None:
+            self._checked = time.time()
+            try:
+                self._seen = self._read()
+            except Exception:
+                log.exception('Could not read the taxonomy cache versions')
+
+    def inherit(self, previous):
+        if isinstance(previous, DatabaseBackend) and \
+                previous._seen is not None:
+            self._seen = dict(previous._seen)
+            self._checked = previous._checked
+
+    def poll(self):
+        if time.time() - self._checked < self.check_interval:
+            return
+        # Only one thread checks at a time, the rest carry on
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._checked = time.time()
+            try:
+                current = self._read()
+            except Exception:
+                log.exception('Could not read the taxonomy cache versions')
+                return
+            seen, self._seen = self._seen, current
+        finally:
+            self._lock.release()
+        if seen is None:
+            return
+
+        changed = [key for key, version in current.items()
+                   if version != seen.get(key)]
+        counts = [key[len(COUNTS_PREFIX):] for key in changed
+                  if key.startswith(COUNTS_PREFIX)]
+        messages = [{'counts': counts}] if counts else []
+        if NAMES_KEY in changed:
+            messages.append({'taxonomy_id': None})
+        else:
+            messages.extend({'taxonomy_id': key, 'version': None}
+                            for key in changed
+                            if not key.startswith(COUNTS_PREFIX))
+        for message in messages:
+            for callback in self._subscribers:
+                callback(dict(message, origin=None))
+
+
+class RedisBackend(CacheBackend):
+    """
+    Shares versions and snapshots through Redis, or anything speaking its
+    protocol, using its publish/subscribe for invalidations.
+    """
+    shared = True
+
+    def __init__(self, url=None, client=None, ttl=86400):
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self._thread = None
+
+    def _key(self, *parts):
+        return PREFIX + ':'.join(str(p) for p in parts)
+
+    def version(self, taxonomy_id):
+        value = self.client.get(self._key('version', taxonomy_id))
+        return int(value) if value is not None else 0
+
+    def bump(self, taxonomy_id):
+        return int(self.client.incr(self._key('version', taxonomy_id)))
+
+    def get_snapshot(self, taxonomy_id, version):
+        return self.client.get(self._key('snapshot', taxonomy_id, version))
+
+    def set_snapshot(self, taxonomy_id, version, data):
+        self.client.set(self._key('snapshot', taxonomy_id, version), data,
+                        ex=self.ttl)
+
+    def publish(self, message):
+        message = dict(message, origin=origin())
+        self.client.publish(CHANNEL, json.dumps(message))
+
+    def subscribe(self, callback):
+        """
+        Listens on a thread of its own. If the connection is lost any
+        message sent meanwhile is missed, so on reconnecting everything is
+        treated as changed.
+        """
+        def listen():
+            reconnecting = False
+            while True:
+                try:
+                    pubsub = self.client.pubsub(
+                        ignore_subscribe_messages=True)
+                    pubsub.subscribe(CHANNEL)
+                    if reconnecting:
+                        callback({'taxonomy_id': None, 'origin': None})
+                        reconnecting = False
+                    for message in pubsub.listen():
+                        if message.get('type') != 'message':
+                            continue
+                        data = message['data']
+                        if isinstance(data, bytes):
+                            data = data.decode('utf-8')
+                        callback(json.loads(data))
+                except Exception:
+                    log.exception('Lost the taxonomy invalidation channel')
+                    reconnecting = True
+                    time.sleep(1)
+
+        self._thread = threading.Thread(target=listen,
+                                         name='taxonomy-invalidations')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+def _create():
+    from ckan.plugins import toolkit
+
+    name = toolkit.config.get('ckanext.taxonomy.cache.backend', 'database')
+    if name == 'database':
+        return DatabaseBackend(float(toolkit.config.get(
+            'ckanext.taxonomy.cache.check_interval', 1.0)))
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'redis':
+        url = toolkit.config.get('ckanext.taxonomy.cache.redis_url') or \
+            toolkit.config.get('ckan.redis.url')
+        ttl = toolkit.asint(toolkit.config.get(
+            'ckanext.taxonomy.cache.ttl', 86400))
+        return RedisBackend(url, ttl=ttl)
+
+    import importlib
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)()
+
+
+def get_backend():
+    """
+    Returns the process's backend, creating it and subscribing the cache
+    to its invalidations when first called in each process.
+    """
+    pid = os.getpid()
+    if not _backend or _backend[0][0] != pid:
+        with _lock:
+            if not _backend or _backend[0][0] != pid:
+                backend = _create()
+                if _backend:
+                    backend.inherit(_backend[0][1])
+                from ckanext.taxonomy import cache
+                backend.subscribe(cache.on_message)
+                del _backend[:]
+                _backend.append((pid, backend))
+    return _backend[0][1]
+
+
+def set_backend(backend):
+    """ Replaces the process's backend, which is mostly useful in tests """
+    from ckanext.taxonomy import cache
+    with _lock:
+        backend.subscribe(cache.on_message)
+        del _backend[:]
+        _backend.append((os.getpid(), backend))
@@ -0,0 +1,234 @@
+"""
+A compact binary file format for taxonomy snapshots, which can be memory
+mapped and used in place rather than loaded from the database.
+
+All numbers are 32 bit, in the byte order of the machine which wrote the
+file. The file is laid out as:
+
+    header         magic, format version, byte order, N terms,
+                   T translations
+    parents        int32[N], the position of each term's parent or -1
+    uri order      uint32[N], term positions sorted by uri
+    id order       uint32[N], term positions sorted by id
+    translations   int32[T], the term position of each translation
+    offsets        uint32[3N + 2T + 2], where each string starts in the
+                   file, and where the last one ends
+    strings        UTF-8 text of the ids (0..N), uris (N..2N), labels
+                   (2N..3N), the language and label of each translation,
+                   and lastly the taxonomy id
+
+Lookups by id or uri are binary searches over the sorted orders, and
+strings are only decoded when they are read, so opening a file costs a
+few milliseconds whatever the size of the taxonomy.
+"""
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+
+from ckanext.taxonomy.cache import TaxonomySnapshot
+
+MAGIC = b'TAXSNAP\x00'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHHII')
+BYTE_ORDERS = {'little': 1, 'big': 2}
+
+
+def _encode(value):
+    return (value or u'').encode('utf-8')
+
+
+def _ints(typecode, values):
+    a = array(typecode, values)
+    assert a.itemsize == 4
+    return a.tobytes()
+
+
+def _sections(snapshot):
+    """ Yields the parts of the binary form of a snapshot, in order """
+    n = len(snapshot)
+    translations = sorted(
+        (lang, i, label)
+        for lang, labels in snapshot.translations.items()
+        for i, label in labels.items())
+
+    strings = [_encode(s) for s in snapshot.ids]
+    strings.extend(_encode(s) for s in snapshot.uris)
+    strings.extend(_encode(s) for s in snapshot.labels)
+    for lang, _, label in translations:
+        strings.append(_encode(lang))
+        strings.append(_encode(label))
+    strings.append(_encode(snapshot.taxonomy_id))
+
+    # Offsets are from the start of the file, after everything else
+    start = HEADER.size + 4 * (3 * n + len(translations) + len(strings) + 1)
+    offsets = [start]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+
+    uri_order = sorted(range(n), key=lambda i: strings[n + i])
+    id_order = sorted(range(n), key=lambda i: strings[i])
+
+    yield HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDERS[sys.byteorder], n,
+                      len(translations))
+    yield _ints('i', list(snapshot.parents))
+    yield _ints('I', uri_order)
+    yield _ints('I', id_order)
+    yield _ints('i', [i for _, i, _ in translations])
+    yield _ints('I', offsets)
+    yield b''.join(strings)
+
+
+def dump_snapshot(snapshot):
+    """ Returns the binary form of a TaxonomySnapshot """
+    return b''.join(_sections(snapshot))
+
+
+def write_snapshot(path, snapshot):
+    """
+    Writes a TaxonomySnapshot to `path`, replacing any existing file in a
+    single rename so that readers only ever see a complete file.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        for section in _sections(snapshot):
+            f.write(section)
+    os.rename(tmp, path)
+
+
+class _Strings(object):
+    """ A read-only sequence of a range of the strings in the file """
+
+    def __init__(self, data, offsets, start, length):
+        self._data = data
+        self._offsets = offsets
+        self._start = start
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def raw(self, index):
+        k = self._start + index
+        return self._data[self._offsets[k]:self._offsets[k + 1]]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self.raw(index).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+
+class _Lookup(object):
+    """
+    Finds the position of a string in a column by binary search over the
+    positions sorted by that column, with the interface of a dictionary's
+    get().
+    """
+
+    def __init__(self, strings, order):
+        self._strings = strings
+        self._order = order
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        key = _encode(key)
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._strings.raw(self._order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._order):
+            i = self._order[lo]
+            if self._strings.raw(i) == key:
+                return i
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._order)
+
+
+class BinarySnapshot(TaxonomySnapshot):
+    """
+    A TaxonomySnapshot read in place from its binary form, held in any
+    object supporting the buffer protocol and slicing to bytes.
+    """
+
+    def __init__(self, data, version=0):
+        if len(data) < HEADER.size:
+            raise ValueError('Not a taxonomy snapshot')
+        magic, format_version, byte_order, n, t = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError('Not a taxonomy snapshot')
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError('The snapshot was written on a machine with a '
+                             'different byte order')
+
+        view = memoryview(data)
+        position = [HEADER.size]
+
+        def section(typecode, length):
+            start = position[0]
+            position[0] += length * 4
+            return view[start:position[0]].cast(typecode)
+
+        self.parents = section('i', n)
+        uri_order = section('I', n)
+        id_order = section('I', n)
+        self._translation_terms = section('i', t)
+        strings = 3 * n + 2 * t + 1
+        offsets = section('I', strings + 1)
+
+        self._all = _Strings(data, offsets, 0, strings)
+        self.ids = _Strings(data, offsets, 0, n)
+        self.uris = _Strings(data, offsets, n, n)
+        self.labels = _Strings(data, offsets, 2 * n, n)
+        self._translation_strings = _Strings(data, offsets, 3 * n, 2 * t)
+        self.by_id = _Lookup(self.ids, id_order)
+        self.by_uri = _Lookup(self.uris, uri_order)
+
+        self.taxonomy_id = self._all[strings - 1]
+        self.version = version
+        self._children = None
+        self._translations = None
+
+    @property
+    def translations(self):
+        """ {lang: {position: label}}, decoded when first needed """
+        if self._translations is None:
+            res = {}
+            strings = self._translation_strings
+            for k, i in enumerate(self._translation_terms):
+                res.setdefault(strings[2 * k], {})[i] = strings[2 * k + 1]
+            self._translations = res
+        return self._translations
+
+
+class MappedSnapshot(BinarySnapshot):
+    """
+    A snapshot read from a file written by write_snapshot, using the
+    memory mapped file directly rather than copying it into lists.
+    """
+
+    def __init__(self, path, version=0):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            super(MappedSnapshot, self).__init__(self._mmap, version)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (path, e))
+        self.path = path
@@ -0,0 +1,582 @@
+"""
+In-process caches of taxonomy data used on the read path.
+
+Each taxonomy has a version number which is bumped whenever one of its
+terms is created, updated or deleted. Cached data is stored against the
+version it was built from, and replaced once a newer version is built.
+Other processes and nodes are told of the change through the cache
+backend (see `backends`), or find it when they next check it.
+
+Only one thread in a process builds any one entry at a time. Others
+wanting the same entry meanwhile are given the copy built from the
+previous version if there is one, and otherwise wait for the build to
+finish, so that a change to a popular taxonomy doesn't send every request
+to the database at once. With ckanext.taxonomy.cache.refresh set, a
+changed taxonomy's snapshot is rebuilt in the background straight away,
+rather than by the next request to use it.
+"""
+import os
+import threading
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+_lock = threading.RLock()
+_versions = {}
+_snapshots = {}
+_derived = {}
+_flights = {}
+_taxonomy_names = {}
+_counts_versions = {}
+_listening = []
+
+# Where the taxonomies whose counts a transaction changed are kept until
+# it commits
+_PENDING_COUNTS = 'ckanext.taxonomy.counts_changed'
+
+
+class TaxonomySnapshot(object):
+    """
+    A read-only, flattened copy of the terms within a single taxonomy.
+
+    Terms are held in parallel lists and refer to their parent by position
+    rather than by id, so walking from a term up to the top of the
+    taxonomy never needs to go back to the database.
+    """
+    # The version of the shared snapshot file this was mapped from, if any
+    shared_version = None
+
+    def __init__(self, taxonomy_id, version, rows, translations=None):
+        self.taxonomy_id = taxonomy_id
+        self.version = version
+
+        self.ids = []
+        self.uris = []
+        self.labels = []
+        parent_ids = []
+        for id, parent_id, uri, label in rows:
+            self.ids.append(id)
+            parent_ids.append(parent_id)
+            self.uris.append(uri)
+            self.labels.append(label)
+
+        self.by_id = dict((id, i) for i, id in enumerate(self.ids))
+        self.by_uri = dict((uri, i) for i, uri in enumerate(self.uris))
+        self.parents = [self.by_id.get(p, -1) for p in parent_ids]
+        self._children = None
+
+        # {lang: {position: label}} for the labels in other languages
+        self.translations = {}
+        for term_id, lang, label in translations or []:
+            i = self.by_id.get(term_id)
+            if i is not None:
+                self.translations.setdefault(lang, {})[i] = label
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, uri_or_id):
+        """
+        Returns the position of the term with the given uri or id, or None
+        if it isn't part of this taxonomy.
+        """
+        i = self.by_uri.get(uri_or_id)
+        if i is None:
+            i = self.by_id.get(uri_or_id)
+        return i
+
+    def label(self, index, lang=None):
+        """
+        Returns the label of the term at `index` in the given language,
+        falling back from a regional language such as 'en-GB' to 'en', and
+        then to the term's own label.
+        """
+        if lang:
+            for candidate in (lang, lang.split('-')[0]):
+                label = self.translations.get(candidate, {}).get(index)
+                if label:
+                    return label
+        return self.labels[index]
+
+    def children(self, index):
+        """ Returns the positions of the terms directly below `index` """
+        if self._children is None:
+            children = [[] for _ in self.ids]
+            for i, parent in enumerate(self.parents):
+                if parent != -1:
+                    children[parent].append(i)
+            self._children = children
+        return self._children[index]
+
+    def descendants(self, index):
+        """ Returns the positions of every term below the one at `index` """
+        res = []
+        seen = set([index])
+        stack = [index]
+        while stack:
+            for child in self.children(stack.pop()):
+                if child not in seen:
+                    seen.add(child)
+                    res.append(child)
+                    stack.append(child)
+        return res
+
+    def ancestors(self, index):
+        """
+        Returns the positions of every term above the one at `index`,
+        nearest first. The walk is bounded by the size of the taxonomy so
+        that a cycle in the data can't hang the caller.
+        """
+        res = []
+        parent = self.parents[index]
+        while parent != -1 and len(res) < len(self.ids):
+            res.append(parent)
+            parent = self.parents[parent]
+        return res
+
+
+def version(taxonomy_id):
+    """ Returns the current cache version of the given taxonomy """
+    return _versions.get(taxonomy_id, 0)
+
+
+def counts_version(taxonomy_id):
+    """
+    Returns a number which changes whenever the dataset counts of any term
+    of a taxonomy change, for cached data which includes them.
+    """
+    return _counts_versions.get(taxonomy_id, 0)
+
+
+def counts_changed(taxonomy_ids):
+    """
+    Marks cached data which includes the dataset counts of the given
+    taxonomies as stale, in this process and through the cache backend in
+    every other, once the current transaction commits. Until then the
+    data would be rebuilt with the old counts. Nothing is marked if the
+    transaction is rolled back.
+    """
+    import ckan.model as model
+    if not _listening:
+        _listen()
+    model.Session.info.setdefault(_PENDING_COUNTS, set()).update(
+        taxonomy_ids)
+
+
+def _listen():
+    import ckan.model as model
+    from sqlalchemy import event
+    with _lock:
+        if not _listening:
+            event.listen(model.Session, 'after_commit', _after_commit)
+            event.listen(model.Session, 'after_soft_rollback',
+                         _after_rollback)
+            _listening.append(True)
+
+
+def _after_commit(session):
+    transaction = session.transaction
+    if transaction is not None and \
+            (transaction.nested or transaction.parent is not None):
+        # Only a savepoint or subtransaction
+        return
+    taxonomy_ids = session.info.pop(_PENDING_COUNTS, None)
+    if taxonomy_ids:
+        _bump_counts(taxonomy_ids)
+        from ckanext.taxonomy.backends import get_backend
+        try:
+            get_backend().publish({'counts': sorted(taxonomy_ids)})
+        except Exception:
+            # The change itself has been committed
+            log.exception('Could not publish a change to dataset counts')
+
+
+def _after_rollback(session, previous_transaction):
+    if not previous_transaction.nested and \
+            previous_transaction.parent is None:
+        session.info.pop(_PENDING_COUNTS, None)
+
+
+def _bump_counts(taxonomy_ids):
+    with _lock:
+        for id in taxonomy_ids:
+            _counts_versions[id] = _counts_versions.get(id, 0) + 1
+
+
+def invalidate(taxonomy_id=None):
+    """
+    Marks all of the cached data for a taxonomy as stale, in this process
+    and, through the cache backend, in every other. Passing no taxonomy_id
+    means the set of taxonomies has changed as well.
+    """
+    if taxonomy_id is None:
+        clear()
+    else:
+        _bump([taxonomy_id])
+
+    from ckanext.taxonomy.backends import get_backend
+    backend = get_backend()
+    version = None
+    if taxonomy_id is not None:
+        version = backend.bump(taxonomy_id)
+        if _shared():
+            # Let the other processes sharing snapshot files know
+            from ckanext.taxonomy import shared
+            shared.bump_version(
+                taxonomy_id, version if backend.shared else None)
+    backend.publish({'taxonomy_id': taxonomy_id, 'version': version})
+    if taxonomy_id is not None:
+        _refresh(taxonomy_id)
+
+
+def clear():
+    """
+    Drops all of the cached data held by this process, without telling
+    any other.
+    """
+    with _lock:
+        _taxonomy_names.clear()
+        _bump(set(_versions) | set(_snapshots))
+        # Some of these may be of taxonomies which no longer exist
+        _snapshots.clear()
+        _derived.clear()
+
+
+def on_message(message):
+    """
+    Applies an invalidation published by another process through the
+    cache backend.
+    """
+    from ckanext.taxonomy.backends import origin
+    if message.get('origin') == origin():
+        return
+    if 'counts' in message:
+        _bump_counts(message['counts'])
+        return
+    taxonomy_id = message.get('taxonomy_id')
+    if taxonomy_id is None:
+        clear()
+        return
+    _bump([taxonomy_id])
+    if message.get('version') and _shared():
+        from ckanext.taxonomy import shared
+        shared.bump_version(taxonomy_id, message['version'])
+    _refresh(taxonomy_id)
+
+
+def _bump(ids):
+    # The cached copies are kept, to be given out while the new version
+    # is built.
+    with _lock:
+        for id in ids:
+            _versions[id] = _versions.get(id, 0) + 1
+
+
+def _shared():
+    from ckanext.taxonomy import shared
+    return bool(shared.directory())
+
+
+def _poll():
+    """
+    Lets the cache backend apply changes made by other processes which it
+    isn't told of as they happen.
+    """
+    from ckanext.taxonomy.backends import get_backend
+    get_backend().poll()
+
+
+def _check_shared(taxonomy_id):
+    """
+    Drops the cached data of a taxonomy which another process has changed
+    since its shared snapshot file was mapped.
+    """
+    snapshot = _snapshots.get(taxonomy_id)
+    if snapshot is None or snapshot.shared_version is None or \
+            snapshot.version != version(taxonomy_id):
+        return
+    from ckanext.taxonomy import shared
+    if shared.changed(taxonomy_id, snapshot.shared_version):
+        _bump([taxonomy_id])
+
+
+def get_snapshot(taxonomy_id):
+    """
+    Returns the TaxonomySnapshot for the given taxonomy id, building it
+    with a single query if there isn't a current one cached.
+    """
+    _poll()
+    _check_shared(taxonomy_id)
+    current = version(taxonomy_id)
+    previous = _snapshots.get(taxonomy_id)
+    if previous is not None and previous.version == current:
+        return previous
+
+    def build():
+        snapshot = _load_snapshot(taxonomy_id, current)
+        with _lock:
+            if version(taxonomy_id) == current:
+                _snapshots[taxonomy_id] = snapshot
+        return snapshot
+
+    return _single_flight(('snapshot', taxonomy_id, current), build,
+                          previous)
+
+
+def taxonomy_ids():
+    """ Returns the ids of every known taxonomy """
+    return sorted(set(_get_taxonomy_names().values()))
+
+
+def get_snapshots(replacing=None):
+    """
+    Returns a snapshot for every known taxonomy. A snapshot built within
+    a transaction which hasn't been committed yet can be given as
+    `replacing`, to be used instead of the cached copy of its taxonomy.
+    """
+    if replacing is None:
+        return [get_snapshot(id) for id in taxonomy_ids()]
+    return [get_snapshot(id) for id in taxonomy_ids()
+            if id != replacing.taxonomy_id] + [replacing]
+
+
+def get_derived(taxonomy_id, name, build, stamp=None, snapshot=None):
+    """
+    Returns data derived from a taxonomy, such as an index over its
+    labels, calling `build` to create it if there isn't a copy built from
+    the current version of the taxonomy. Data which also depends on
+    something else can pass a `stamp` which must match as well.
+
+    Data built from a `snapshot`, such as an index of term positions,
+    should pass it, so that the copy returned is always the one built from
+    that snapshot, even while it is out of date.
+    """
+    _poll()
+    _check_shared(taxonomy_id)
+    built_from = version(taxonomy_id) if snapshot is None \
+        else snapshot.version
+    current = (built_from, stamp)
+    key = (taxonomy_id, name)
+    entry = _derived.get(key)
+    if entry is not None and entry[0] == current:
+        return entry[1]
+
+    previous = None
+    if entry is not None and (snapshot is None or entry[0][0] == built_from):
+        previous = entry[1]
+
+    def build_entry():
+        value = build()
+        with _lock:
+            if version(taxonomy_id) == built_from:
+                _derived[key] = (current, value)
+        return value
+
+    return _single_flight(('derived', key, current), build_entry, previous)
+
+
+class _Flight(object):
+    """ A build in progress, which other threads wanting it wait for """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _single_flight(key, build, previous=None):
+    """
+    Calls `build` unless another thread is already building `key`, in
+    which case `previous` is returned if there is one and stale copies may
+    be served, and otherwise the other thread's result once it finishes.
+    A thread which waits longer than the wait timeout builds its own.
+    """
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = _Flight()
+            leader = True
+        else:
+            leader = False
+
+    if not leader and flight.thread is not threading.current_thread():
+        if previous is not None and _config('serve_stale', True):
+            return previous
+        if flight.done.wait(_config('wait_timeout', 30.0)):
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        log.warning('Gave up waiting for %r to be built', key)
+        return build()
+    if not leader:
+        # Something the build depends on needs it built already
+        return build()
+
+    try:
+        flight.value = build()
+        return flight.value
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _after_fork():
+    """
+    Forgets the builds of other threads in a newly forked process, where
+    those threads don't exist to finish them.
+    """
+    global _lock
+    _lock = threading.RLock()
+    _flights.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _refresh(taxonomy_id):
+    """
+    Rebuilds a taxonomy's snapshot on a thread of its own if background
+    refreshing is turned on, while requests are given the previous one.
+    """
+    if not _config('refresh', False):
+        return
+
+    def run():
+        import ckan.model as model
+        try:
+            get_snapshot(taxonomy_id)
+        except Exception:
+            log.exception('Could not refresh the snapshot of %s',
+                          taxonomy_id)
+        finally:
+            model.Session.remove()
+
+    thread = threading.Thread(target=run,
+                              name='taxonomy-refresh-%s' % taxonomy_id)
+    thread.daemon = True
+    thread.start()
+
+
+def _config(name, default):
+    from ckan.plugins import toolkit
+    value = toolkit.config.get('ckanext.taxonomy.cache.%s' % name, default)
+    if isinstance(default, bool):
+        return toolkit.asbool(value)
+    return float(value)
+
+
+def taxonomy_id_for(name_or_id):
+    """
+    Returns the id of the taxonomy with the given name or id without
+    going to the database, or None if there is no such taxonomy.
+    """
+    return _get_taxonomy_names().get(name_or_id)
+
+
+def find_terms(uris, replacing=None):
+    """
+    Finds the given term uris across every taxonomy, returning a list of
+    (snapshot, index) pairs for the terms that exist. See `get_snapshots`
+    for `replacing`.
+    """
+    res = []
+    snapshots = get_snapshots(replacing)
+    for uri in uris:
+        for snapshot in snapshots:
+            i = snapshot.by_uri.get(uri)
+            if i is not None:
+                res.append((snapshot, i))
+    return res
+
+
+def _get_taxonomy_names():
+    """
+    Returns a dictionary mapping both the name and the id of every
+    taxonomy to its id.
+    """
+    _poll()
+    if not _taxonomy_names:
+        import ckan.model as model
+        from ckanext.taxonomy.models import Taxonomy
+
+        names = {}
+        for id, name in model.Session.query(Taxonomy.id, Taxonomy.name):
+            names[id] = id
+            names[name] = id
+        with _lock:
+            _taxonomy_names.update(names)
+    return dict(_taxonomy_names)
+
+
+def _load_snapshot(taxonomy_id, version):
+    """
+    Maps the taxonomy's shared snapshot file if snapshot files are used,
+    otherwise builds the snapshot from the database.
+    """
+    # Make sure this process is listening for invalidations before it
+    # caches anything.
+    from ckanext.taxonomy.backends import get_backend
+    get_backend()
+
+    if _shared():
+        from ckanext.taxonomy import shared
+        return shared.load_snapshot(taxonomy_id, version)
+    return fetch_snapshot(taxonomy_id, version)
+
+
+def fetch_snapshot(taxonomy_id, version=0):
+    """
+    Returns the snapshot of a taxonomy stored in the cache backend by
+    another node, or builds it from the database and stores it there.
+    """
+    from ckanext.taxonomy.backends import get_backend
+    backend = get_backend()
+    if not backend.shared:
+        return build_snapshot(taxonomy_id, version)
+
+    from ckanext.taxonomy.binary import BinarySnapshot, dump_snapshot
+    shared_version = backend.version(taxonomy_id)
+    data = backend.get_snapshot(taxonomy_id, shared_version)
+    if data is not None:
+        try:
+            return BinarySnapshot(data, version)
+        except ValueError as e:
+            log.warning('Ignoring stored snapshot of %s: %s',
+                        taxonomy_id, e)
+
+    snapshot = build_snapshot(taxonomy_id, version)
+    # Don't store it if the taxonomy changed while it was being read
+    if backend.version(taxonomy_id) == shared_version:
+        backend.set_snapshot(taxonomy_id, shared_version,
+                             dump_snapshot(snapshot))
+    return snapshot
+
+
+def build_snapshot(taxonomy_id, version=0):
+    """ Builds the snapshot of a taxonomy from the database """
+    import ckan.model as model
+    from ckanext.taxonomy.labels import PREF
+    from ckanext.taxonomy.models import TaxonomyTerm, TaxonomyTermLabel
+
+    rows = model.Session.query(TaxonomyTerm.id, TaxonomyTerm.parent_id,
+                               TaxonomyTerm.uri, TaxonomyTerm.label)\
+        .filter(TaxonomyTerm.taxonomy_id == taxonomy_id)\
+        .order_by(TaxonomyTerm.id)
+    translations = model.Session.query(TaxonomyTermLabel.term_id,
+                                       TaxonomyTermLabel.lang,
+                                       TaxonomyTermLabel.label)\
+        .filter(TaxonomyTermLabel.taxonomy_id == taxonomy_id)\
+        .filter(TaxonomyTermLabel.kind == PREF)\
+        .filter(TaxonomyTermLabel.lang.isnot(None))
+    snapshot = TaxonomySnapshot(taxonomy_id, version, rows.all(),
+                                translations.all())
+    log.debug('Loaded snapshot of %s (%d terms, version %d)',
+              taxonomy_id, len(snapshot), version)
+    return snapshot
@@ -0,0 +1,111 @@
+"""
+Records every change to a term in the taxonomy_term_change log, and reads
+it back for mirrors which sync incrementally.
+
+Each change has a sequence number, and a mirror asks for the changes after
+the last one it has applied. For that to never skip a change, numbers must
+be handed out in the order the changes are committed. On PostgreSQL,
+where transactions run concurrently, recording a change therefore locks
+the log against other writers until the transaction commits. Reading the
+log is never blocked.
+"""
+import datetime
+
+import ckan.model as model
+from sqlalchemy import func
+
+from ckanext.taxonomy.models import TaxonomyTermChange
+
+CREATE = u'create'
+UPDATE = u'update'
+MOVE = u'move'
+DELETE = u'delete'
+
+# The fields of a term compared to tell what kind of change it was
+FIELDS = ('label', 'description', 'uri', 'extras', 'parent_id')
+
+
+def _lock():
+    session = model.Session
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(
+            'LOCK TABLE taxonomy_term_change IN EXCLUSIVE MODE')
+
+
+def _row(action, term, taxonomy_id=None, now=None):
+    return {
+        'taxonomy_id': term.get('taxonomy_id') or taxonomy_id,
+        'term_id': term['id'],
+        'uri': term.get('uri'),
+        'action': action,
+        'timestamp': now or datetime.datetime.utcnow(),
+        'term': None if action == DELETE else term,
+    }
+
+
+def record(action, term):
+    """
+    Records a change to a term, given as a term dict, as part of the
+    current transaction. Deleted terms only need their 'id', 'uri' and
+    'taxonomy_id'.
+    """
+    record_many([_row(action, term)])
+
+
+def record_many(rows):
+    """ Records many changes at once, as made by `changes_between` """
+    if not rows:
+        return
+    _lock()
+    model.Session.execute(TaxonomyTermChange.__table__.insert(), rows)
+
+
+def kind_of_change(before, after):
+    """
+    Returns the kind of change between two versions of a term dict, MOVE
+    if its parent changed, or None if nothing did.
+    """
+    if before.get('parent_id') != after.get('parent_id'):
+        return MOVE
+    if any(before.get(f) != after.get(f) for f in FIELDS):
+        return UPDATE
+    return None
+
+
+def changes_between(taxonomy_id, before, after):
+    """
+    Returns the changes which turn one set of a taxonomy's terms into
+    another, each given as a dictionary of term dicts keyed by id.
+    """
+    now = datetime.datetime.utcnow()
+    rows = []
+    for id, term in before.items():
+        if id not in after:
+            rows.append(_row(DELETE, term, taxonomy_id, now))
+    for id, term in after.items():
+        if id not in before:
+            rows.append(_row(CREATE, term, taxonomy_id, now))
+        else:
+            action = kind_of_change(before[id], term)
+            if action:
+                rows.append(_row(action, term, taxonomy_id, now))
+    return rows
+
+
+def changes_since(since=0, taxonomy_id=None, limit=1000):
+    """
+    Returns up to `limit` changes numbered after `since`, oldest first,
+    and whether there are more.
+    """
+    q = model.Session.query(TaxonomyTermChange)\
+        .filter(TaxonomyTermChange.seq > since)
+    if taxonomy_id:
+        q = q.filter(TaxonomyTermChange.taxonomy_id == taxonomy_id)
+    rows = q.order_by(TaxonomyTermChange.seq).limit(limit + 1).all()
+    return [row.as_dict() for row in rows[:limit]], len(rows) > limit
+
+
+def latest():
+    """ Returns the number of the latest change, or 0 """
+    return model.Session.query(func.max(TaxonomyTermChange.seq)).scalar() \
+        or 0
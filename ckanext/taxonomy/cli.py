@@ -1,7 +1,6 @@
+import os
 import sys
 import click
-import rdflib
-import skos
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -18,16 +17,41 @@ paster taxonomy cleanup
 # Loading a taxonomy
 paster taxonomy load --url URL --name NAME --title TITLE --lang LANG --uri URI
 paster taxonomy load --filename FILE --name NAME --title TITLE --lang LANG --uri URI
+    [--lock-policy wait|fail --lock-timeout SECONDS]
+
+# Exporting a taxonomy as SKOS (turtle or nt) or JSON Lines (jsonl)
+paster taxonomy export NAME --format FORMAT --output FILE --lang LANG
 
 # Loading taxonomy extras
 paster taxonomy load-extras --filename FILE --name NAME
 
+# Indexing the labels of terms created before the label index existed
+paster taxonomy index-labels --name NAME
+
+# Suggesting terms for each line of a file of free text tags
+paster taxonomy reconcile FILE --name NAME --output CSV --workers N
+
+# Replacing tags on datasets with taxonomy terms
+paster taxonomy migrate-tags MAPPING --workers N --checkpoint FILE
+
+# Writing taxonomies out as static files for a web server to serve
+paster taxonomy publish --directory DIR --name NAME --lang LANG
+
+# Writing binary snapshot files for web nodes to map instead of querying
+paster taxonomy snapshot --name NAME
+
+# Rebuilding the record of which datasets use which terms
+paster taxonomy backfill-usage --batch-size SIZE --workers WORKERS
+
 Where:
-    URL  is the url to a SKOS document
-    FILE is the local path to a SKOS/extras document
+    URL  is the url to a SKOS document, or to a JSON Lines export
+         ending in .jsonl
+    FILE is the local path to a SKOS/extras document, or to a JSON Lines
+         export ending in .jsonl
     NAME is the short-name of the taxonomy
     TITLE is the title of the taxonomy
-    LANG (optional) is a language identifier, e.g. en, es, fr
+    LANG (optional) is the language of the default labels, e.g. en, es,
+         fr. Labels in every other language are stored as translations.
     URI is a uri for the taxonomy
 """
 
@@ -61,9 +85,11 @@ def cleanup():
 @click.option('--filename', is_flag = False, default = None, help = "Path to a file")
 @click.option('--name'    , is_flag = False, default = None, help = "Name of the taxonomy to work with", required = True)
 @click.option('--title'   , is_flag = False, default = None, help = "Title of the taxonomy")
-@click.option('--lang'    , is_flag = False, default = 'en', help = "Language to use when retrieving labels. Default is 'en'")
+@click.option('--lang'    , is_flag = False, default = 'en', help = "Language of the default labels, others are stored as translations. Default is 'en'")
 @click.option('--uri'     , is_flag = False, default = None, help = "The URI of the taxonomy", required = True)
-def load(url, filename, name, title, lang, uri):
+@click.option('--lock-policy', type=click.Choice(['wait', 'fail']), default=None, help="Whether to wait for another import of the taxonomy to finish or fail, default is ckanext.taxonomy.lock.policy")
+@click.option('--lock-timeout', type=float, default=None, help="Seconds to wait for another import, default is ckanext.taxonomy.lock.timeout")
+def load(url, filename, name, title, lang, uri, lock_policy, lock_timeout):
     """Load a taxonomy
     """
     if not url and not filename:
@@ -81,68 +107,46 @@ def load(url, filename, name, title, lang, uri):
         logger.error(usage)
         return
 
-    logger.info("Loading graph")
-    graph = rdflib.Graph()
-    result = graph.parse(url or filename)
-    loader = skos.RDFLoader(graph, max_depth=float('inf'), flat=True, lang=lang)
+    from ckanext.taxonomy import importer
+    from ckanext.taxonomy.locks import TaxonomyLocked
 
-    logger.info("Processing concepts")
-    concepts = loader.getConcepts()
+    try:
+        tx, count = importer.import_taxonomy(
+            url or filename, name, title, uri, lang,
+            lock_policy=lock_policy, lock_timeout=lock_timeout)
+    except TaxonomyLocked as e:
+        logger.error(str(e))
+        sys.exit(1)
+    logger.info('Loaded %d terms into %s', count, tx['name'])
+    logger.info('Load complete')
 
-    top_level = []
-    for _, v in concepts.items():
-        if not v.broader:
-            top_level.append(v)
-    top_level.sort(key=lambda x: x.prefLabel)
 
-    import ckan.model as model
+@taxonomy.command()
+@click.argument(u'name')
+@click.option('--format', type=click.Choice(['turtle', 'nt', 'jsonl']), default='turtle', help="Format to write, default is turtle")
+@click.option('--output', default='-', help="Path of the file to write, default is stdout")
+@click.option('--lang'  , default='en', help="Language of the default labels, to give to load. Default is 'en'")
+def export(name, format, output, lang):
+    """Export a taxonomy as SKOS or JSON Lines
+    """
+    import io
     import ckan.logic as logic
+    from ckanext.taxonomy.export import export as export_taxonomy
 
-    context = {'model': model, 'ignore_auth': True }
-
+    if output == '-':
+        output_file = click.get_text_stream('stdout')
+    else:
+        output_file = io.open(output, 'w', encoding='utf-8')
     try:
-        current = logic.get_action('taxonomy_show')(
-            context,
-            {'id': name})
-        logic.get_action('taxonomy_delete')(
-            context,
-            {'id': name})
+        count = export_taxonomy(name, output_file, format, lang)
     except logic.NotFound:
-        pass
-
-    tx = logic.get_action('taxonomy_create')(context, {
-        'title': title or name,
-        'name': name,
-        'uri': uri
-    })
-
-    for t in top_level:
-       _add_node(context, tx, t)
-    logger.info('Load complete')
-
-def _add_node(context, tx, node, parent=None, depth = 1):
-    import ckan.logic as logic
-
-    logger.info(('   ' * depth) + node.prefLabel)
-
-    description = ''
-    if hasattr(node, 'definition') and node.definition:
-        description = node.definition
-
-    # logger.debug(type(node))
-    # rdfs:comment print dir(node)
-
-    nd = logic.get_action('taxonomy_term_create')(context,  {
-        'label': node.prefLabel,
-        'uri': node.uri,
-        'description': description,
-        'taxonomy_id': tx['id'],
-        'parent_id': parent
-    })
-    node_id = nd['id']
+        logger.error("No taxonomy called %s", name)
+        return
+    finally:
+        if output != '-':
+            output_file.close()
+    logger.info('Exported %d terms', count)
 
-    for _, child in node.narrower.items():
-        _add_node(context, tx, child, node_id, depth + 1)
 
 @taxonomy.command()
 @click.argument(u'filename')
@@ -161,9 +165,163 @@ def load_extras(filename, name):
         return
 
     from . import lib
-    lib.load_term_extras(filename, taxonomy_name=name)
+    from ckanext.taxonomy.locks import TaxonomyLocked
+
+    try:
+        lib.load_term_extras(filename, taxonomy_name=name)
+    except TaxonomyLocked as e:
+        logger.error(str(e))
+        sys.exit(1)
     logger.info('Extras loaded')
 
 
+@taxonomy.command()
+@click.option('--batch-size', default=500, help="Number of datasets per batch")
+@click.option('--workers'   , default=4, help="Number of batches to process at once")
+def backfill_usage(batch_size, workers):
+    """Record the terms used by all existing datasets
+    """
+    from ckanext.taxonomy.usage import backfill
+    total = backfill(batch_size=batch_size, workers=workers)
+    logger.info('Term usage recorded for %d datasets', total)
+
+
+@taxonomy.command()
+@click.option('--name', default=None, help="Name of the taxonomy, all are indexed if omitted")
+def index_labels(name):
+    """Index the labels of terms created before the label index existed
+    """
+    from ckanext.taxonomy.labels import rebuild
+    from ckanext.taxonomy.models import Taxonomy
+
+    taxonomy_id = None
+    if name:
+        taxonomy = Taxonomy.get(name)
+        if not taxonomy:
+            logger.error("No taxonomy called %s", name)
+            return
+        taxonomy_id = taxonomy.id
+    total = rebuild(taxonomy_id)
+    logger.info('Labels indexed for %d terms', total)
+
+
+@taxonomy.command()
+@click.argument(u'filename')
+@click.option('--name'     , default=None, help="Name of the taxonomy to match against, all are used if omitted")
+@click.option('--output'   , default='-', help="Path of the CSV file to write, default is stdout")
+@click.option('--limit'    , default=3, help="Number of candidate terms per string")
+@click.option('--threshold', default=0.0, help="Lowest score a candidate may have, between 0 and 1")
+@click.option('--workers'  , default=1, help="Number of processes to match with")
+def reconcile(filename, name, output, limit, threshold, workers):
+    """Suggest taxonomy terms for each line of a text file
+    """
+    import csv
+    from ckanext.taxonomy.models import Taxonomy
+    from ckanext.taxonomy.reconcile import reconcile_file
+
+    taxonomy_ids = None
+    if name:
+        taxonomy = Taxonomy.get(name)
+        if not taxonomy:
+            logger.error("No taxonomy called %s", name)
+            return
+        taxonomy_ids = [taxonomy.id]
+
+    with open(filename) as input_file:
+        strings = [line.strip() for line in input_file if line.strip()]
+
+    with click.open_file(output, 'w') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['string', 'rank', 'score', 'uri', 'label', 'match'])
+        for text, candidates in reconcile_file(strings, taxonomy_ids, limit,
+                                               threshold, workers):
+            for rank, c in enumerate(candidates, 1):
+                writer.writerow([text, rank, c['score'], c['uri'],
+                                 c['label'], c['match']])
+    logger.info('Reconciled %d strings', len(strings))
+
+
+@taxonomy.command()
+@click.argument(u'mapping')
+@click.option('--field'     , default=None, help="Dataset field to store term uris in, default is the first of ckanext.taxonomy.package_fields")
+@click.option('--page-size' , default=100, help="Number of datasets written per transaction")
+@click.option('--workers'   , default=4, help="Number of pages to write at once")
+@click.option('--checkpoint', default='migrate-tags.checkpoint.json', help="File recording progress, so an interrupted run can resume")
+@click.option('--restart'   , is_flag=True, help="Ignore any existing checkpoint and start from the beginning")
+@click.option('--keep-tags' , is_flag=True, help="Leave the mapped tags on the datasets")
+@click.option('--dry-run'   , is_flag=True, help="Report what would change without writing anything")
+def migrate_tags(mapping, field, page_size, workers, checkpoint, restart,
+                 keep_tags, dry_run):
+    """Replace tags on datasets with taxonomy terms, using a CSV mapping
+    with tag, uri and (optional) vocabulary columns
+    """
+    import os
+    from ckan.plugins import toolkit
+    from ckanext.taxonomy import migrate
+
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    result = migrate.migrate_tags(migrate.load_mapping(mapping),
+                                  field=field,
+                                  page_size=page_size,
+                                  workers=workers,
+                                  checkpoint_path=checkpoint,
+                                  keep_tags=keep_tags,
+                                  dry_run=dry_run,
+                                  user=site_user['name'])
+    logger.info('Visited %(visited)d datasets, changed %(changed)d', result)
+
+
+@taxonomy.command()
+@click.option('--directory', default=None, help="Directory to write to, default is ckanext.taxonomy.publish.directory")
+@click.option('--name'     , multiple=True, help="Name of a taxonomy to publish, all are published if omitted")
+@click.option('--lang'     , default=None, help="Language to label the terms in, written to a directory of its own")
+def publish(directory, name, lang):
+    """Write taxonomies out as static JSON files, with compressed copies
+    """
+    from ckanext.taxonomy import publish as publisher
+
+    directory = directory or publisher.publish_directory()
+    if not directory:
+        logger.error("No --directory given and "
+                     "ckanext.taxonomy.publish.directory is not set")
+        return
+    written, removed = publisher.publish(directory, names=name, lang=lang)
+    logger.info('Published to %s: %d files written, %d removed',
+                directory, written, removed)
+
+
+@taxonomy.command()
+@click.option('--name', multiple=True, help="Name of a taxonomy to write, all are written if omitted")
+def snapshot(name):
+    """Write the shared snapshot files of taxonomies
+    """
+    from ckanext.taxonomy import cache, shared
+    from ckanext.taxonomy.binary import write_snapshot
+
+    directory = shared.directory()
+    if not directory:
+        logger.error("ckanext.taxonomy.snapshot.directory is not set")
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    taxonomy_ids = cache.taxonomy_ids()
+    if name:
+        taxonomy_ids = [cache.taxonomy_id_for(n) for n in name]
+        if None in taxonomy_ids:
+            logger.error("No taxonomy called %s",
+                         name[taxonomy_ids.index(None)])
+            return
+    for taxonomy_id in taxonomy_ids:
+        path = shared.snapshot_file(taxonomy_id,
+                                    shared.read_version(taxonomy_id))
+        snapshot = cache.build_snapshot(taxonomy_id)
+        write_snapshot(path, snapshot)
+        logger.info('Wrote %d terms to %s', len(snapshot), path)
+
+
 def get_commands():
     return [taxonomy]
@@ -17,17 +17,78 @@ class TaxonomyController(base.BaseController):
         return toolkit.render('ckanext/taxonomy/index.html')
 
     def show(self, name):
+        fragments = self._fragments(name)
+
+        toolkit.c.taxonomy = fragments.taxonomy
+        toolkit.c.tree_html = toolkit.literal(fragments['tree.html'].text)
+        toolkit.c.menu_html = toolkit.literal(fragments['menu.html'].text)
+        toolkit.c.checkboxes_html = toolkit.literal(
+            fragments['checkboxes.html'].text)
+
+        return toolkit.render('ckanext/taxonomy/show.html')
+
+    def fragment(self, name, fragment):
+        """
+        Serves the JSON tree or one of the rendered trees of a taxonomy
+        straight from the cache, gzipped if the client accepts it.
+        """
+        fragment = self._fragments(name).get(fragment)
+        if fragment is None:
+            base.abort(404, toolkit._('Not found'))
+
+        request = toolkit.request
+        response = toolkit.response
+        response.headers['Content-Type'] = fragment.content_type
+        response.headers['ETag'] = fragment.etag
+        response.headers['Vary'] = 'Accept-Encoding'
+        if request.headers.get('If-None-Match') == fragment.etag:
+            response.status_int = 304
+            return ''
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response.headers['Content-Encoding'] = 'gzip'
+            return fragment.gzipped
+        return fragment.body
+
+    def terms(self, name, format='json'):
+        """
+        Streams every term of a taxonomy, ordered by label as a JSON list,
+        or ordered by id as JSON Lines, reading and encoding them a batch
+        at a time so the response is never held in memory as a whole.
+        """
+        from ckanext.taxonomy import cache, streaming
+
         context = {
             'model': model,
             'user': toolkit.c.user
         }
+        logic.check_access('taxonomy_term_list', context, {'id': name})
 
-        toolkit.c.taxonomy = logic.get_action('taxonomy_show')(
-            context,
-            {'id': name})
+        taxonomy_id = cache.taxonomy_id_for(name)
+        if not taxonomy_id:
+            base.abort(404, toolkit._('Taxonomy not found'))
 
-        toolkit.c.terms = logic.get_action('taxonomy_term_tree')(
-            context,
-            {'id': toolkit.c.taxonomy['id']})
+        response = toolkit.response
+        if format == 'jsonl':
+            response.headers['Content-Type'] = 'application/x-ndjson'
+            return streaming.iter_json_lines(
+                streaming.iter_terms(taxonomy_id, order_by='id'))
+        response.headers['Content-Type'] = 'application/json'
+        return streaming.iter_json_list(streaming.iter_terms(taxonomy_id))
 
-        return toolkit.render('ckanext/taxonomy/show.html')
+    def _fragments(self, name):
+        from ckanext.taxonomy import cache
+        from ckanext.taxonomy.fragments import get_fragments, language
+
+        context = {
+            'model': model,
+            'user': toolkit.c.user
+        }
+        logic.check_access('taxonomy_show', context, {'id': name})
+
+        taxonomy_id = cache.taxonomy_id_for(name)
+        if not taxonomy_id:
+            base.abort(404, toolkit._('Taxonomy not found'))
+
+        lang = language(taxonomy_id, toolkit.request.params.get('lang'),
+                        toolkit.h.lang())
+        return get_fragments(taxonomy_id, lang)
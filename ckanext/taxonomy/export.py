@@ -0,0 +1,207 @@
+"""
+Writes a taxonomy out as SKOS (Turtle or N-Triples) or JSON Lines, and
+reads the JSON Lines back in.
+
+Terms are read in id order through a streaming cursor, together with
+their parent's uri and their other labels, and written out one at a time,
+so exporting never holds the taxonomy in memory. Each term only refers to
+its parent (skos:broader), which `taxonomy load` follows to rebuild the
+hierarchy.
+
+A JSON Lines export starts with a line describing the taxonomy, followed
+by a line for each term, and keeps everything about the terms including
+their extras. SKOS has no place for extras, which can be loaded separately
+with `taxonomy load-extras`.
+"""
+import itertools
+import json
+
+from logging import getLogger
+
+import ckan.logic as logic
+import ckan.model as model
+
+from ckanext.taxonomy import labels
+from ckanext.taxonomy.models import TaxonomyTerm, TaxonomyTermLabel
+
+log = getLogger(__name__)
+
+FORMATS = ('turtle', 'nt', 'jsonl')
+
+SKOS = 'http://www.w3.org/2004/02/skos/core#'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+
+# The label kinds of taxonomy_term_label and the term dict key for each
+_LABEL_KEYS = {labels.PREF: 'labels', labels.ALT: 'alt_labels',
+               labels.HIDDEN: 'hidden_labels'}
+
+
+def iter_export_terms(taxonomy_id, batch_size=1000):
+    """
+    Yields a dictionary for each term in a taxonomy in id order, with its
+    'parent_uri' and lists of its translated 'labels', 'alt_labels' and
+    'hidden_labels' as {'label', 'lang'} dictionaries.
+    """
+    from sqlalchemy import and_, or_, select
+
+    term = TaxonomyTerm.__table__
+    parent = term.alias('parent')
+    label = TaxonomyTermLabel.__table__
+    query = select([term.c.id, term.c.uri, term.c.label, term.c.description,
+                    term.c.extras, parent.c.uri,
+                    label.c.label, label.c.kind, label.c.lang])\
+        .select_from(
+            term.outerjoin(parent, parent.c.id == term.c.parent_id)
+                .outerjoin(label, and_(
+                    label.c.term_id == term.c.id,
+                    # The default label is the term's own
+                    or_(label.c.kind != labels.PREF,
+                        label.c.lang.isnot(None)))))\
+        .where(term.c.taxonomy_id == taxonomy_id)\
+        .order_by(term.c.id, label.c.kind, label.c.lang, label.c.label)
+
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True)\
+            .execute(query)
+        rows = iter(lambda: result.fetchmany(batch_size), [])
+        rows = itertools.chain.from_iterable(rows)
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            id, uri, label_, description, extras, parent_uri = group[0][:6]
+            d = {'id': id, 'uri': uri, 'label': label_,
+                 'description': description, 'extras': extras,
+                 'parent_uri': parent_uri,
+                 'labels': [], 'alt_labels': [], 'hidden_labels': []}
+            for row in group:
+                if row[6] is not None:
+                    d[_LABEL_KEYS[row[7]]].append({'label': row[6],
+                                                   'lang': row[8]})
+            yield d
+    finally:
+        connection.close()
+
+
+def _json_lines(taxonomy, terms):
+    yield json.dumps(dict(taxonomy, type='taxonomy')) + '\n'
+    for term in terms:
+        yield json.dumps(dict(term, type='term')) + '\n'
+
+
+def _triples(taxonomy, terms, lang):
+    """ Yields (subject, predicate, object) tuples of rdflib nodes """
+    from rdflib import Literal, URIRef
+
+    scheme = URIRef(taxonomy['uri'])
+    a = URIRef(RDF_TYPE)
+
+    def skos(name):
+        return URIRef(SKOS + name)
+
+    yield scheme, a, skos('ConceptScheme')
+    yield scheme, skos('prefLabel'), \
+        Literal(taxonomy['title'] or taxonomy['name'], lang=lang)
+    for term in terms:
+        concept = URIRef(term['uri'])
+        yield concept, a, skos('Concept')
+        yield concept, skos('inScheme'), scheme
+        yield concept, skos('prefLabel'), Literal(term['label'], lang=lang)
+        for label in term['labels']:
+            if label['lang'] != lang:
+                yield concept, skos('prefLabel'), \
+                    Literal(label['label'], lang=label['lang'])
+        for key, name in (('alt_labels', 'altLabel'),
+                          ('hidden_labels', 'hiddenLabel')):
+            for label in term[key]:
+                yield concept, skos(name), \
+                    Literal(label['label'], lang=label['lang'])
+        if term['description']:
+            yield concept, skos('definition'), \
+                Literal(term['description'], lang=lang)
+        if term['parent_uri']:
+            yield concept, skos('broader'), URIRef(term['parent_uri'])
+        else:
+            yield concept, skos('topConceptOf'), scheme
+
+
+def _ntriples(triples):
+    for s, p, o in triples:
+        yield u'%s %s %s .\n' % (s.n3(), p.n3(), o.n3())
+
+
+def _turtle(triples):
+    """
+    Writes Turtle a subject at a time, relying on the triples of each
+    subject coming together.
+    """
+    from rdflib import URIRef
+
+    namespaces = [('skos', SKOS)]
+    for prefix, namespace in namespaces:
+        yield u'@prefix %s: <%s> .\n' % (prefix, namespace)
+
+    def name(node):
+        if isinstance(node, URIRef):
+            if node == URIRef(RDF_TYPE):
+                return u'a'
+            for prefix, namespace in namespaces:
+                local = node[len(namespace):]
+                if node.startswith(namespace) and local.isalnum():
+                    return u'%s:%s' % (prefix, local)
+        return node.n3()
+
+    for subject, group in itertools.groupby(triples, key=lambda t: t[0]):
+        lines = [u'    %s %s' % (name(p), name(o)) for _, p, o in group]
+        yield u'\n%s\n%s .\n' % (subject.n3(), u' ;\n'.join(lines))
+
+
+def export(name, output, format='turtle', lang='en'):
+    """
+    Writes the named taxonomy to the `output` file object in the given
+    format. `lang` is the language the default labels are tagged with in
+    SKOS, which should be given to `taxonomy load` to read them back.
+
+    :returns: The number of terms written
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown format %s' % format)
+
+    context = {'model': model, 'ignore_auth': True, 'with_terms': False}
+    taxonomy = logic.get_action('taxonomy_show')(context, {'id': name})
+
+    count = [0]
+
+    def terms():
+        for term in iter_export_terms(taxonomy['id']):
+            count[0] += 1
+            yield term
+
+    if format == 'jsonl':
+        pieces = _json_lines(taxonomy, terms())
+    else:
+        triples = _triples(taxonomy, terms(), lang)
+        pieces = _ntriples(triples) if format == 'nt' else _turtle(triples)
+    for piece in pieces:
+        output.write(piece)
+    return count[0]
+
+
+def load_json_lines(lines, name=None, title=None, uri=None):
+    """
+    Creates a taxonomy from a JSON Lines export, which must not already
+    exist. The name, title and uri default to those in the file.
+    Terms are inserted in bulk as they are read and attached to their
+    parents once they all exist, as a parent may come after its children.
+
+    :returns: The new taxonomy and the number of terms created
+    """
+    from ckanext.taxonomy import importer
+    from ckanext.taxonomy.models import Taxonomy
+
+    header, terms = importer.read_json_lines(lines)
+    name = name or header['name']
+    if Taxonomy.get(name) is not None:
+        raise logic.ValidationError("Name is already in use")
+    return importer.replace_taxonomy(
+        name, title or header.get('title') or name, uri or header['uri'],
+        terms)
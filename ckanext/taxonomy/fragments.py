@@ -0,0 +1,115 @@
+"""
+Pre-rendered parts of the taxonomy show page.
+
+Rendering the term tree of a large taxonomy through recursive macros is
+most of the cost of the show page, so the rendered trees and the JSON tree
+they are built from are cached for each taxonomy version and language,
+both as they are and gzipped. They are rebuilt when the taxonomy or any
+dataset counts change, and otherwise served without going to the database.
+"""
+import gzip
+import io
+import json
+
+import ckan.logic as logic
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache
+
+# The name of each fragment and the snippet it is rendered with
+SNIPPETS = {
+    'tree.html': 'ckanext/taxonomy/snippets/term_tree.html',
+    'menu.html': 'ckanext/taxonomy/snippets/term_menu.html',
+    'checkboxes.html': 'ckanext/taxonomy/snippets/term_checkboxes.html',
+}
+
+
+def compress(body):
+    """ Gzips a body, without a timestamp so the output is repeatable """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class Fragment(object):
+    """ A rendered response body held both as it is and gzipped """
+
+    def __init__(self, body, content_type, etag):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.body = body
+        self.gzipped = compress(body)
+        self.content_type = content_type
+        self.etag = etag
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8')
+
+
+class TreeFragments(object):
+    """ The taxonomy and the rendered fragments of its show page """
+
+    def __init__(self, taxonomy, fragments):
+        self.taxonomy = taxonomy
+        self.fragments = fragments
+
+    def get(self, name):
+        return self.fragments.get(name)
+
+    def __getitem__(self, name):
+        return self.fragments[name]
+
+
+def languages(taxonomy_id):
+    """
+    Returns the languages fragments of a taxonomy may be rendered in: the
+    locales the site offers and those the taxonomy has labels in. Each is
+    cached separately, so no others are allowed.
+    """
+    from ckan.lib.i18n import get_locales
+    return set(get_locales()) | \
+        set(cache.get_snapshot(taxonomy_id).translations)
+
+
+def language(taxonomy_id, requested, default=None):
+    """ Returns the requested language if it is allowed, or the default """
+    if requested and requested in languages(taxonomy_id):
+        return requested
+    return default
+
+
+def get_fragments(taxonomy_id, lang=None):
+    """
+    Returns the TreeFragments of a taxonomy in the given language, one of
+    its `languages`, rendering them if there aren't any for the current
+    versions of the taxonomy and of its dataset counts.
+    """
+    stamp = cache.counts_version(taxonomy_id)
+
+    def build():
+        return render(taxonomy_id, lang, stamp)
+
+    name = 'fragments:%s' % lang if lang else 'fragments'
+    return cache.get_derived(taxonomy_id, name, build, stamp)
+
+
+def render(taxonomy_id, lang=None, stamp=None):
+    context = {'model': model, 'ignore_auth': True, 'with_terms': False}
+    taxonomy = logic.get_action('taxonomy_show')(context,
+                                                 {'id': taxonomy_id})
+    terms = logic.get_action('taxonomy_term_tree')(
+        context, {'id': taxonomy_id, 'include_counts': True, 'lang': lang})
+
+    etag = '"%s-%d-%s-%s"' % (taxonomy_id, cache.version(taxonomy_id),
+                              stamp, lang or '')
+    fragments = {
+        'tree.json': Fragment(json.dumps(terms), 'application/json', etag),
+    }
+    for name, snippet in SNIPPETS.items():
+        html = toolkit.render_snippet(snippet, {'taxonomy': taxonomy,
+                                                'terms': terms})
+        fragments[name] = Fragment(html, 'text/html; charset=utf-8', etag)
+    return TreeFragments(taxonomy, fragments)
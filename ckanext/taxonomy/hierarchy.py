@@ -0,0 +1,84 @@
+"""
+Moves terms, along with everything beneath them, within a taxonomy's
+hierarchy, keeping the counts derived from it up to date for the moved
+branch only.
+
+A term can't be moved beneath itself or any of the terms beneath it.
+Rather than reading the whole taxonomy to check, the new parent's
+ancestors are followed up to the top, one query per level. On PostgreSQL
+they are locked as they are read, so that two moves made at once can't
+make a cycle between them: one waits for the other to commit, or fails on
+the deadlock.
+"""
+import ckan.model as model
+
+from ckanext.taxonomy import usage
+from ckanext.taxonomy.models import TaxonomyTerm
+
+
+class CycleError(Exception):
+    """ Raised when a move would put a term beneath itself """
+    pass
+
+
+def ancestors(term_id, lock=False):
+    """
+    Returns the ids of the term and of each term above it, nearest first,
+    locking their rows for the rest of the transaction if `lock` is True.
+
+    :raises CycleError: If the hierarchy above the term already loops
+    """
+    res = []
+    seen = set()
+    while term_id is not None:
+        if term_id in seen:
+            raise CycleError('The terms above %s form a cycle' % term_id)
+        seen.add(term_id)
+        res.append(term_id)
+        q = model.Session.query(TaxonomyTerm.parent_id)\
+            .filter(TaxonomyTerm.id == term_id)
+        if lock:
+            q = q.with_for_update()
+        term_id = q.scalar()
+    return res
+
+
+def descendants(term_id):
+    """ Returns the ids of every term beneath a term, a level at a time """
+    res = set()
+    level = [term_id]
+    while level:
+        children = []
+        for i in range(0, len(level), 500):
+            children.extend(id for id, in model.Session.query(
+                TaxonomyTerm.id)
+                .filter(TaxonomyTerm.parent_id.in_(level[i:i + 500])))
+        level = [id for id in children if id not in res]
+        res.update(level)
+    return res
+
+
+def move_term(term, parent_id):
+    """
+    Moves a term and the branch beneath it to a new parent, or to the top
+    of its taxonomy if `parent_id` is None, and adjusts the rollup counts
+    of the ancestors it leaves and joins. The caller is responsible for
+    checking the parent is in the same taxonomy, and for committing.
+
+    :returns: The ids of the terms in the branch, or an empty set if the
+        term was already there
+    :raises CycleError: If the new parent is the term or beneath it
+    """
+    if parent_id == term.parent_id:
+        return set()
+
+    joined = ancestors(parent_id, lock=True) if parent_id else []
+    if term.id in joined:
+        raise CycleError('A term cannot be moved beneath itself')
+    left = ancestors(term.parent_id) if term.parent_id else []
+
+    branch = descendants(term.id)
+    branch.add(term.id)
+    usage.move_branch(branch, left, joined)
+    term.parent_id = parent_id
+    return branch
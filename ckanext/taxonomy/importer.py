@@ -0,0 +1,493 @@
+"""
+Imports a taxonomy from a SKOS document or a JSON Lines export, replacing
+any taxonomy of the same name.
+
+Imports run either in the `taxonomy load` command's own process or as a
+background job started with the taxonomy_import_start action. Either way
+the terms and their labels are written with bulk inserts a batch at a time
+rather than through taxonomy_term_create, and the old terms are replaced
+in the same transaction, so readers see the old taxonomy until the new one
+is complete.
+
+A job reports its progress in its metadata, which taxonomy_import_status
+reads: the phase it has reached (queued, parsing, waiting for the
+taxonomy's lock, deleting, inserting, linking, refreshing, then finished
+or failed), the number of terms and labels written so far and any errors.
+"""
+import contextlib
+import time
+
+from logging import getLogger
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache, changes, jobs, labels, locks, usage
+from ckanext.taxonomy.models import Taxonomy, TaxonomyTerm, \
+    TaxonomyTermCount, TaxonomyTermLabel, TaxonomyTermPackage, make_uuid
+
+log = getLogger(__name__)
+
+FORMATS = ('skos', 'jsonl')
+
+# The most errors kept in a job's metadata
+MAX_ERRORS = 100
+
+
+def guess_format(source):
+    return 'jsonl' if source.split('?')[0].endswith('.jsonl') else 'skos'
+
+
+def _is_url(source):
+    return source.split(':', 1)[0] in ('http', 'https')
+
+
+def read_skos(source, lang='en'):
+    """
+    Parses a SKOS document from a path or url, and returns its terms in
+    an iterator, each after its parent.
+    """
+    import rdflib
+    import skos
+    from rdflib.namespace import SKOS
+
+    graph = rdflib.Graph()
+    graph.parse(source)
+    loader = skos.RDFLoader(graph, max_depth=float('inf'), flat=True,
+                            lang=lang)
+    concepts = loader.getConcepts()
+
+    def node_labels(node, predicate):
+        return [{'label': str(o), 'lang': getattr(o, 'language', None)}
+                for o in graph.objects(rdflib.URIRef(node.uri), predicate)]
+
+    top_level = [c for c in concepts.values() if not c.broader]
+    top_level.sort(key=lambda c: c.prefLabel)
+
+    def walk(node, parent_uri):
+        yield {
+            'uri': node.uri,
+            'label': node.prefLabel,
+            'description': getattr(node, 'definition', None) or '',
+            'parent_uri': parent_uri,
+            'labels': node_labels(node, SKOS.prefLabel),
+            'alt_labels': node_labels(node, SKOS.altLabel),
+            'hidden_labels': node_labels(node, SKOS.hiddenLabel),
+        }
+        for child in node.narrower.values():
+            for term in walk(child, node.uri):
+                yield term
+
+    def terms():
+        for node in top_level:
+            for term in walk(node, None):
+                yield term
+
+    return terms()
+
+
+def read_json_lines(lines):
+    """
+    Returns the taxonomy described by the first line of a JSON Lines
+    export, and an iterator over the terms on the lines after it.
+    """
+    import json
+
+    lines = (json.loads(line) for line in lines if line.strip())
+    header = next(lines, None)
+    if not header or header.get('type') != 'taxonomy':
+        raise ValueError('The file does not start with a taxonomy')
+    return header, lines
+
+
+@contextlib.contextmanager
+def _open_lines(source):
+    """
+    Opens a path or url for reading line by line, closing it at the end
+    of the block. A server which stops answering for longer than
+    ckanext.taxonomy.import.timeout seconds (default 60) fails the import.
+    """
+    if _is_url(source):
+        import requests
+        timeout = float(toolkit.config.get(
+            'ckanext.taxonomy.import.timeout', 60))
+        response = requests.get(source, stream=True, timeout=timeout)
+        try:
+            response.raise_for_status()
+            yield response.iter_lines(decode_unicode=True)
+        finally:
+            response.close()
+    else:
+        with open(source) as lines:
+            yield lines
+
+
+def _replace_terms(taxonomy_id):
+    """
+    Deletes the terms of a taxonomy along with their labels and usage
+    records, without committing.
+
+    :returns: The ids of the datasets which used any of them
+    """
+    session = model.Session
+    term_ids = session.query(TaxonomyTerm.id)\
+        .filter(TaxonomyTerm.taxonomy_id == taxonomy_id)
+    package_ids = set(id for id, in session.query(
+        TaxonomyTermPackage.package_id)
+        .filter(TaxonomyTermPackage.term_id.in_(term_ids.subquery()))
+        .distinct())
+
+    for table in (TaxonomyTermPackage, TaxonomyTermCount):
+        session.query(table)\
+            .filter(table.term_id.in_(term_ids.subquery()))\
+            .delete(synchronize_session=False)
+    session.query(TaxonomyTermLabel)\
+        .filter(TaxonomyTermLabel.taxonomy_id == taxonomy_id)\
+        .delete(synchronize_session=False)
+    session.query(TaxonomyTerm)\
+        .filter(TaxonomyTerm.taxonomy_id == taxonomy_id)\
+        .delete(synchronize_session=False)
+    return package_ids
+
+
+def _term_dicts(taxonomy_id):
+    """
+    Returns the term dicts of a taxonomy keyed by id, read without loading
+    the terms into the session, which would hold on to them past a
+    `_replace_terms`.
+    """
+    columns = ('id', 'label', 'description', 'uri', 'extras', 'taxonomy_id',
+               'parent_id')
+    rows = model.Session.query(*[getattr(TaxonomyTerm, c) for c in columns])\
+        .filter(TaxonomyTerm.taxonomy_id == taxonomy_id)
+    return dict((row[0], dict(zip(columns, row))) for row in rows)
+
+
+def insert_terms(taxonomy_id, terms, lang=None, batch_size=None,
+                 progress=None, errors=None, reuse=None):
+    """
+    Inserts terms, given as dictionaries with the keys of an export, in
+    batches of ckanext.taxonomy.import.batch_size (default 1000). Terms
+    are linked to a parent given by 'parent_uri' once every term has been
+    inserted, unless the parent came before them. The caller is
+    responsible for committing.
+
+    Terms whose uri is a key of `reuse` keep the id it gives, so that a
+    replaced term keeps its id.
+
+    :returns: The number of terms inserted
+    """
+    if batch_size is None:
+        batch_size = toolkit.asint(toolkit.config.get(
+            'ckanext.taxonomy.import.batch_size', 1000))
+    progress = progress or (lambda phase, **counts: None)
+    errors = errors if errors is not None else []
+    reuse = reuse or {}
+    session = model.Session
+
+    ids = {}
+    unlinked = []
+    term_rows = []
+    label_rows = []
+    counts = {'terms': 0, 'labels': 0}
+
+    def flush():
+        if term_rows:
+            session.execute(TaxonomyTerm.__table__.insert(), term_rows)
+        if label_rows:
+            session.execute(TaxonomyTermLabel.__table__.insert(), label_rows)
+        counts['terms'] += len(term_rows)
+        counts['labels'] += len(label_rows)
+        del term_rows[:]
+        del label_rows[:]
+        progress('inserting', **counts)
+
+    for term in terms:
+        if not term.get('uri') or not term.get('label'):
+            errors.append('Skipped a term without a uri or label: %s'
+                          % (term.get('uri') or term.get('label')))
+            continue
+        if term['uri'] in ids:
+            errors.append('Skipped a second term with the uri %s'
+                          % term['uri'])
+            continue
+        id = reuse.get(term['uri']) or make_uuid()
+        ids[term['uri']] = id
+        parent_uri = term.get('parent_uri')
+        if parent_uri and parent_uri not in ids:
+            unlinked.append((id, parent_uri))
+        term_rows.append({
+            'id': id,
+            'taxonomy_id': taxonomy_id,
+            'uri': term['uri'],
+            'label': term['label'],
+            'description': term.get('description'),
+            'extras': term.get('extras'),
+            'parent_id': ids.get(parent_uri) if parent_uri else None,
+        })
+        label_rows.extend(labels.new_term_labels(
+            id, taxonomy_id, term['label'],
+            alt_labels=term.get('alt_labels'),
+            hidden_labels=term.get('hidden_labels'),
+            translations=term.get('labels'), lang=lang))
+        if len(term_rows) >= batch_size:
+            flush()
+    flush()
+
+    progress('linking', **counts)
+    links = []
+    for id, parent_uri in unlinked:
+        if parent_uri in ids:
+            links.append({'term_id': id, 'new_parent_id': ids[parent_uri]})
+        else:
+            errors.append('The parent %s of a term was not found'
+                          % parent_uri)
+    if links:
+        from sqlalchemy import bindparam
+        table = TaxonomyTerm.__table__
+        session.execute(table.update()
+                        .where(table.c.id == bindparam('term_id'))
+                        .values(parent_id=bindparam('new_parent_id')), links)
+    return counts['terms']
+
+
+def import_taxonomy(source, name, title=None, uri=None, lang='en',
+                    format=None, progress=None, errors=None,
+                    lock_policy=None, lock_timeout=None):
+    """
+    Imports a taxonomy from a path or url, replacing the terms of any
+    existing taxonomy with the same name. The title and uri of a JSON
+    Lines export default to its own.
+
+    `progress` is called with the phase reached and the counts so far,
+    and any terms which could not be imported are described in `errors`.
+    The taxonomy is locked while it is written, see `locks`.
+
+    :returns: The taxonomy and the number of terms imported
+    :raises locks.TaxonomyLocked: If another import holds the lock
+    """
+    progress = progress or _log_progress
+    format = format or guess_format(source)
+    if format not in FORMATS:
+        raise ValueError('Unknown format %s' % format)
+
+    if format == 'jsonl':
+        # The terms are read from the source as they are inserted
+        with _open_lines(source) as lines:
+            header, terms = read_json_lines(lines)
+            title = title or header.get('title')
+            uri = uri or header.get('uri')
+            # Every label in an export other than the default has a
+            # language
+            return replace_taxonomy(name, title, uri, terms, None, progress,
+                                    errors, lock_policy, lock_timeout)
+
+    progress('parsing')
+    terms = read_skos(source, lang)
+    return replace_taxonomy(name, title, uri, terms, lang, progress, errors,
+                            lock_policy, lock_timeout)
+
+
+def replace_taxonomy(name, title, uri, terms, lang=None, progress=None,
+                     errors=None, lock_policy=None, lock_timeout=None):
+    """
+    Creates the named taxonomy with the given terms, or replaces the
+    terms of the existing one, in a single transaction while holding the
+    taxonomy's lock.
+
+    :returns: The taxonomy and the number of terms imported
+    """
+    progress = progress or _log_progress
+    if not uri:
+        raise ValueError('A uri is required for the taxonomy')
+
+    progress('waiting')
+    with locks.taxonomy_lock(name, lock_policy, lock_timeout):
+        return _replace_taxonomy(name, title, uri, terms, lang, progress,
+                                 errors)
+
+
+def _replace_taxonomy(name, title, uri, terms, lang, progress, errors):
+    try:
+        progress('deleting')
+        taxonomy = Taxonomy.get(name)
+        created = taxonomy is None
+        package_ids = set()
+        before = {}
+        if created:
+            taxonomy = Taxonomy(name=name, title=title or name, uri=uri)
+            model.Session.add(taxonomy)
+            model.Session.flush()
+        else:
+            before = _term_dicts(taxonomy.id)
+            package_ids = _replace_terms(taxonomy.id)
+            taxonomy.title = title or taxonomy.title
+            taxonomy.uri = uri
+
+        # Terms which are still there keep their ids, so the change log
+        # only records what the import actually changed
+        reuse = dict((term['uri'], id) for id, term in before.items()
+                     if term['uri'])
+        count = insert_terms(taxonomy.id, terms, lang, progress=progress,
+                             errors=errors, reuse=reuse)
+
+        # The usage records were deleted with the old terms, so record them
+        # again for the datasets which used them and for any using the
+        # terms which are new. The cached copy of the taxonomy is of the
+        # old terms, so the new ones are read from this transaction.
+        snapshot = cache.build_snapshot(taxonomy.id)
+        old_uris = set(term['uri'] for term in before.values())
+        package_ids.update(usage.packages_using_uris(
+            set(snapshot.uris) - old_uris))
+        if package_ids:
+            progress('refreshing', packages=len(package_ids))
+            usage.refresh_packages(package_ids, replacing=snapshot)
+
+        # Recording the changes locks the change log until the commit, so
+        # this is done last
+        changes.record_many(changes.changes_between(
+            taxonomy.id, before, _term_dicts(taxonomy.id)))
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    cache.invalidate(None if created else taxonomy.id)
+    if package_ids:
+        jobs.enqueue_reindex(package_ids=package_ids)
+        log.info('Queued reindex of %d datasets', len(package_ids))
+    return taxonomy.as_dict(), count
+
+
+def _log_progress(phase, **counts):
+    log.info('%s %s', phase.capitalize(),
+             ', '.join('%d %s' % (v, k) for k, v in sorted(counts.items())))
+
+
+class JobQueue(object):
+    """ Runs imports on CKAN's background job queue """
+
+    def enqueue(self, fn, kwargs, title):
+        """ Queues a call of `fn` and returns its job id """
+        return toolkit.enqueue_job(fn, kwargs=kwargs, title=title).id
+
+    def current_job(self):
+        """ Returns the job being run by the calling worker, or None """
+        from rq import get_current_job
+        return get_current_job()
+
+    def fetch(self, job_id):
+        """
+        Returns a job, with its `meta`, `save_meta()` and `get_status()`,
+        or None if there is no such job.
+        """
+        from ckan.lib.jobs import job_from_id
+        try:
+            return job_from_id(job_id)
+        except KeyError:
+            return None
+
+
+_queue = [JobQueue()]
+
+
+def get_queue():
+    return _queue[0]
+
+
+def set_queue(queue):
+    """ Replaces the queue imports are run on, which is useful in tests """
+    _queue[0] = queue
+
+
+def start(source, name, title=None, uri=None, lang='en', format=None):
+    """ Queues an import and returns the id of its job """
+    return get_queue().enqueue(
+        import_job,
+        {'source': source, 'name': name, 'title': title, 'uri': uri,
+         'lang': lang, 'format': format},
+        'Import taxonomy %s' % name)
+
+
+def import_job(source, name, title=None, uri=None, lang='en', format=None):
+    """ Runs an import queued by `start`, recording its progress """
+    job = get_queue().current_job()
+    meta = job.meta if job is not None else {}
+    meta.update({'phase': 'parsing', 'terms': 0, 'labels': 0, 'errors': [],
+                 'name': name, 'started': time.time(), 'finished': None})
+
+    def save():
+        if len(meta['errors']) > MAX_ERRORS:
+            meta['errors'][MAX_ERRORS:] = []
+        meta['updated'] = time.time()
+        if job is not None:
+            job.save_meta()
+
+    def progress(phase, **counts):
+        if phase != meta['phase']:
+            _log_progress(phase, **counts)
+        if phase == 'inserting' and 'inserting' not in meta:
+            meta['inserting'] = time.time()
+        meta['phase'] = phase
+        meta.update(counts)
+        save()
+
+    save()
+    try:
+        taxonomy, count = import_taxonomy(source, name, title, uri, lang,
+                                          format, progress, meta['errors'])
+    except Exception as e:
+        log.exception('Could not import taxonomy %s', name)
+        meta['errors'].append(str(e))
+        meta['phase'] = 'failed'
+        meta['finished'] = time.time()
+        save()
+        raise
+    finally:
+        model.Session.remove()
+
+    meta['phase'] = 'finished'
+    meta['finished'] = time.time()
+    meta['taxonomy_id'] = taxonomy['id']
+    save()
+    return count
+
+
+def status(job_id):
+    """
+    Returns the progress of an import job, or None if there is no such
+    job.
+    """
+    job = get_queue().fetch(job_id)
+    if job is None:
+        return None
+    meta = job.meta
+    phase = meta.get('phase', 'queued')
+
+    per_second = None
+    if meta.get('inserting') and meta.get('terms'):
+        elapsed = (meta.get('finished') or meta['updated']) - \
+            meta['inserting']
+        if elapsed > 0:
+            per_second = round(meta['terms'] / elapsed, 1)
+
+    def timestamp(value):
+        if value is None:
+            return None
+        import datetime
+        return datetime.datetime.utcfromtimestamp(value).isoformat()
+
+    return {
+        'id': job_id,
+        'status': getattr(job.get_status(), 'value', job.get_status()),
+        'name': meta.get('name'),
+        'taxonomy_id': meta.get('taxonomy_id'),
+        'phase': phase,
+        'terms': meta.get('terms', 0),
+        'labels': meta.get('labels', 0),
+        'packages': meta.get('packages', 0),
+        'terms_per_second': per_second,
+        'started': timestamp(meta.get('started')),
+        'finished': timestamp(meta.get('finished')),
+        'errors': list(meta.get('errors', [])),
+    }
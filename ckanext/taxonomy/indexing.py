@@ -0,0 +1,85 @@
+"""
+Adds taxonomy information to the search index documents of datasets.
+
+Every term assigned to a dataset is indexed along with all of the terms
+above it, so that filtering or faceting on any level of a taxonomy is a
+single term lookup in Solr rather than an expansion of the subtree.
+"""
+import json
+
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache
+
+# Both fields match CKAN's multivalued vocab_* dynamic field, so they
+# work with the standard Solr schema.
+URIS_FIELD = 'vocab_taxonomy_uris'
+LABELS_FIELD = 'vocab_taxonomy_labels'
+
+
+def package_fields():
+    """
+    Returns the names of the dataset fields which hold taxonomy term uris,
+    from the ckanext.taxonomy.package_fields config option.
+    """
+    return toolkit.aslist(
+        toolkit.config.get('ckanext.taxonomy.package_fields', 'theme'))
+
+
+def parse_term_uris(value):
+    """
+    Returns the list of term uris stored in a dataset field, which may be
+    a single uri, a list of uris or a JSON encoded list of uris.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return [value]
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if v and isinstance(v, str)]
+    return []
+
+
+def package_term_uris(pkg_dict):
+    """
+    Gathers the term uris from the configured fields of a dataset dict.
+    This understands both the dict passed to the IPackageController hooks
+    and the flattened 'extras_*' form used when indexing.
+    """
+    extras = dict((e.get('key'), e.get('value'))
+                  for e in pkg_dict.get('extras') or []
+                  if isinstance(e, dict))
+
+    uris = []
+    for field in package_fields():
+        for value in (pkg_dict.get(field),
+                      pkg_dict.get('extras_' + field),
+                      extras.get(field)):
+            for uri in parse_term_uris(value):
+                if uri not in uris:
+                    uris.append(uri)
+    return uris
+
+
+def index_package(pkg_dict):
+    """
+    Adds the uri and label of each of the dataset's terms, and of all of
+    their ancestors, to the dataset's search index document.
+    """
+    uris = []
+    labels = []
+    for snapshot, i in cache.find_terms(package_term_uris(pkg_dict)):
+        for j in [i] + snapshot.ancestors(i):
+            if snapshot.uris[j] not in uris:
+                uris.append(snapshot.uris[j])
+                labels.append(snapshot.labels[j])
+
+    if uris:
+        pkg_dict[URIS_FIELD] = uris
+        pkg_dict[LABELS_FIELD] = labels
+    return pkg_dict
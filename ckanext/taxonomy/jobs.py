@@ -0,0 +1,94 @@
+"""
+Background jobs, run by the CKAN job worker (`ckan jobs worker`).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache, usage
+
+log = getLogger(__name__)
+
+
+def enqueue_reindex(term_ids=None, package_ids=None):
+    """
+    Queues a job to reindex the datasets affected by a change to the given
+    terms, along with any datasets listed in `package_ids`. Use the latter
+    when the terms are being deleted, as by the time the job runs there
+    will be no record of which datasets used them.
+    """
+    if not term_ids and not package_ids:
+        return None
+    return toolkit.enqueue_job(
+        reindex_terms,
+        kwargs={'term_ids': list(term_ids or []),
+                'package_ids': list(package_ids or [])},
+        title='Reindex datasets after a taxonomy change')
+
+
+def affected_packages(term_ids):
+    """
+    Returns the ids of the datasets using any of the given terms or any of
+    the terms beneath them.
+    """
+    subtree = set()
+    for snapshot in cache.get_snapshots():
+        for term_id in term_ids:
+            i = snapshot.by_id.get(term_id)
+            if i is not None:
+                subtree.add(term_id)
+                subtree.update(snapshot.ids[j]
+                               for j in snapshot.descendants(i))
+    return usage.packages_for_terms(subtree)
+
+
+def reindex_terms(term_ids=None, package_ids=None):
+    """
+    Reindexes the datasets affected by a change to the given terms, in
+    batches of ckanext.taxonomy.reindex.batch_size (default 100) with at
+    most ckanext.taxonomy.reindex.workers (default 2) batches in flight.
+    """
+    # The worker process may have missed the invalidations made by the web
+    # process, so start from a fresh copy of the taxonomies.
+    cache.clear()
+
+    package_ids = sorted(set(package_ids or []) |
+                         affected_packages(term_ids or []))
+    batch_size = toolkit.asint(
+        toolkit.config.get('ckanext.taxonomy.reindex.batch_size', 100))
+    workers = toolkit.asint(
+        toolkit.config.get('ckanext.taxonomy.reindex.workers', 2))
+
+    batches = [package_ids[i:i + batch_size]
+               for i in range(0, len(package_ids), batch_size)]
+    done = 0
+    _report_progress(done, len(package_ids))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for count in pool.map(_reindex_batch, batches):
+            done += count
+            _report_progress(done, len(package_ids))
+
+    from ckan.lib import search
+    search.commit()
+    return done
+
+
+def _reindex_batch(package_ids):
+    from ckan.lib import search
+    try:
+        search.rebuild(package_ids=package_ids, defer_commit=True)
+    finally:
+        model.Session.remove()
+    return len(package_ids)
+
+
+def _report_progress(done, total):
+    log.info('Reindexed %d of %d datasets', done, total)
+
+    from rq import get_current_job
+    job = get_current_job()
+    if job is not None:
+        job.meta['progress'] = {'done': done, 'total': total}
+        job.save_meta()
@@ -0,0 +1,167 @@
+"""
+Maintains the taxonomy_term_label table of the labels each term is known
+by: its translations and its synonyms.
+"""
+import unicodedata
+
+import ckan.model as model
+
+from ckanext.taxonomy.models import TaxonomyTermLabel, make_uuid
+
+PREF = u'pref'
+ALT = u'alt'
+HIDDEN = u'hidden'
+
+
+def normalise(label):
+    """
+    Folds a label for matching: accents are stripped, case is folded and
+    runs of whitespace become a single space.
+    """
+    if not label:
+        return u''
+    label = unicodedata.normalize('NFKD', label)
+    label = u''.join(c for c in label if not unicodedata.combining(c))
+    return u' '.join(label.casefold().split())
+
+
+def _as_labels(values, lang=None):
+    """
+    Accepts labels as either strings or dictionaries with 'label' and
+    'lang' (or 'language') keys and returns a list of (label, lang) tuples.
+    """
+    res = []
+    for value in values or []:
+        if isinstance(value, dict):
+            if value.get('label'):
+                res.append((value['label'],
+                            value.get('lang', value.get('language', lang))))
+        elif value:
+            res.append((value, lang))
+    return res
+
+
+def set_term_labels(term, alt_labels=None, hidden_labels=None,
+                    translations=None, lang=None):
+    """
+    Stores the labels of a term. The term's own label is stored as the
+    preferred label with no language, and always replaces the one stored.
+    Its translations (preferred labels in other languages) and synonyms
+    are only replaced when a list of them is given. `lang` is the language
+    of any labels given as plain strings. The caller is responsible for
+    committing.
+    """
+    session = model.Session
+    q = session.query(TaxonomyTermLabel)\
+        .filter(TaxonomyTermLabel.term_id == term.id)
+
+    kinds = {}
+    if alt_labels is not None:
+        kinds[ALT] = _as_labels(alt_labels, lang)
+    if hidden_labels is not None:
+        kinds[HIDDEN] = _as_labels(hidden_labels, lang)
+    if kinds:
+        q.filter(TaxonomyTermLabel.kind.in_(list(kinds.keys())))\
+            .delete(synchronize_session=False)
+
+    if translations is not None:
+        q.filter(TaxonomyTermLabel.kind == PREF)\
+            .delete(synchronize_session=False)
+        kinds[PREF] = [(label, label_lang) for label, label_lang
+                       in _as_labels(translations, lang)
+                       if label_lang and label_lang != lang]
+    else:
+        default = TaxonomyTermLabel.lang.is_(None)
+        if lang:
+            default = default | (TaxonomyTermLabel.lang == lang)
+        q.filter(TaxonomyTermLabel.kind == PREF).filter(default)\
+            .delete(synchronize_session=False)
+        kinds[PREF] = []
+    kinds[PREF].append((term.label, None))
+
+    for kind, values in kinds.items():
+        for label, label_lang in values:
+            session.add(TaxonomyTermLabel(term_id=term.id,
+                                          taxonomy_id=term.taxonomy_id,
+                                          label=label,
+                                          normalised=normalise(label),
+                                          kind=kind,
+                                          lang=label_lang))
+
+
+def new_term_labels(term_id, taxonomy_id, label, alt_labels=None,
+                    hidden_labels=None, translations=None, lang=None):
+    """
+    Returns the rows of taxonomy_term_label for a term being created,
+    as set_term_labels would store them, for inserting many at once.
+    """
+    values = [(PREF, label, None)]
+    values.extend((PREF, translation, label_lang) for translation, label_lang
+                  in _as_labels(translations, lang)
+                  if label_lang and label_lang != lang)
+    values.extend((ALT, alt, alt_lang)
+                  for alt, alt_lang in _as_labels(alt_labels, lang))
+    values.extend((HIDDEN, hidden, hidden_lang)
+                  for hidden, hidden_lang in _as_labels(hidden_labels, lang))
+    return [{'id': make_uuid(), 'term_id': term_id,
+             'taxonomy_id': taxonomy_id, 'label': value,
+             'normalised': normalise(value), 'kind': kind, 'lang': value_lang}
+            for kind, value, value_lang in values]
+
+
+def label_entries(snapshot, lang=None):
+    """
+    Returns a (label, position) pair for every label of every term in a
+    taxonomy snapshot: its own label, its translations and its synonyms.
+    Given a language, only labels in that language or with no language
+    are included, with translations taking the place of the term's label.
+    """
+    if lang:
+        entries = [(snapshot.label(i, lang), i) for i in range(len(snapshot))]
+    else:
+        entries = list(zip(snapshot.labels, range(len(snapshot))))
+        for translations in snapshot.translations.values():
+            entries.extend((label, i) for i, label in translations.items())
+
+    synonyms = model.Session.query(TaxonomyTermLabel.term_id,
+                                   TaxonomyTermLabel.label,
+                                   TaxonomyTermLabel.lang)\
+        .filter(TaxonomyTermLabel.taxonomy_id == snapshot.taxonomy_id)\
+        .filter(TaxonomyTermLabel.kind != PREF)
+    for term_id, label, label_lang in synonyms:
+        if lang and label_lang and label_lang.split('-')[0] != \
+                lang.split('-')[0]:
+            continue
+        i = snapshot.by_id.get(term_id)
+        if i is not None:
+            entries.append((label, i))
+    return entries
+
+
+def remove_terms(term_ids):
+    """ Removes the labels of terms which are being deleted """
+    if not term_ids:
+        return
+    model.Session.query(TaxonomyTermLabel)\
+        .filter(TaxonomyTermLabel.term_id.in_(list(term_ids)))\
+        .delete(synchronize_session=False)
+
+
+def rebuild(taxonomy_id=None):
+    """
+    Rewrites the preferred label of every term, or of every term in one
+    taxonomy, leaving any synonyms in place. This fills in the labels of
+    terms created before the table existed.
+
+    :returns: The number of terms processed
+    """
+    from ckanext.taxonomy.models import TaxonomyTerm
+
+    q = model.Session.query(TaxonomyTerm)
+    if taxonomy_id:
+        q = q.filter(TaxonomyTerm.taxonomy_id == taxonomy_id)
+    terms = q.all()
+    for term in terms:
+        set_term_labels(term)
+    model.Session.commit()
+    return len(terms)
@@ -4,6 +4,9 @@ import ckan.model as model
 import ckan.logic as logic
 from ckan.plugins import toolkit as tk
 
+from ckanext.taxonomy.labels import PREF
+from ckanext.taxonomy.locks import taxonomy_lock
+
 
 def load_term_extras(filepath, taxonomy_name):
     '''
@@ -26,16 +29,17 @@ def load_term_extras(filepath, taxonomy_name):
     the 'label' of the taxonomy term, the keys 'description' and
     'stored_as' are also removed from the object before storing it in the
     JSON extras field.
+
+    The taxonomy is locked while its terms are updated, see `locks`.
     '''
     with open(filepath) as input_file:
         extras_list = json.loads(input_file.read())
 
-        context = {'model': model, 'ignore_auth': True}
+    context = {'model': model, 'ignore_auth': True}
 
-        data = {'name': taxonomy_name}
-        taxonomy_terms = logic.get_action('taxonomy_term_list')(context, data)
-        taxonomy_term_lookup = dict([(term['label'], term)
-                                     for term in taxonomy_terms])
+    with taxonomy_lock(taxonomy_name):
+        taxonomy_term_lookup = _lookup_terms(
+            context, taxonomy_name, [extras['title'] for extras in extras_list])
 
         for extras in extras_list:
             term_name = extras['title']
@@ -49,6 +53,27 @@ def load_term_extras(filepath, taxonomy_name):
             logic.get_action('taxonomy_term_update')(context, term)
 
 
+def _lookup_terms(context, taxonomy_name, term_labels):
+    '''
+    Returns a dictionary of the terms in the taxonomy which have one of the
+    given labels as their own label, keyed by label. Synonyms and
+    translations don't count, so a title which is only another term's
+    synonym makes a term of its own.
+    '''
+    if not term_labels:
+        return {}
+    matches = logic.get_action('taxonomy_term_lookup')(
+        context, {'name': taxonomy_name, 'labels': term_labels,
+                  'match': 'exact'})
+    res = {}
+    for label, terms in matches.items():
+        terms = [t for t in terms
+                 if t['label_kind'] == PREF and t['label'] == label]
+        if terms:
+            res[label] = terms[0]
+    return res
+
+
 def load_terms_and_extras(filepath, taxonomy_name, taxonomy_title=None):
     '''
     Load terms and extras from file as a taxonomy. This can be used by tests
@@ -70,6 +95,11 @@ def load_terms_and_extras(filepath, taxonomy_name, taxonomy_title=None):
     This file format has been adopted from the themes.json file used in
     data.gov.uk.
     '''
+    with taxonomy_lock(taxonomy_name):
+        _load_terms_and_extras(filepath, taxonomy_name, taxonomy_title)
+
+
+def _load_terms_and_extras(filepath, taxonomy_name, taxonomy_title):
     context = {'model': model, 'ignore_auth': True}
     try:
         taxonomy = tk.get_action('taxonomy_show')(context,
@@ -82,9 +112,8 @@ def load_terms_and_extras(filepath, taxonomy_name, taxonomy_title=None):
     with open(filepath) as input_file:
         term_list = json.loads(input_file.read())
 
-    existing_terms = logic.get_action('taxonomy_term_list')(context, {'name': taxonomy_name})
-    existing_term_lookup = dict([(term['label'], term)
-                                 for term in existing_terms])
+    existing_term_lookup = _lookup_terms(
+        context, taxonomy_name, [term['title'] for term in term_list])
 
     for term_from_file in term_list:
         term_name = term_from_file['title']
@@ -100,5 +129,5 @@ def load_terms_and_extras(filepath, taxonomy_name, taxonomy_title=None):
             term['id'] = existing_term_lookup[term_name]['id']
             logic.get_action('taxonomy_term_update')(context, term)
         else:
-            logic.get_action('taxonomy_term_create')(context, term)
-        existing_terms = logic.get_action('taxonomy_term_list')(context, {'name': taxonomy_name})
+            existing_term_lookup[term_name] = \
+                logic.get_action('taxonomy_term_create')(context, term)
@@ -0,0 +1,154 @@
+"""
+A lock per taxonomy, so that only one import or sync writes a taxonomy's
+terms at a time.
+
+On PostgreSQL this is a session level advisory lock, taken on a connection
+of its own so that it is held however many transactions the work commits,
+and released if the process dies. That connection runs in autocommit mode,
+so it holds no transaction open while the lock is held. On other
+databases, such as SQLite in development, it is an exclusive lock on a
+file in ckanext.taxonomy.lock.directory (the system's temporary directory
+by default), which only holds between processes on one host.
+
+What happens when a taxonomy is already locked is decided by
+ckanext.taxonomy.lock.policy: 'wait' (the default) waits for up to
+ckanext.taxonomy.lock.timeout seconds (600 by default), and 'fail' gives up
+straight away. Either way TaxonomyLocked is raised if the lock can't be
+taken. Readers never take the lock.
+"""
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+POLICIES = ('wait', 'fail')
+
+# How often, in seconds, a waiting process tries the lock again
+POLL_INTERVAL = 0.5
+
+
+class TaxonomyLocked(Exception):
+    """ Raised when another process holds a taxonomy's lock """
+    pass
+
+
+def _config():
+    from ckan.plugins import toolkit
+    policy = toolkit.config.get('ckanext.taxonomy.lock.policy', 'wait')
+    timeout = float(toolkit.config.get('ckanext.taxonomy.lock.timeout', 600))
+    return policy, timeout
+
+
+def _digest(name):
+    return hashlib.sha1(name.encode('utf-8')).digest()
+
+
+class _AdvisoryLock(object):
+
+    def __init__(self, name):
+        import ckan.model as model
+        # Advisory lock keys are signed 64 bit integers
+        self.key = int.from_bytes(_digest(name)[:8], 'big', signed=True)
+        # Without autocommit each try would leave the connection idle in a
+        # transaction for as long as the lock is held
+        self.connection = model.meta.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+
+    def acquire(self):
+        from sqlalchemy import text
+        return bool(self.connection.execute(
+            text('SELECT pg_try_advisory_lock(:key)'), key=self.key)
+            .scalar())
+
+    def release(self):
+        from sqlalchemy import text
+        try:
+            self.connection.execute(text('SELECT pg_advisory_unlock(:key)'),
+                                    key=self.key)
+        except Exception:
+            # Don't return a connection which may still hold the lock to
+            # the pool
+            self.connection.invalidate()
+            raise
+        finally:
+            self.connection.close()
+
+    def close(self):
+        self.connection.close()
+
+
+class _FileLock(object):
+
+    def __init__(self, name):
+        from ckan.plugins import toolkit
+        directory = toolkit.config.get('ckanext.taxonomy.lock.directory') \
+            or tempfile.gettempdir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, 'ckanext-taxonomy-%s.lock'
+                                 % _digest(name).hex()[:16])
+        self.file = open(self.path, 'a')
+
+    def acquire(self):
+        import fcntl
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def release(self):
+        import fcntl
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+
+    def close(self):
+        self.file.close()
+
+
+def _lock_for(name):
+    import ckan.model as model
+    if model.meta.engine.dialect.name == 'postgresql':
+        return _AdvisoryLock(name)
+    return _FileLock(name)
+
+
+@contextlib.contextmanager
+def taxonomy_lock(name, policy=None, timeout=None):
+    """
+    Holds the lock of the named taxonomy for the duration of the block,
+    waiting for it or failing according to `policy` and `timeout`, which
+    default to the configured ones.
+
+    :raises TaxonomyLocked: If the lock could not be taken
+    """
+    default_policy, default_timeout = _config()
+    policy = policy or default_policy
+    timeout = default_timeout if timeout is None else timeout
+    if policy not in POLICIES:
+        raise ValueError('Unknown lock policy %s' % policy)
+
+    lock = _lock_for(name)
+    deadline = time.time() + timeout
+    waited = False
+    while not lock.acquire():
+        if policy == 'fail' or time.time() >= deadline:
+            lock.close()
+            raise TaxonomyLocked(
+                'Taxonomy %s is being changed by another process' % name)
+        if not waited:
+            log.info('Waiting for the lock of taxonomy %s', name)
+            waited = True
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        yield
+    finally:
+        lock.release()
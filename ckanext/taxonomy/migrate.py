@@ -0,0 +1,214 @@
+"""
+Rewrites datasets to replace free or vocabulary tags with taxonomy terms.
+
+The mapping is a CSV file with 'tag' and 'uri' columns, and optionally a
+'vocabulary' column naming the tag vocabulary (left empty for free tags).
+A tag may be mapped to several terms by giving it more than one row.
+
+Only datasets with a mapped tag are visited. They are read in pages of
+ids, each page is rewritten by one of a pool of threads and committed as
+a single transaction, and a checkpoint file records the last page which
+has been written so that an interrupted run can carry on from there.
+"""
+import csv
+import json
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import ckan.logic as logic
+import ckan.model as model
+
+from ckanext.taxonomy.indexing import package_fields, parse_term_uris
+
+log = getLogger(__name__)
+
+
+def load_mapping(filepath):
+    """
+    Reads a mapping file into a dictionary of {(vocabulary_id, tag): uris},
+    where vocabulary_id is None for free tags.
+    """
+    vocabularies = dict((v.name, v.id)
+                        for v in model.Session.query(model.Vocabulary))
+    mapping = {}
+    with open(filepath) as mapping_file:
+        for row in csv.DictReader(mapping_file):
+            tag = (row.get('tag') or '').strip()
+            uri = (row.get('uri') or '').strip()
+            if not tag or not uri:
+                continue
+            vocabulary = (row.get('vocabulary') or '').strip()
+            vocabulary_id = None
+            if vocabulary:
+                if vocabulary not in vocabularies:
+                    raise ValueError('Unknown vocabulary %s' % vocabulary)
+                vocabulary_id = vocabularies[vocabulary]
+            uris = mapping.setdefault((vocabulary_id, tag), [])
+            if uri not in uris:
+                uris.append(uri)
+    return mapping
+
+
+def migrate_package(pkg_dict, mapping, field, keep_tags=False):
+    """
+    Applies the mapping to a dataset dict, adding the terms of its mapped
+    tags to `field` and, unless `keep_tags` is set, removing those tags.
+
+    :returns: The updated dataset dict, or None if nothing changed
+    """
+    tags = pkg_dict.get('tags') or []
+    uris = []
+    kept = []
+    for tag in tags:
+        mapped = mapping.get((tag.get('vocabulary_id'), tag.get('name')))
+        if mapped:
+            uris.extend(mapped)
+        if not mapped or keep_tags:
+            kept.append(tag)
+    if not uris:
+        return None
+
+    # Schemas may promote the field to the top level of the dataset dict,
+    # otherwise it is stored as an extra.
+    extras = pkg_dict.get('extras') or []
+    if field in pkg_dict:
+        current = parse_term_uris(pkg_dict[field])
+    else:
+        current = []
+        for e in extras:
+            if e.get('key') == field:
+                current = parse_term_uris(e.get('value'))
+
+    new = list(current)
+    for uri in uris:
+        if uri not in new:
+            new.append(uri)
+    if new == current and len(kept) == len(tags):
+        return None
+
+    pkg_dict = dict(pkg_dict, tags=kept)
+    value = json.dumps(new)
+    if field in pkg_dict:
+        pkg_dict[field] = value
+    else:
+        extras = [e for e in extras if e.get('key') != field]
+        extras.append({'key': field, 'value': value})
+        pkg_dict['extras'] = extras
+    return pkg_dict
+
+
+def _package_pages(mapping, page_size, after):
+    """ Yields pages of the ids of datasets using any mapped tag """
+    by_vocabulary = {}
+    for vocabulary_id, tag in mapping:
+        by_vocabulary.setdefault(vocabulary_id, set()).add(tag)
+
+    last_id = after or ''
+    while True:
+        ids = set()
+        for vocabulary_id, tags in by_vocabulary.items():
+            q = model.Session.query(model.Package.id)\
+                .join(model.PackageTag,
+                      model.PackageTag.package_id == model.Package.id)\
+                .join(model.Tag, model.Tag.id == model.PackageTag.tag_id)\
+                .filter(model.Package.state == 'active')\
+                .filter(model.PackageTag.state == 'active')\
+                .filter(model.Tag.name.in_(list(tags)))\
+                .filter(model.Tag.vocabulary_id == vocabulary_id)\
+                .filter(model.Package.id > last_id)\
+                .distinct()\
+                .order_by(model.Package.id)\
+                .limit(page_size)
+            ids.update(id for id, in q)
+        if not ids:
+            break
+        page = sorted(ids)[:page_size]
+        yield page
+        last_id = page[-1]
+
+
+def _migrate_page(package_ids, mapping, field, keep_tags, dry_run, user):
+    session = model.Session
+    changed = 0
+    try:
+        for package_id in package_ids:
+            context = {'model': model, 'session': session, 'user': user,
+                       'ignore_auth': True}
+            pkg_dict = logic.get_action('package_show')(
+                context, {'id': package_id})
+            pkg_dict = migrate_package(pkg_dict, mapping, field, keep_tags)
+            if pkg_dict is None:
+                continue
+            changed += 1
+            if not dry_run:
+                context = {'model': model, 'session': session, 'user': user,
+                           'ignore_auth': True, 'defer_commit': True}
+                logic.get_action('package_update')(context, pkg_dict)
+        if dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+    return changed
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    return {'last_id': None, 'visited': 0, 'changed': 0}
+
+
+def write_checkpoint(path, checkpoint):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(tmp, path)
+
+
+def migrate_tags(mapping, field=None, page_size=100, workers=4,
+                 checkpoint_path=None, keep_tags=False, dry_run=False,
+                 user=None):
+    """
+    Migrates every dataset with a mapped tag, resuming after the last page
+    recorded in the checkpoint file if there is one.
+
+    :returns: The final checkpoint, with the number of datasets visited
+        and changed
+    """
+    field = field or package_fields()[0]
+    checkpoint = read_checkpoint(checkpoint_path)
+    if checkpoint['last_id']:
+        log.info('Resuming after dataset %s', checkpoint['last_id'])
+
+    # Pages are committed in any order, but the checkpoint only moves
+    # past a page once it and every page before it have been written.
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def finish(page, future):
+            checkpoint['visited'] += len(page)
+            checkpoint['changed'] += future.result()
+            checkpoint['last_id'] = page[-1]
+            if checkpoint_path and not dry_run:
+                write_checkpoint(checkpoint_path, checkpoint)
+            log.info('Visited %(visited)d datasets, changed %(changed)d',
+                     checkpoint)
+
+        for page in _package_pages(mapping, page_size,
+                                   checkpoint['last_id']):
+            pending.append((page, pool.submit(
+                _migrate_page,
+                page, mapping, field, keep_tags, dry_run, user)))
+            # Read ahead no further than the workers can keep up with
+            while len(pending) > workers * 2:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    return checkpoint
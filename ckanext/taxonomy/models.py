@@ -1,7 +1,7 @@
 import uuid
 import json
 
-from sqlalchemy import Table, Column, MetaData, ForeignKey
+from sqlalchemy import Table, Column, MetaData, ForeignKey, Index
 from sqlalchemy import types, orm
 from sqlalchemy.sql import select
 from sqlalchemy.orm import mapper, relationship
@@ -127,10 +127,152 @@ class TaxonomyTerm(Base):
         return "<Taxonomy Term: %s>" % (self.label)
 
 
+class TaxonomyTermPackage(Base):
+    """
+    Records which datasets use which taxonomy terms, so that the datasets
+    using a term can be found without going to the search index.
+    """
+    __tablename__ = 'taxonomy_term_package'
+
+    term_id = Column(types.UnicodeText, ForeignKey('taxonomy_term.id'),
+                     primary_key=True)
+    package_id = Column(types.UnicodeText, primary_key=True, index=True)
+
+    def __init__(self, **kwargs):
+        for k, v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "<Taxonomy Term Package: %s %s>" % (self.term_id,
+                                                   self.package_id)
+
+
+class TaxonomyTermCount(Base):
+    """
+    The number of datasets using a term directly, and the number using the
+    term or any of the terms beneath it (the rollup). These are adjusted
+    as datasets change rather than being recounted.
+    """
+    __tablename__ = 'taxonomy_term_count'
+
+    term_id = Column(types.UnicodeText, ForeignKey('taxonomy_term.id'),
+                     primary_key=True)
+    direct = Column(types.Integer, nullable=False, default=0)
+    rollup = Column(types.Integer, nullable=False, default=0)
+
+    def __init__(self, **kwargs):
+        for k, v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "<Taxonomy Term Count: %s %s/%s>" % (self.term_id,
+                                                    self.direct, self.rollup)
+
+
+class TaxonomyTermLabel(Base):
+    """
+    The labels a term is known by. As well as the term's own label (a
+    skos:prefLabel) this holds its synonyms (skos:altLabel) and common
+    misspellings (skos:hiddenLabel), along with a case and accent folded
+    copy of each label for matching.
+    """
+    __tablename__ = 'taxonomy_term_label'
+    __table_args__ = (
+        Index('idx_taxonomy_term_label_normalised',
+              'normalised', 'taxonomy_id'),
+    )
+
+    id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
+    term_id = Column(types.UnicodeText, ForeignKey('taxonomy_term.id'),
+                     nullable=False, index=True)
+    taxonomy_id = Column(types.UnicodeText, ForeignKey('taxonomy.id'),
+                         nullable=False)
+    label = Column(types.UnicodeText, nullable=False, index=True)
+    normalised = Column(types.UnicodeText, nullable=False)
+    kind = Column(types.UnicodeText, nullable=False, default=u'pref')
+    lang = Column(types.UnicodeText)
+
+    def __init__(self, **kwargs):
+        for k, v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'kind': self.kind,
+            'lang': self.lang,
+        }
+
+    def __repr__(self):
+        return "<Taxonomy Term Label: %s (%s)>" % (self.label, self.kind)
+
+
+class TaxonomyTermChange(Base):
+    """
+    An append-only log of every change to a term, numbered in the order
+    the changes were committed, for mirrors to follow. A deleted term
+    leaves a change with no term data, a tombstone.
+    """
+    __tablename__ = 'taxonomy_term_change'
+    __table_args__ = (
+        Index('idx_taxonomy_term_change_taxonomy', 'taxonomy_id', 'seq'),
+    )
+
+    seq = Column(types.Integer, primary_key=True, autoincrement=True)
+    taxonomy_id = Column(types.UnicodeText, nullable=False)
+    term_id = Column(types.UnicodeText, nullable=False)
+    uri = Column(types.UnicodeText)
+    action = Column(types.UnicodeText, nullable=False)
+    timestamp = Column(types.DateTime, nullable=False)
+    term = Column(ckan_types.JsonDictType)
+
+    def __init__(self, **kwargs):
+        for k, v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def as_dict(self):
+        return {
+            'seq': self.seq,
+            'taxonomy_id': self.taxonomy_id,
+            'term_id': self.term_id,
+            'uri': self.uri,
+            'action': self.action,
+            'timestamp': self.timestamp.isoformat(),
+            'term': self.term,
+        }
+
+    def __repr__(self):
+        return "<Taxonomy Term Change: %s %s %s>" % (self.seq, self.action,
+                                                     self.term_id)
+
+
+class TaxonomyCacheVersion(Base):
+    """
+    A version number for each taxonomy's cached data, and one for the set
+    of taxonomies, which processes compare with the versions their caches
+    were built from to notice changes made by other processes.
+    """
+    __tablename__ = 'taxonomy_cache_version'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    version = Column(types.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<Taxonomy Cache Version: %s %s>" % (self.key, self.version)
+
+
 def init_tables():
+    from ckanext.taxonomy.search import create_index
+
     Base.metadata.create_all(model.meta.engine)
+    create_index(model.meta.engine)
 
 
 def remove_tables():
+    TaxonomyCacheVersion.__table__.drop(model.meta.engine, checkfirst=True)
+    TaxonomyTermChange.__table__.drop(model.meta.engine, checkfirst=True)
+    TaxonomyTermLabel.__table__.drop(model.meta.engine, checkfirst=True)
+    TaxonomyTermCount.__table__.drop(model.meta.engine, checkfirst=True)
+    TaxonomyTermPackage.__table__.drop(model.meta.engine, checkfirst=True)
     TaxonomyTerm.__table__.drop(model.meta.engine, checkfirst=False)
     Taxonomy.__table__.drop(model.meta.engine, checkfirst=False)
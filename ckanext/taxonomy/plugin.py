@@ -1,5 +1,4 @@
 from logging import getLogger
-from ckanext.taxonomy.cli import get_commands
 
 import ckan.plugins as p
 
@@ -17,11 +16,43 @@ class TaxonomyPlugin(p.SingletonPlugin):
     p.implements(p.IAuthFunctions, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
     p.implements(p.IClick)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IMiddleware, inherit=True)
+
+    _helpers = None
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        from ckanext.taxonomy import preload
+
+        def middleware(environ, start_response):
+            preload.request_started()
+            return app(environ, start_response)
+        return middleware
 
     # IClick
     def get_commands(self):
+        # The commands need rdflib and skos, which web workers don't
+        from ckanext.taxonomy.cli import get_commands
         return get_commands()
 
+    # IPackageController
+    def before_index(self, pkg_dict):
+        from ckanext.taxonomy.indexing import index_package
+        return index_package(pkg_dict)
+
+    def after_create(self, context, pkg_dict):
+        from ckanext.taxonomy.usage import update_package
+        update_package(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        from ckanext.taxonomy.usage import update_package
+        update_package(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        from ckanext.taxonomy.usage import remove_package
+        remove_package(pkg_dict)
+
     def before_map(self, map):
         ctrl = 'ckanext.taxonomy.controllers:TaxonomyController'
         map.connect('taxonomies_index', '/taxonomies',
@@ -30,6 +61,13 @@ class TaxonomyPlugin(p.SingletonPlugin):
         map.connect('taxonomies_show', '/taxonomies/:name',
             controller=ctrl,
             action='show')
+        map.connect('taxonomies_terms', '/taxonomies/{name}/terms.{format}',
+            controller=ctrl,
+            action='terms',
+            requirements={'format': 'json|jsonl'})
+        map.connect('taxonomies_fragment', '/taxonomies/:name/:fragment',
+            controller=ctrl,
+            action='fragment')
         return map
 
     def after_map(self, map):
@@ -44,17 +82,19 @@ class TaxonomyPlugin(p.SingletonPlugin):
         A dictionary of extra helpers that will be available to provide
         taxonomy helpers to the templates.
         """
-        from ckanext.taxonomy import helpers
-        from inspect import getmembers, isfunction
+        if self._helpers is None:
+            from ckanext.taxonomy import helpers
+            from inspect import getmembers, isfunction
 
-        helper_dict = {}
+            helper_dict = {}
 
-        functions_list = [o for o in getmembers(helpers, isfunction)]
-        for name, fn in functions_list:
-            if name[0] != '_':
-                helper_dict[name] = fn
+            functions_list = [o for o in getmembers(helpers, isfunction)]
+            for name, fn in functions_list:
+                if name[0] != '_':
+                    helper_dict[name] = fn
 
-        return helper_dict
+            self._helpers = helper_dict
+        return dict(self._helpers)
 
     def get_actions(self):
         import ckanext.taxonomy.actions as actions
@@ -71,7 +111,19 @@ class TaxonomyPlugin(p.SingletonPlugin):
             'taxonomy_term_show_bulk': actions.taxonomy_term_show_bulk,
             'taxonomy_term_create': actions.taxonomy_term_create,
             'taxonomy_term_update': actions.taxonomy_term_update,
-            'taxonomy_term_delete': actions.taxonomy_term_delete
+            'taxonomy_term_move':   actions.taxonomy_term_move,
+            'taxonomy_term_delete': actions.taxonomy_term_delete,
+            'taxonomy_term_usage':  actions.taxonomy_term_usage,
+            'taxonomy_term_usage_count': actions.taxonomy_term_usage_count,
+            'taxonomy_term_lookup': actions.taxonomy_term_lookup,
+            'taxonomy_term_autocomplete': actions.taxonomy_term_autocomplete,
+            'taxonomy_term_search': actions.taxonomy_term_search,
+            'taxonomy_term_reconcile': actions.taxonomy_term_reconcile,
+
+            'taxonomy_changes_since': actions.taxonomy_changes_since,
+            'taxonomy_preload_status': actions.taxonomy_preload_status,
+            'taxonomy_import_start': actions.taxonomy_import_start,
+            'taxonomy_import_status': actions.taxonomy_import_status
         }
 
     def get_auth_functions(self):
@@ -88,5 +140,17 @@ class TaxonomyPlugin(p.SingletonPlugin):
             'taxonomy_term_show':   auth.taxonomy_term_show,
             'taxonomy_term_create': auth.taxonomy_term_create,
             'taxonomy_term_update': auth.taxonomy_term_update,
-            'taxonomy_term_delete': auth.taxonomy_term_delete
+            'taxonomy_term_move':   auth.taxonomy_term_update,
+            'taxonomy_term_delete': auth.taxonomy_term_delete,
+            'taxonomy_term_usage':  auth.taxonomy_term_usage,
+            'taxonomy_term_usage_count': auth.taxonomy_term_usage,
+            'taxonomy_term_lookup': auth.taxonomy_term_lookup,
+            'taxonomy_term_autocomplete': auth.taxonomy_term_lookup,
+            'taxonomy_term_search': auth.taxonomy_term_lookup,
+            'taxonomy_term_reconcile': auth.taxonomy_term_lookup,
+
+            'taxonomy_changes_since': auth.taxonomy_changes_since,
+            'taxonomy_preload_status': auth.taxonomy_preload_status,
+            'taxonomy_import_start': auth.taxonomy_import,
+            'taxonomy_import_status': auth.taxonomy_import
         }
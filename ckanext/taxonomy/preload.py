@@ -0,0 +1,178 @@
+"""
+Loads the snapshots of chosen taxonomies on a background thread when a
+web worker handles its first request, so that the requests after it don't
+pay for them.
+
+The taxonomies are named in ckanext.taxonomy.preload, separated by spaces,
+or '*' for all of them. Requests arriving before they are loaded still
+work: one which needs a taxonomy being loaded waits for it through the
+cache's single flight, and any other loads what it needs itself.
+
+Preloading is started by the plugin's middleware, so only processes which
+handle requests preload. Commands, background job workers and the
+processes they fork load the plugin too, but never handle a request.
+"""
+import datetime
+import os
+import threading
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+PENDING = 'pending'
+LOADED = 'loaded'
+FAILED = 'failed'
+
+_lock = threading.Lock()
+_request_lock = threading.Lock()
+_state = {}
+# The process which the plugin was loaded in, and the one which has
+# started preloading, if any
+_loaded_in = os.getpid()
+_started_in = None
+
+
+def configured():
+    """ Returns the names of the taxonomies to preload, or ['*'] """
+    from ckan.plugins import toolkit
+    return toolkit.aslist(toolkit.config.get('ckanext.taxonomy.preload', ''))
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+def start(names=None):
+    """
+    Starts preloading the given taxonomies, or the configured ones, on a
+    daemon thread.
+    """
+    names = configured() if names is None else list(names)
+    if not names:
+        return None
+
+    with _lock:
+        _state.clear()
+        _state.update({'pid': os.getpid(), 'names': names,
+                       'started': _now(), 'finished': None,
+                       'taxonomies': {}})
+
+    thread = threading.Thread(target=_run, args=(names,),
+                              name='taxonomy-preload')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def request_started():
+    """
+    Starts preloading the configured taxonomies if this process hasn't
+    yet. The plugin's middleware calls it before each request is handled,
+    so each web worker starts on its first.
+    """
+    global _started_in
+    pid = os.getpid()
+    if _started_in == pid:
+        return None
+    with _request_lock:
+        if _started_in == pid:
+            return None
+        _started_in = pid
+        if pid != _loaded_in:
+            _drop_inherited_connections()
+        return start()
+
+
+def _after_fork():
+    # A thread may have held the locks, and the state is the parent's
+    global _lock, _request_lock
+    _lock = threading.Lock()
+    _request_lock = threading.Lock()
+    _state.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _drop_inherited_connections():
+    """
+    Stops this process using the database connections it inherited from
+    the process it was forked from, which may still be using them.
+    """
+    import ckan.model as model
+    engine = model.meta.engine
+    try:
+        # Leave them open for the parent
+        engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy before 1.4.33 can only close them
+        engine.dispose()
+
+
+def _run(names):
+    import ckan.model as model
+    from ckanext.taxonomy import autocomplete, cache
+
+    try:
+        if '*' in names:
+            ids = cache.taxonomy_ids()
+        else:
+            ids = []
+            for name in names:
+                taxonomy_id = cache.taxonomy_id_for(name)
+                if taxonomy_id is None:
+                    log.warning('Cannot preload unknown taxonomy %s', name)
+                    _set(name, FAILED, 'Not found')
+                else:
+                    ids.append(taxonomy_id)
+        for taxonomy_id in ids:
+            _set(taxonomy_id, PENDING)
+
+        for taxonomy_id in ids:
+            try:
+                snapshot = cache.get_snapshot(taxonomy_id)
+                autocomplete.get_index(taxonomy_id)
+            except Exception as e:
+                log.exception('Could not preload taxonomy %s', taxonomy_id)
+                _set(taxonomy_id, FAILED, str(e))
+            else:
+                _set(taxonomy_id, LOADED, terms=len(snapshot))
+    except Exception:
+        log.exception('Could not preload taxonomies')
+    finally:
+        model.Session.remove()
+        with _lock:
+            _state['finished'] = _now()
+    log.info('Preloaded taxonomies: %s', _state['taxonomies'])
+
+
+def _set(taxonomy_id, state, error=None, terms=None):
+    entry = {'state': state}
+    if error is not None:
+        entry['error'] = error
+    if terms is not None:
+        entry['terms'] = terms
+    with _lock:
+        _state['taxonomies'][taxonomy_id] = entry
+
+
+def status():
+    """
+    Returns whether preloading is enabled, whether it has finished in
+    this process, and the state of each taxonomy.
+    """
+    with _lock:
+        state = dict(_state)
+        taxonomies = dict(state.get('taxonomies', {}))
+    enabled = bool(configured())
+    finished = bool(state.get('finished')) and \
+        state.get('pid') == os.getpid()
+    return {
+        'enabled': enabled,
+        'ready': finished or not enabled,
+        'started': state.get('started'),
+        'finished': state.get('finished') if finished else None,
+        'taxonomies': taxonomies,
+    }
@@ -0,0 +1,213 @@
+"""
+Writes taxonomies out as static files, so that a web server such as nginx
+can answer reads of them without going through CKAN.
+
+Each taxonomy is written to a directory of its own name containing:
+
+    tree.json             every term, nested under its parent
+    terms.json            every term as a flat list
+    children/root.json    the top level terms
+    children/ID.json      the terms directly below the term with that id
+
+along with a manifest.json recording a hash of each file and a version
+for the whole taxonomy, and an index.json listing every taxonomy at the
+top of the directory. Every file has .gz and, if the brotli package is
+installed, .br siblings for the server to send to clients accepting them.
+
+Only files whose content has changed since the last publish are written,
+and files for terms which no longer exist are removed.
+"""
+import hashlib
+import json
+import os
+
+from logging import getLogger
+
+import ckan.logic as logic
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy.fragments import compress
+
+log = getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+INDEX = 'index.json'
+
+# The fields of each term which are published
+TERM_FIELDS = ('id', 'label', 'uri', 'description', 'parent_id')
+
+
+def publish_directory():
+    return toolkit.config.get('ckanext.taxonomy.publish.directory')
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def serialise(data):
+    """ Serialises data to JSON the same way every time """
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))\
+        .encode('utf-8')
+
+
+def taxonomy_files(terms):
+    """
+    Returns a dictionary of {relative path: body} of the files for a
+    taxonomy, given the flat list of its terms.
+    """
+    terms = [dict((k, t.get(k)) for k in TERM_FIELDS) for t in terms]
+    terms.sort(key=lambda t: (t['label'] or '', t['id']))
+
+    children = {}
+    for t in terms:
+        children.setdefault(t['parent_id'], []).append(t)
+
+    def nested(term):
+        return dict(term, children=[nested(c)
+                                    for c in children.get(term['id'], [])])
+
+    def level(parent_id):
+        return [dict(t, has_children=t['id'] in children)
+                for t in children.get(parent_id, [])]
+
+    files = {
+        'tree.json': serialise([nested(t) for t in children.get(None, [])]),
+        'terms.json': serialise(terms),
+        'children/root.json': serialise(level(None)),
+    }
+    for parent_id in children:
+        if parent_id is not None:
+            files['children/%s.json' % parent_id] = serialise(
+                level(parent_id))
+    return files
+
+
+def _write(path, body):
+    """ Writes a file atomically, creating its directory if need be """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    os.rename(tmp, path)
+
+
+def _write_compressed(path, body, brotli):
+    """ Writes a file along with its compressed siblings """
+    _write(path, body)
+    _write(path + '.gz', compress(body))
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(body))
+
+
+def _read(path):
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    return None
+
+
+def _remove(path):
+    for p in (path, path + '.gz', path + '.br'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def _read_manifest(directory):
+    body = _read(os.path.join(directory, MANIFEST))
+    if body is not None:
+        return json.loads(body.decode('utf-8'))
+    return {'version': None, 'files': {}}
+
+
+def write_files(directory, files):
+    """
+    Brings a directory up to date with `files`, writing only those which
+    are missing or have changed, with their compressed siblings, and
+    removing any left over from the last publish.
+
+    :returns: The manifest and the number of files written and removed
+    """
+    brotli = _brotli()
+    previous = _read_manifest(directory)
+
+    hashes = {}
+    written = 0
+    for name, body in sorted(files.items()):
+        digest = hashlib.sha256(body).hexdigest()
+        hashes[name] = digest
+        path = os.path.join(directory, name)
+        if previous['files'].get(name) == digest and os.path.exists(path):
+            continue
+        _write_compressed(path, body, brotli)
+        written += 1
+
+    removed = 0
+    for name in set(previous['files']) - set(hashes):
+        _remove(os.path.join(directory, name))
+        removed += 1
+
+    version = hashlib.sha256(serialise(hashes)).hexdigest()[:16]
+    manifest = {'version': version, 'files': hashes}
+    if written or removed or previous['version'] != version:
+        _write(os.path.join(directory, MANIFEST), serialise(manifest))
+    return manifest, written, removed
+
+
+def publish(directory, names=None, lang=None):
+    """
+    Publishes the named taxonomies, or all of them, to `directory`. With a
+    `lang` the terms are labelled in that language and written beneath a
+    directory for it within each taxonomy's directory.
+
+    :returns: The number of files written and removed
+    """
+    brotli = _brotli()
+    if brotli is None:
+        log.warning('brotli is not installed, so no .br files are written')
+
+    context = {'model': model, 'ignore_auth': True}
+    taxonomies = logic.get_action('taxonomy_list')(context, {})
+    if names:
+        taxonomies = [t for t in taxonomies if t['name'] in names]
+
+    index_path = os.path.join(directory, INDEX)
+    previous = _read(index_path)
+    index = {}
+    if previous is not None:
+        for t in json.loads(previous.decode('utf-8')):
+            index[t['name']] = t
+
+    written = removed = 0
+    for taxonomy in taxonomies:
+        terms = logic.get_action('taxonomy_term_list')(
+            context, {'id': taxonomy['id'], 'lang': lang})
+        taxonomy_dir = os.path.join(directory, taxonomy['name'])
+        if lang:
+            taxonomy_dir = os.path.join(taxonomy_dir, lang)
+        manifest, w, r = write_files(taxonomy_dir, taxonomy_files(terms))
+        written += w
+        removed += r
+        log.info('Published %s version %s (%d files written, %d removed)',
+                 taxonomy['name'], manifest['version'], w, r)
+        if not lang:
+            index[taxonomy['name']] = dict(
+                (k, taxonomy[k]) for k in ('id', 'name', 'title', 'uri'))
+            index[taxonomy['name']]['version'] = manifest['version']
+
+    if not names:
+        # Taxonomies which have been deleted are dropped from the index,
+        # but their files are left for anyone still linking to them.
+        current = set(t['name'] for t in taxonomies)
+        index = dict((k, v) for k, v in index.items() if k in current)
+    body = serialise(sorted(index.values(), key=lambda t: t['name']))
+    if body != previous:
+        _write_compressed(index_path, body, brotli)
+    return written, removed
@@ -0,0 +1,230 @@
+"""
+Fuzzy matching of free text, such as legacy tags, onto taxonomy terms.
+
+Labels and synonyms are broken into overlapping character trigrams and
+stored in an inverted index. The similarity of a string to every label is
+then the cosine of their idf weighted trigram vectors, worked out as a
+sparse dot product by walking only the postings of the string's own
+trigrams.
+"""
+import heapq
+import math
+
+from operator import itemgetter
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.labels import label_entries, normalise
+
+NGRAM_SIZE = 3
+
+# Trigrams found in more than this share of labels say little about a
+# match, so their postings aren't used to find candidate labels.
+COMMON_NGRAM_SHARE = 0.05
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    """
+    Returns the set of character n-grams of the normalised text, padded
+    with spaces so that the start and end of words are significant.
+    """
+    text = u' %s ' % normalise(text)
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+class NgramIndex(object):
+    """
+    An inverted index from trigrams to the labels containing them.
+    """
+
+    def __init__(self, entries):
+        """
+        `entries` is an iterable of (label, term) pairs, where term is any
+        value identifying the term the label belongs to.
+        """
+        self.labels = []
+        self.terms = []
+        postings = {}
+        grams_by_label = []
+        for label, term in entries:
+            grams = ngrams(label)
+            if not grams:
+                continue
+            for gram in grams:
+                postings.setdefault(gram, []).append(len(self.labels))
+            grams_by_label.append(grams)
+            self.labels.append(label)
+            self.terms.append(term)
+
+        size = float(len(self.labels))
+        # Store squared idf weights with the postings, as they are what the
+        # dot product sums.
+        self.postings = dict(
+            (gram, (math.log(1.0 + size / len(p)) ** 2, p))
+            for gram, p in postings.items())
+        self.inverse_norms = [
+            1.0 / math.sqrt(sum(self.postings[g][0] for g in grams))
+            for grams in grams_by_label]
+        self.label_grams = grams_by_label
+        self.max_postings = max(50, int(size * COMMON_NGRAM_SHARE))
+        # The weight of a trigram which no label contains
+        self.max_weight = math.log(1.0 + size) ** 2
+
+    def __len__(self):
+        return len(self.labels)
+
+    def match(self, text, limit=3, threshold=0.0):
+        """
+        Returns up to `limit` (term, label, score) tuples for the terms
+        most similar to `text`, best first. Scores are between 0 and 1,
+        and each term appears once with its best matching label.
+        """
+        grams = ngrams(text)
+        if not grams or not self.labels:
+            return []
+
+        scores = {}
+        get = scores.get
+        common = []
+        query_norm = 0.0
+        max_postings = self.max_postings
+        for gram in grams:
+            entry = self.postings.get(gram)
+            if entry is None:
+                # Unknown trigrams still count towards the query's length
+                query_norm += self.max_weight
+                continue
+            weight, posting = entry
+            query_norm += weight
+            if len(posting) > max_postings:
+                common.append((gram, weight))
+                continue
+            for i in posting:
+                scores[i] = get(i, 0.0) + weight
+        if not scores:
+            if not common:
+                return []
+            # Every trigram is common, as for short labels in a large
+            # taxonomy. A label the text matches exactly contains all of
+            # them, so the labels containing the rarest are the candidates.
+            posting = min((self.postings[gram][1] for gram, _ in common),
+                          key=len)
+            for i in posting:
+                scores[i] = 0.0
+
+        # Trigrams in a large share of labels are only checked against the
+        # labels already found, rather than their postings being walked.
+        if common:
+            label_grams = self.label_grams
+            for i in scores:
+                grams_i = label_grams[i]
+                for gram, weight in common:
+                    if gram in grams_i:
+                        scores[i] += weight
+
+        inverse_norms = self.inverse_norms
+        for i in scores:
+            scores[i] *= inverse_norms[i]
+        scale = 1.0 / math.sqrt(query_norm)
+
+        # Synonyms can put one term in the running more than once, so take
+        # enough of the best labels to fill the limit with distinct terms.
+        res = []
+        seen = set()
+        ranked = heapq.nlargest(limit * 4, scores.items(),
+                                key=itemgetter(1))
+        for i, score in ranked:
+            score *= scale
+            if score < threshold or len(res) >= limit:
+                break
+            if self.terms[i] not in seen:
+                seen.add(self.terms[i])
+                res.append((self.terms[i], self.labels[i], score))
+        return res
+
+
+def get_index(taxonomy_id):
+    """
+    Returns the snapshot and NgramIndex of a taxonomy, building the index
+    when first needed and again whenever the taxonomy changes.
+    """
+    snapshot = cache.get_snapshot(taxonomy_id)
+
+    def build():
+        return NgramIndex(label_entries(snapshot))
+
+    return snapshot, cache.get_derived(taxonomy_id, 'reconcile', build,
+                                       snapshot=snapshot)
+
+
+def reconcile(strings, taxonomy_ids=None, limit=3, threshold=0.0):
+    """
+    Finds the best matching terms for each of the strings, searching the
+    given taxonomies or all of them. Strings which are the same once
+    normalised are only matched once.
+
+    :returns: For each string, up to `limit` candidate terms with their
+        'id', 'uri', 'label', 'taxonomy_id', the label which matched
+        ('match') and a 'score' between 0 and 1
+    :rtype: A dictionary of lists of dictionaries
+    """
+    if not taxonomy_ids:
+        taxonomy_ids = cache.taxonomy_ids()
+    indexes = [get_index(taxonomy_id) for taxonomy_id in taxonomy_ids]
+
+    by_normalised = {}
+    res = {}
+    for text in strings:
+        key = normalise(text)
+        if key not in by_normalised:
+            candidates = []
+            for snapshot, index in indexes:
+                for i, label, score in index.match(text, limit, threshold):
+                    candidates.append({'id': snapshot.ids[i],
+                                       'uri': snapshot.uris[i],
+                                       'label': snapshot.labels[i],
+                                       'taxonomy_id': snapshot.taxonomy_id,
+                                       'match': label,
+                                       'score': round(score, 4)})
+            candidates.sort(key=lambda c: -c['score'])
+            by_normalised[key] = candidates[:limit]
+        res[text] = by_normalised[key]
+    return res
+
+
+def reconcile_file(strings, taxonomy_ids=None, limit=3, threshold=0.0,
+                   workers=1, chunk_size=1000):
+    """
+    Reconciles a large batch of strings, yielding (string, candidates)
+    pairs in the order given. With more than one worker the strings are
+    split into chunks matched by forked processes, which share the indexes
+    built here before the pool starts.
+    """
+    if not taxonomy_ids:
+        taxonomy_ids = cache.taxonomy_ids()
+    for taxonomy_id in taxonomy_ids:
+        get_index(taxonomy_id)
+
+    chunks = [strings[i:i + chunk_size]
+              for i in range(0, len(strings), chunk_size)]
+    args = [(chunk, taxonomy_ids, limit, threshold) for chunk in chunks]
+    if workers > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork'))
+        with pool:
+            results = pool.map(_reconcile_chunk, args)
+            for chunk, matches in zip(chunks, results):
+                for text in chunk:
+                    yield text, matches[text]
+    else:
+        for chunk, arg in zip(chunks, args):
+            matches = _reconcile_chunk(arg)
+            for text in chunk:
+                yield text, matches[text]
+
+
+def _reconcile_chunk(args):
+    return reconcile(*args)
@@ -0,0 +1,164 @@
+"""
+Full text search over the labels and descriptions of taxonomy terms.
+
+On PostgreSQL this uses a GIN index over a tsvector of each term, created
+by `init_tables`. Other databases, such as the SQLite used in some
+tests, use an in-memory inverted index built per taxonomy instead. The
+ckanext.taxonomy.search.backend option can be set to 'python' to use the
+in-memory index everywhere.
+"""
+import math
+import re
+
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.labels import normalise
+from ckanext.taxonomy.models import TaxonomyTerm
+
+# Words in a label count for more than words in a description
+LABEL_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+
+# This must match the expression the index is created with, otherwise
+# PostgreSQL won't use it.
+TSVECTOR_SQL = (
+    "setweight(to_tsvector('simple', coalesce(taxonomy_term.label, '')), 'A')"
+    " || setweight(to_tsvector('simple', "
+    "coalesce(taxonomy_term.description, '')), 'B')")
+
+INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_taxonomy_term_fts ON taxonomy_term "
+    "USING gin ((%s))" % TSVECTOR_SQL)
+
+
+def tokenise(text):
+    """ Splits text into case and accent folded words """
+    return re.findall(r'\w+', normalise(text), re.UNICODE)
+
+
+class InvertedIndex(object):
+    """
+    Maps each word to the terms containing it and a weight for how
+    prominently it appears, and ranks the terms matching every word of a
+    query by a tf-idf score.
+    """
+
+    def __init__(self, terms):
+        """
+        `terms` is a list of (label, description) pairs, and results refer
+        to terms by their position in that list.
+        """
+        self.size = len(terms)
+        self.postings = {}
+        for i, (label, description) in enumerate(terms):
+            for weight, text in ((LABEL_WEIGHT, label),
+                                 (DESCRIPTION_WEIGHT, description)):
+                for word in tokenise(text):
+                    posting = self.postings.setdefault(word, {})
+                    posting[i] = posting.get(i, 0) + weight
+
+    def search(self, query):
+        """
+        Returns (position, score) pairs for the terms containing every word
+        of the query, best first.
+        """
+        words = set(tokenise(query))
+        if not words:
+            return []
+
+        scores = None
+        for word in words:
+            posting = self.postings.get(word)
+            if not posting:
+                return []
+            idf = math.log(1.0 + float(self.size) / len(posting))
+            if scores is None:
+                scores = dict((i, w * idf) for i, w in posting.items())
+            else:
+                scores = dict((i, s + posting[i] * idf)
+                              for i, s in scores.items() if i in posting)
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+
+def use_database():
+    backend = toolkit.config.get('ckanext.taxonomy.search.backend', 'auto')
+    return backend != 'python' and \
+        model.meta.engine.dialect.name == 'postgresql'
+
+
+def create_index(engine):
+    """ Creates the full text index on PostgreSQL, if it doesn't exist """
+    if engine.dialect.name == 'postgresql':
+        engine.execute(INDEX_SQL)
+
+
+def search_terms(query, taxonomy_ids=None, limit=20, offset=0):
+    """
+    Returns the number of terms matching the query and a page of them,
+    best first, each with a 'score'.
+    """
+    if use_database():
+        return _search_database(query, taxonomy_ids, limit, offset)
+    return _search_memory(query, taxonomy_ids, limit, offset)
+
+
+def _search_database(query, taxonomy_ids, limit, offset):
+    from sqlalchemy import func, literal_column
+
+    tsquery = func.plainto_tsquery('simple', query)
+    tsvector = literal_column(TSVECTOR_SQL)
+    score = func.ts_rank(tsvector, tsquery).label('score')
+
+    q = model.Session.query(TaxonomyTerm, score)\
+        .filter(tsvector.op('@@')(tsquery))
+    if taxonomy_ids:
+        q = q.filter(TaxonomyTerm.taxonomy_id.in_(taxonomy_ids))
+
+    count = q.count()
+    page = q.order_by(score.desc(), TaxonomyTerm.label)\
+        .offset(offset).limit(limit)
+    return count, [_result(term.as_dict(), s) for term, s in page]
+
+
+def _get_index(taxonomy_id):
+    def build():
+        rows = model.Session.query(
+            TaxonomyTerm.id, TaxonomyTerm.label, TaxonomyTerm.description,
+            TaxonomyTerm.uri, TaxonomyTerm.parent_id)\
+            .filter(TaxonomyTerm.taxonomy_id == taxonomy_id)\
+            .order_by(TaxonomyTerm.id).all()
+        terms = [{'id': id, 'label': label, 'description': description,
+                  'uri': uri, 'parent_id': parent_id,
+                  'taxonomy_id': taxonomy_id}
+                 for id, label, description, uri, parent_id in rows]
+        index = InvertedIndex([(t['label'], t['description'])
+                               for t in terms])
+        return terms, index
+
+    return cache.get_derived(taxonomy_id, 'search', build)
+
+
+def _search_memory(query, taxonomy_ids, limit, offset):
+    if not taxonomy_ids:
+        taxonomy_ids = cache.taxonomy_ids()
+
+    matches = []
+    for taxonomy_id in taxonomy_ids:
+        terms, index = _get_index(taxonomy_id)
+        matches.extend((score, terms[i]) for i, score in index.search(query))
+    matches.sort(key=lambda m: (-m[0], m[1]['label'] or ''))
+
+    return len(matches), [_result(term, score)
+                          for score, term in matches[offset:offset + limit]]
+
+
+def _result(term, score):
+    return {'id': term['id'],
+            'label': term['label'],
+            'description': term['description'],
+            'uri': term['uri'],
+            'taxonomy_id': term['taxonomy_id'],
+            'parent_id': term['parent_id'],
+            'score': float(score)}
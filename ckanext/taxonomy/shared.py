@@ -0,0 +1,149 @@
+"""
+Snapshot files shared by every process on a host.
+
+When ckanext.taxonomy.snapshot.directory is set, each taxonomy has a
+version number kept in a small file in that directory, and a binary
+snapshot file for the current version, named TAXONOMY_ID-VERSION.snap.
+Processes memory map the file rather than holding their own copy, so
+every worker shares one copy in the page cache.
+
+Changing a taxonomy bumps its version, which every process notices the
+next time it checks (at most once every check_interval seconds), dropping
+its caches of that taxonomy. The first process to need the new version
+builds it from the database and writes the file with an atomic rename,
+and the rest map it. Builders take an exclusive lock on the version's
+TAXONOMY_ID-VERSION.build file first, so that processes needing it at
+once wait for the one building it rather than all building it.
+"""
+import fcntl
+import os
+import time
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+_checked = {}
+
+
+def directory():
+    from ckan.plugins import toolkit
+    return toolkit.config.get('ckanext.taxonomy.snapshot.directory')
+
+
+def check_interval():
+    from ckan.plugins import toolkit
+    return float(toolkit.config.get(
+        'ckanext.taxonomy.snapshot.check_interval', 1.0))
+
+
+def _version_path(taxonomy_id):
+    return os.path.join(directory(), '%s.version' % taxonomy_id)
+
+
+def snapshot_file(taxonomy_id, version):
+    return os.path.join(directory(), '%s-%d.snap' % (taxonomy_id, version))
+
+
+def _build_lock_path(taxonomy_id, version):
+    return os.path.join(directory(), '%s-%d.build' % (taxonomy_id, version))
+
+
+def read_version(taxonomy_id):
+    """ Returns the shared version of a taxonomy """
+    try:
+        with open(_version_path(taxonomy_id)) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def bump_version(taxonomy_id, version=None):
+    """
+    Moves a taxonomy on to a new version, so that every process drops its
+    copy, and removes the files of earlier versions. Processes which still
+    have one of them mapped keep reading it until they next check.
+
+    Given a `version`, such as one agreed through the cache backend, the
+    taxonomy is moved on to that version unless it has already reached
+    it, so every process on a host can apply the same change.
+    """
+    path = _version_path(taxonomy_id)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            current = int(f.read().strip() or 0)
+            if version is None:
+                version = current + 1
+            elif version <= current:
+                return current
+            f.seek(0)
+            f.truncate()
+            f.write(str(version))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    prefix = '%s-' % taxonomy_id
+    current = '%s%d' % (prefix, version)
+    for name in os.listdir(directory()):
+        base, ext = os.path.splitext(name)
+        if base.startswith(prefix) and ext in ('.snap', '.build') and \
+                base != current:
+            try:
+                os.remove(os.path.join(directory(), name))
+            except OSError:
+                pass
+    _checked[taxonomy_id] = (version, time.time())
+    return version
+
+
+def changed(taxonomy_id, version):
+    """
+    Returns True if the shared version of a taxonomy is no longer
+    `version`, reading it at most once every check_interval seconds.
+    """
+    now = time.time()
+    last = _checked.get(taxonomy_id)
+    if last is None or now - last[1] >= check_interval():
+        last = (read_version(taxonomy_id), now)
+        _checked[taxonomy_id] = last
+    return last[0] != version
+
+
+def load_snapshot(taxonomy_id, local_version):
+    """
+    Returns a snapshot of the current shared version of a taxonomy mapped
+    from its file, writing the file first if no process has yet. Only one
+    process at a time builds a version, and the others wait for its file.
+    """
+    from ckanext.taxonomy.binary import MappedSnapshot, write_snapshot
+    from ckanext.taxonomy.cache import build_snapshot, fetch_snapshot
+
+    version = read_version(taxonomy_id)
+    _checked[taxonomy_id] = (version, time.time())
+    path = snapshot_file(taxonomy_id, version)
+    if not os.path.exists(path):
+        with open(_build_lock_path(taxonomy_id, version), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have written it while this one waited
+            if not os.path.exists(path):
+                snapshot = fetch_snapshot(taxonomy_id, local_version)
+                # Don't publish it if the taxonomy changed while it was
+                # being read, as it may not have the change.
+                if read_version(taxonomy_id) != version:
+                    return snapshot
+                write_snapshot(path, snapshot)
+                log.info('Wrote snapshot of %s version %d to %s',
+                         taxonomy_id, version, path)
+
+    try:
+        snapshot = MappedSnapshot(path, local_version)
+    except (ValueError, EnvironmentError) as e:
+        log.warning('Could not map snapshot %s: %s', path, e)
+        return build_snapshot(taxonomy_id, local_version)
+    snapshot.shared_version = version
+    return snapshot
@@ -0,0 +1,87 @@
+"""
+Streams the terms of a taxonomy as JSON without building the whole list
+in memory.
+
+Rows are read through a connection of their own with a server-side cursor
+where the database supports one, a batch at a time, and encoded into
+chunks of roughly CHUNK_SIZE bytes as they arrive. The request's session
+isn't used because the response is only iterated over once the controller
+has returned and the session has been cleaned up.
+"""
+import json
+
+import ckan.model as model
+
+from ckanext.taxonomy.models import TaxonomyTerm
+
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+# The columns of each term, in the same form as TaxonomyTerm.as_dict
+TERM_COLUMNS = ('id', 'label', 'description', 'uri', 'extras',
+                'taxonomy_id', 'parent_id')
+
+
+def iter_terms(taxonomy_id, order_by='label', batch_size=BATCH_SIZE):
+    """
+    Yields a dictionary for each term in a taxonomy, ordered by 'label'
+    (as taxonomy_term_list is) or by 'id'.
+    """
+    from sqlalchemy import select
+
+    table = TaxonomyTerm.__table__
+    columns = [table.c[name] for name in TERM_COLUMNS]
+    order = [table.c.label, table.c.id] if order_by == 'label' \
+        else [table.c.id]
+    query = select(columns)\
+        .where(table.c.taxonomy_id == taxonomy_id)\
+        .order_by(*order)
+
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True)\
+            .execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(TERM_COLUMNS, row))
+    finally:
+        connection.close()
+
+
+def _chunks(pieces, chunk_size=CHUNK_SIZE):
+    """ Joins small strings into chunks of bytes of about chunk_size """
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield u''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield u''.join(buf).encode('utf-8')
+
+
+def iter_json_list(items, chunk_size=CHUNK_SIZE):
+    """ Encodes items as a JSON list, yielding chunks of bytes """
+    def pieces():
+        separator = u'['
+        for item in items:
+            yield separator
+            yield json.dumps(item)
+            separator = u','
+        yield u'[]' if separator == u'[' else u']'
+    return _chunks(pieces(), chunk_size)
+
+
+def iter_json_lines(items, chunk_size=CHUNK_SIZE):
+    """ Encodes items as JSON Lines, yielding chunks of bytes """
+    def pieces():
+        for item in items:
+            yield json.dumps(item)
+            yield u'\n'
+    return _chunks(pieces(), chunk_size)
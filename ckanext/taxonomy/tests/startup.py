@@ -0,0 +1,59 @@
+"""
+Measures what loading the plugin costs a web worker: the time taken to
+import it and to collect its actions, auth functions and helpers, the
+memory this adds, and whether any of the modules only the commands need
+were loaded. Run it in a fresh interpreter:
+
+    python -m ckanext.taxonomy.tests.startup
+
+which prints the results as JSON.
+"""
+import json
+import resource
+import sys
+import time
+
+# Modules which only the paster/ckan commands should load
+COMMAND_MODULES = ('rdflib', 'skos', 'ckanext.taxonomy.cli',
+                   'ckanext.taxonomy.export')
+
+
+def rss():
+    """ Returns the resident set size of the process in kilobytes """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    # Elsewhere, the peak is the best there is
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def measure():
+    import ckan.plugins  # noqa, CKAN itself is not being measured
+
+    before = rss()
+    start = time.time()
+    from ckanext.taxonomy.plugin import TaxonomyPlugin
+    imported = time.time()
+
+    plugin = TaxonomyPlugin()
+    plugin.get_actions()
+    plugin.get_auth_functions()
+    plugin.get_helpers()
+    loaded = time.time()
+
+    return {
+        'import_seconds': round(imported - start, 4),
+        'load_seconds': round(loaded - start, 4),
+        'rss_kb': rss() - before,
+        'command_modules': [m for m in COMMAND_MODULES
+                            if m in sys.modules],
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(measure(), indent=2))
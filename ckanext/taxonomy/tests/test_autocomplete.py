@@ -0,0 +1,66 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.autocomplete import PrefixIndex
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestPrefixIndex(object):
+
+    def test_search(self):
+        index = PrefixIndex([(u'Economy', 1),
+                             (u'Social economy', 2),
+                             (u'Économie', 1),
+                             (u'Education', 3)])
+        assert index.search(u'eco') == [(1, u'Économie'),
+                                         (2, u'Social economy')]
+        assert index.search(u'ECONOMY') == [(1, u'Economy'),
+                                            (2, u'Social economy')]
+        assert index.search(u'e', limit=2) == [(1, u'Économie'),
+                                               (3, u'Education')]
+        assert index.search(u'') == []
+        assert index.search(u'zzz') == []
+
+    def test_large_index(self):
+        """
+        How long lookups take is measured by
+        ckanext.taxonomy.tests.autocomplete_benchmark
+        """
+        index = PrefixIndex((u'term %06d label' % i, i)
+                            for i in range(100000))
+        res = index.search(u'term 05', 10)
+        assert res == [(i, u'term %06d label' % i)
+                       for i in range(50000, 50010)], res
+
+
+class TestAutocomplete(TaxonomyTestCase):
+
+    def test_autocomplete(self):
+        term = logic.get_action('taxonomy_term_create')(
+            TestAutocomplete.sysadmin_context,
+            {'label': u'Transport',
+             'uri': 'http://localhost.local/autocomplete/transport',
+             'taxonomy_id': TestAutocomplete.taxonomies[0]['id'],
+             'alt_labels': [u'Mobility']})
+
+        res = logic.get_action('taxonomy_term_autocomplete')(
+            TestAutocomplete.empty_context,
+            {'q': u'mob', 'taxonomy': TestAutocomplete.taxonomies[0]['name']})
+        assert [t['id'] for t in res] == [term['id']], res
+        assert res[0]['match'] == u'Mobility', res
+
+        # The index is rebuilt once the taxonomy changes
+        logic.get_action('taxonomy_term_update')(
+            TestAutocomplete.sysadmin_context,
+            dict(term, label=u'Travel'))
+        res = logic.get_action('taxonomy_term_autocomplete')(
+            TestAutocomplete.empty_context,
+            {'q': u'tra', 'taxonomy': TestAutocomplete.taxonomies[0]['id']})
+        assert [t['label'] for t in res] == [u'Travel'], res
+
+    @raises(logic.NotFound)
+    def test_autocomplete_missing_taxonomy(self):
+        logic.get_action('taxonomy_term_autocomplete')(
+            TestAutocomplete.empty_context,
+            {'q': u'a', 'taxonomy': 'no-such-taxonomy'})
@@ -0,0 +1,137 @@
+import queue
+import threading
+
+from ckanext.taxonomy import backends, cache
+from ckanext.taxonomy.backends import DatabaseBackend, MemoryBackend, \
+    RedisBackend
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class StandInRedis(object):
+    """
+    Enough of a Redis client, kept in memory, for several backends to
+    share as if they were on different nodes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+        self.subscribed = threading.Event()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        with self.lock:
+            self.data[key] = int(self.data.get(key, 0)) + 1
+            return self.data[key]
+
+    def publish(self, channel, message):
+        for q in self.subscribers:
+            q.put({'type': 'message', 'channel': channel,
+                   'data': message.encode('utf-8')})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return StandInPubSub(self)
+
+
+class StandInPubSub(object):
+
+    def __init__(self, redis):
+        self.queue = queue.Queue()
+        self.redis = redis
+
+    def subscribe(self, channel):
+        self.redis.subscribers.append(self.queue)
+        self.redis.subscribed.set()
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+
+class TestBackends(object):
+
+    def test_memory_versions(self):
+        backend = MemoryBackend()
+        assert backend.version('t') == 0
+        assert backend.bump('t') == 1
+        assert backend.version('t') == 1
+        assert backend.get_snapshot('t', 1) is None
+
+    def test_redis_versions_are_shared(self):
+        redis = StandInRedis()
+        one, two = RedisBackend(client=redis), RedisBackend(client=redis)
+        assert one.bump('t') == 1
+        assert two.version('t') == 1
+        two.set_snapshot('t', 1, b'data')
+        assert one.get_snapshot('t', 1) == b'data'
+        assert one.get_snapshot('t', 0) is None
+
+    def test_redis_publish(self):
+        redis = StandInRedis()
+        one, two = RedisBackend(client=redis), RedisBackend(client=redis)
+        received = queue.Queue()
+        two.subscribe(received.put)
+        assert redis.subscribed.wait(5), 'The subscriber never subscribed'
+
+        one.publish({'taxonomy_id': 't', 'version': 3})
+        message = received.get(timeout=5)
+        assert message['taxonomy_id'] == 't', message
+        assert message['version'] == 3, message
+        assert message['origin'] == backends.origin(), message
+
+    def test_message_from_another_node(self):
+        cache.get_derived('remote', 'test', lambda: 1)
+        before = cache.version('remote')
+
+        cache.on_message({'taxonomy_id': 'remote', 'version': 2,
+                          'origin': backends.origin()})
+        assert cache.version('remote') == before
+
+        cache.on_message({'taxonomy_id': 'remote', 'version': 2,
+                          'origin': 'elsewhere:1'})
+        assert cache.version('remote') == before + 1
+        assert cache.get_derived('remote', 'test', lambda: 2) == 2
+
+
+class TestDatabaseBackend(TaxonomyTestCase):
+
+    def test_changes_are_found(self):
+        one, two = DatabaseBackend(), DatabaseBackend(check_interval=0)
+        received = []
+        one.subscribe(lambda message: None)
+        two.subscribe(received.append)
+
+        version = one.bump('polled')
+        assert two.version('polled') == version
+        two.poll()
+        assert received == [{'taxonomy_id': 'polled', 'version': None,
+                             'origin': None}], received
+        two.poll()
+        assert len(received) == 1, received
+
+        # A change to the set of taxonomies drops everything
+        one.publish({'taxonomy_id': None})
+        two.poll()
+        assert received[-1] == {'taxonomy_id': None, 'origin': None}
+
+    def test_own_changes_are_not_repeated(self):
+        backend = DatabaseBackend(check_interval=0)
+        received = []
+        backend.subscribe(received.append)
+        backend.bump('own')
+        backend.poll()
+        assert received == [], received
+
+    def test_checks_are_limited(self):
+        one, two = DatabaseBackend(), DatabaseBackend(check_interval=60)
+        received = []
+        two.subscribe(received.append)
+        one.bump('limited')
+        two.poll()
+        assert received == [], received
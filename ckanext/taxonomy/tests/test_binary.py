@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from nose.tools import raises
+
+from ckanext.taxonomy.binary import MappedSnapshot, write_snapshot
+from ckanext.taxonomy.cache import TaxonomySnapshot
+
+ROWS = [
+    ('c', 'a', 'http://x/c', u'Trade'),
+    ('a', None, 'http://x/a', u'Économie'),
+    ('b', 'a', 'http://x/b', u'Tax'),
+    ('d', 'b', 'http://x/d', None),
+]
+
+
+class TestBinarySnapshot(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'taxonomy.snap')
+        self.snapshot = TaxonomySnapshot(
+            'taxonomy', 0, ROWS, [('b', 'fr', u'Impôt')])
+        write_snapshot(self.path, self.snapshot)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_columns(self):
+        mapped = MappedSnapshot(self.path, 7)
+        assert mapped.taxonomy_id == 'taxonomy'
+        assert mapped.version == 7
+        assert len(mapped) == 4
+        assert list(mapped.ids) == list(self.snapshot.ids)
+        assert list(mapped.uris) == list(self.snapshot.uris)
+        assert list(mapped.labels) == [u'Trade', u'Économie', u'Tax', u'']
+        assert list(mapped.parents) == list(self.snapshot.parents)
+
+    def test_lookups(self):
+        mapped = MappedSnapshot(self.path)
+        for i, id in enumerate(self.snapshot.ids):
+            assert mapped.by_id.get(id) == i
+            assert mapped.index_of(self.snapshot.uris[i]) == i
+        assert mapped.by_id.get('missing') is None
+        assert mapped.by_uri.get('http://x/zzz', -1) == -1
+
+    def test_hierarchy(self):
+        mapped = MappedSnapshot(self.path)
+        d = mapped.by_id.get('d')
+        assert [mapped.ids[i] for i in mapped.ancestors(d)] == ['b', 'a']
+        a = mapped.by_id.get('a')
+        assert sorted(mapped.ids[i] for i in mapped.descendants(a)) == \
+            ['b', 'c', 'd']
+
+    def test_translations(self):
+        mapped = MappedSnapshot(self.path)
+        b = mapped.by_id.get('b')
+        assert mapped.translations == {'fr': {b: u'Impôt'}}
+        assert mapped.label(b, 'fr-CA') == u'Impôt'
+        assert mapped.label(b, 'de') == u'Tax'
+
+    @raises(ValueError)
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 64)
+        MappedSnapshot(self.path)
@@ -0,0 +1,97 @@
+import threading
+
+from ckanext.taxonomy import cache
+
+
+class TestSingleFlight(object):
+
+    def _start(self, target):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(target()))
+        thread.start()
+        return thread, result
+
+    def test_one_build_at_a_time(self):
+        started, release = threading.Event(), threading.Event()
+        builds = []
+
+        def build():
+            builds.append(1)
+            started.set()
+            release.wait(5)
+            return 'built'
+
+        def get():
+            return cache.get_derived('flight', 'test', build)
+
+        first, first_result = self._start(get)
+        started.wait(5)
+        second, second_result = self._start(get)
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        assert builds == [1], builds
+        assert first_result == ['built'], first_result
+        assert second_result == ['built'], second_result
+
+    def test_previous_version_while_building(self):
+        assert cache.get_derived('stale', 'test', lambda: 'old') == 'old'
+        cache.invalidate('stale')
+
+        started, release = threading.Event(), threading.Event()
+
+        def build():
+            started.set()
+            release.wait(5)
+            return 'new'
+
+        first, first_result = self._start(
+            lambda: cache.get_derived('stale', 'test', build))
+        started.wait(5)
+        # Served the old copy rather than waiting for the new one
+        assert cache.get_derived('stale', 'test', build) == 'old'
+        release.set()
+        first.join(5)
+
+        assert first_result == ['new'], first_result
+        assert cache.get_derived('stale', 'test', build) == 'new'
+
+    def test_previous_of_another_snapshot(self):
+        snapshot = cache.TaxonomySnapshot('positions', 0, [])
+        assert cache.get_derived('positions', 'test', lambda: 'old',
+                                 snapshot=snapshot) == 'old'
+        cache.invalidate('positions')
+
+        newer = cache.TaxonomySnapshot('positions',
+                                       cache.version('positions'), [])
+        # Nothing else is building, so the copy is rebuilt for the newer
+        # snapshot, and the older one is only kept for its own snapshot
+        assert cache.get_derived('positions', 'test', lambda: 'new',
+                                 snapshot=newer) == 'new'
+        assert cache.get_derived('positions', 'test', lambda: 'rebuilt',
+                                 snapshot=snapshot) == 'rebuilt'
+
+    def test_errors_reach_waiters(self):
+        started, release = threading.Event(), threading.Event()
+
+        def build():
+            started.set()
+            release.wait(5)
+            raise ValueError('broken')
+
+        def get():
+            try:
+                return cache.get_derived('failing', 'test', build)
+            except ValueError as e:
+                return str(e)
+
+        first, first_result = self._start(get)
+        started.wait(5)
+        second, second_result = self._start(get)
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        assert first_result == ['broken'], first_result
+        assert second_result == ['broken'], second_result
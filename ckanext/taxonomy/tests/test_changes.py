@@ -0,0 +1,149 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy import changes, importer
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestKindOfChange(object):
+
+    def test_kinds(self):
+        before = {'id': 'a', 'label': 'A', 'parent_id': None}
+        assert changes.kind_of_change(before, dict(before)) is None
+        assert changes.kind_of_change(
+            before, dict(before, label='B')) == changes.UPDATE
+        assert changes.kind_of_change(
+            before, dict(before, label='B', parent_id='p')) == changes.MOVE
+
+    def test_changes_between(self):
+        before = {'a': {'id': 'a', 'uri': 'u:a', 'label': 'A'},
+                  'b': {'id': 'b', 'uri': 'u:b', 'label': 'B'}}
+        after = {'b': {'id': 'b', 'uri': 'u:b', 'label': 'Bee'},
+                 'c': {'id': 'c', 'uri': 'u:c', 'label': 'C'}}
+        rows = changes.changes_between('t', before, after)
+        actions = dict((row['term_id'], row['action']) for row in rows)
+        assert actions == {'a': changes.DELETE, 'b': changes.UPDATE,
+                           'c': changes.CREATE}, actions
+        tombstone = [row for row in rows if row['term_id'] == 'a'][0]
+        assert tombstone['term'] is None
+        assert tombstone['uri'] == 'u:a'
+        assert tombstone['taxonomy_id'] == 't'
+
+
+class TestChangesSince(TaxonomyTestCase):
+
+    def _changes(self, **kwargs):
+        return logic.get_action('taxonomy_changes_since')(
+            TestChangesSince.sysadmin_context, kwargs)
+
+    def _term(self, action, **data):
+        return logic.get_action('taxonomy_term_' + action)(
+            TestChangesSince.sysadmin_context, data)
+
+    def test_create_update_move_delete(self):
+        taxonomy_id = TestChangesSince.taxonomies[0]['id']
+        since = self._changes()['latest']
+
+        parent = self._term('create', label='Parent', taxonomy_id=taxonomy_id,
+                            uri='http://localhost.local/changes-parent')
+        child = self._term('create', label='Child', taxonomy_id=taxonomy_id,
+                           uri='http://localhost.local/changes-child')
+        child['label'] = 'Renamed'
+        self._term('update', **child)
+        child['parent_id'] = parent['id']
+        self._term('update', **child)
+        self._term('delete', id=parent['id'])
+
+        res = self._changes(since=since, taxonomy=taxonomy_id)
+        assert not res['more']
+        found = [(c['action'], c['term_id']) for c in res['changes']]
+        assert found[:4] == [
+            ('create', parent['id']), ('create', child['id']),
+            ('update', child['id']), ('move', child['id'])], found
+        # Deleting the parent deletes its child too, leaving tombstones
+        assert sorted(found[4:]) == sorted([
+            ('delete', parent['id']), ('delete', child['id'])]), found
+        assert res['changes'][3]['term']['parent_id'] == parent['id']
+        assert res['changes'][-1]['term'] is None
+        assert res['next'] == res['changes'][-1]['seq'] == res['latest']
+
+        seqs = [c['seq'] for c in res['changes']]
+        assert seqs == sorted(seqs) and seqs[0] > since
+
+    def test_paging(self):
+        taxonomy_id = TestChangesSince.taxonomies[0]['id']
+        since = self._changes()['latest']
+        ids = [self._term('create', label='Page %d' % i,
+                          taxonomy_id=taxonomy_id,
+                          uri='http://localhost.local/changes-page-%d' % i)
+               ['id'] for i in range(5)]
+
+        seen = []
+        while True:
+            res = self._changes(since=since, limit=2)
+            assert len(res['changes']) <= 2
+            seen.extend(c['term_id'] for c in res['changes'])
+            since = res['next']
+            if not res['more']:
+                break
+        assert seen == ids, seen
+        assert self._changes(since=since)['changes'] == []
+
+        for id in ids:
+            self._term('delete', id=id)
+
+    def test_reimport_logs_only_changes(self):
+        def term(name, label, parent=None):
+            return {'uri': 'http://localhost.local/reimport/' + name,
+                    'label': label,
+                    'parent_uri': parent and
+                    'http://localhost.local/reimport/' + parent}
+
+        taxonomy, _ = importer.replace_taxonomy(
+            'changes-reimport', 'Reimport', 'http://localhost.local/reimport',
+            [term('a', 'A'), term('b', 'B'), term('c', 'C')])
+        first = self._changes(taxonomy=taxonomy['id'])
+        assert [c['action'] for c in first['changes']] == ['create'] * 3
+        ids = dict((c['uri'].rsplit('/', 1)[1], c['term_id'])
+                   for c in first['changes'])
+
+        importer.replace_taxonomy(
+            'changes-reimport', 'Reimport', 'http://localhost.local/reimport',
+            [term('a', 'A'), term('c', 'See', 'a'), term('d', 'D')])
+        res = self._changes(since=first['next'], taxonomy=taxonomy['id'])
+        found = dict((c['uri'].rsplit('/', 1)[1], c) for c in res['changes'])
+        assert sorted(found) == ['b', 'c', 'd'], found
+        assert found['b']['action'] == 'delete'
+        assert found['c']['action'] == 'move'
+        assert found['d']['action'] == 'create'
+        # Terms still in the taxonomy keep their ids
+        assert found['c']['term_id'] == ids['c']
+        assert found['c']['term']['parent_id'] == ids['a']
+
+        logic.get_action('taxonomy_delete')(
+            TestChangesSince.sysadmin_context, {'id': taxonomy['id']})
+        # The taxonomy has gone, so its tombstones are among all changes
+        res = self._changes(since=res['next'])
+        deleted = sorted(c['term_id'] for c in res['changes']
+                         if c['taxonomy_id'] == taxonomy['id'] and
+                         c['action'] == 'delete')
+        assert deleted == sorted([ids['a'], ids['c'],
+                                  found['d']['term_id']]), deleted
+
+    def test_since_beyond_latest(self):
+        res = self._changes(taxonomy=TestChangesSince.taxonomies[0]['name'],
+                            since=10 ** 9)
+        assert res['changes'] == [] and res['next'] == 10 ** 9
+
+    @raises(logic.ValidationError)
+    def test_since_must_be_integer(self):
+        self._changes(since='yesterday')
+
+    @raises(logic.ValidationError)
+    def test_limit_must_be_positive(self):
+        self._changes(limit=0)
+
+    @raises(logic.ValidationError)
+    def test_since_must_not_be_negative(self):
+        self._changes(since=-1)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import io
+
+import rdflib
+from rdflib.namespace import SKOS
+
+import ckan.logic as logic
+
+from ckanext.taxonomy.export import export, load_json_lines
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestExport(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestExport, cls).setup_class()
+        create = logic.get_action('taxonomy_term_create')
+        taxonomy_id = cls.taxonomies[0]['id']
+        cls.top = create(cls.sysadmin_context, {
+            'label': u'Economy', 'uri': 'http://localhost.local/x/economy',
+            'taxonomy_id': taxonomy_id, 'description': 'Money "and" trade',
+            'extras': {'code': '01'}, 'lang': 'en',
+            'labels': [{'label': u'Économie', 'lang': 'fr'}],
+            'alt_labels': [u'Trade', {'label': u'Handel', 'lang': 'de'}]})
+        create(cls.sysadmin_context, {
+            'label': u'Tax', 'uri': 'http://localhost.local/x/tax',
+            'taxonomy_id': taxonomy_id, 'parent_id': cls.top['id'],
+            'hidden_labels': [u'Taxes']})
+
+    def _export(self, format):
+        output = io.StringIO()
+        count = export('taxonomy-one', output, format)
+        assert count == 2, count
+        return output.getvalue()
+
+    def test_json_lines_round_trip(self):
+        body = self._export('jsonl')
+        taxonomy, count = load_json_lines(body.splitlines(True),
+                                          name='taxonomy-copy')
+        assert count == 2, count
+
+        terms = logic.get_action('taxonomy_term_list')(
+            TestExport.empty_context, {'id': 'taxonomy-copy'})
+        by_uri = dict((t['uri'], t) for t in terms)
+        top = by_uri['http://localhost.local/x/economy']
+        assert top['extras'] == {'code': '01'}, top
+        assert top['description'] == 'Money "and" trade', top
+        assert by_uri['http://localhost.local/x/tax']['parent_id'] == \
+            top['id'], terms
+
+        res = logic.get_action('taxonomy_term_show')(
+            TestExport.empty_context, {'id': top['id'], 'lang': 'fr'})
+        assert res['label'] == u'Économie', res
+
+        copy = self._copy_export(taxonomy)
+        original = self._export('jsonl').splitlines()[1:]
+        assert [self._comparable(l) for l in copy] == \
+            sorted(self._comparable(l) for l in original)
+
+    def _copy_export(self, taxonomy):
+        output = io.StringIO()
+        export(taxonomy['name'], output, 'jsonl')
+        return sorted(output.getvalue().splitlines()[1:],
+                      key=self._comparable)
+
+    def _comparable(self, line):
+        import json
+        term = json.loads(line)
+        term.pop('id')
+        return json.dumps(term, sort_keys=True)
+
+    def test_turtle(self):
+        self._check_graph(self._export('turtle'), 'turtle')
+
+    def test_ntriples(self):
+        self._check_graph(self._export('nt'), 'nt')
+
+    def _check_graph(self, body, format):
+        graph = rdflib.Graph()
+        graph.parse(data=body, format=format)
+        economy = rdflib.URIRef('http://localhost.local/x/economy')
+        tax = rdflib.URIRef('http://localhost.local/x/tax')
+        labels = set(graph.objects(economy, SKOS.prefLabel))
+        assert labels == set([rdflib.Literal(u'Economy', lang='en'),
+                              rdflib.Literal(u'Économie', lang='fr')]), labels
+        assert (tax, SKOS.broader, economy) in graph
+        assert (tax, SKOS.hiddenLabel, rdflib.Literal(u'Taxes')) in graph
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+
+import ckan.model as model
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.fragments import Fragment, compress
+
+
+class TestFragments(object):
+
+    def test_compress_is_repeatable(self):
+        body = b'<ul><li>Economy</li></ul>' * 100
+        assert compress(body) == compress(body)
+        with gzip.GzipFile(fileobj=io.BytesIO(compress(body))) as f:
+            assert f.read() == body
+
+    def test_fragment_text(self):
+        fragment = Fragment(u'<li>Économie</li>', 'text/html', '"1"')
+        assert fragment.body == u'<li>Économie</li>'.encode('utf-8')
+        assert fragment.text == u'<li>Économie</li>'
+        assert len(fragment.gzipped) > 0
+
+    def test_derived_stamp(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return len(builds)
+
+        assert cache.get_derived('stamped', 'test', build, 1) == 1
+        assert cache.get_derived('stamped', 'test', build, 1) == 1
+        assert cache.get_derived('stamped', 'test', build, 2) == 2
+        cache.invalidate('stamped')
+        assert cache.get_derived('stamped', 'test', build, 2) == 3
+
+    def test_counts_version(self):
+        before = cache.counts_version('counted')
+        other = cache.counts_version('uncounted')
+        cache.counts_changed(['counted'])
+        # Nothing is stale until the change is committed
+        assert cache.counts_version('counted') == before
+        model.Session.commit()
+        assert cache.counts_version('counted') == before + 1
+        assert cache.counts_version('uncounted') == other
+
+    def test_counts_version_rolled_back(self):
+        before = cache.counts_version('counted')
+        cache.counts_changed(['counted'])
+        model.Session.rollback()
+        model.Session.commit()
+        assert cache.counts_version('counted') == before
+
+    def test_counts_from_another_process(self):
+        before = cache.counts_version('remote-counts')
+        cache.on_message({'counts': ['remote-counts'],
+                          'origin': 'elsewhere:1'})
+        assert cache.counts_version('remote-counts') == before + 1
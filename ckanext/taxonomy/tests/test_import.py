@@ -0,0 +1,267 @@
+import functools
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import ckan.logic as logic
+import ckan.model as model
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import importer
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class LocalJob(object):
+
+    def __init__(self, id, fn, kwargs):
+        self.id = id
+        self.fn = fn
+        self.kwargs = kwargs
+        self.meta = {}
+        self.status = 'queued'
+
+    def save_meta(self):
+        pass
+
+    def get_status(self):
+        return self.status
+
+
+class LocalQueue(object):
+    """
+    Stands in for CKAN's job queue, keeping jobs in memory until they are
+    run in the calling thread with run().
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.pending = []
+        self.running = None
+
+    def enqueue(self, fn, kwargs, title):
+        job = LocalJob(str(len(self.jobs) + 1), fn, kwargs)
+        self.jobs[job.id] = job
+        self.pending.append(job)
+        return job.id
+
+    def current_job(self):
+        return self.running
+
+    def fetch(self, job_id):
+        return self.jobs.get(job_id)
+
+    def run(self):
+        while self.pending:
+            job = self.running = self.pending.pop(0)
+            job.status = 'started'
+            try:
+                job.fn(**job.kwargs)
+                job.status = 'finished'
+            except Exception:
+                job.status = 'failed'
+            finally:
+                self.running = None
+
+
+class TestImport(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestImport, cls).setup_class()
+        cls.directory = tempfile.mkdtemp()
+        handler = functools.partial(SimpleHTTPRequestHandler,
+                                    directory=cls.directory)
+        cls.server = HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base_url = 'http://127.0.0.1:%d/' % cls.server.server_port
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.directory)
+        super(TestImport, cls).teardown_class()
+
+    def setup(self):
+        self.queue = LocalQueue()
+        importer.set_queue(self.queue)
+
+    def teardown(self):
+        importer.set_queue(importer.JobQueue())
+
+    def _publish(self, filename, terms):
+        with open(os.path.join(TestImport.directory, filename), 'w') as f:
+            f.write(json.dumps({'type': 'taxonomy', 'name': 'imported',
+                                'title': 'Imported',
+                                'uri': 'http://localhost.local/imported'}))
+            f.write('\n')
+            for term in terms:
+                f.write(json.dumps(dict(term, type='term')) + '\n')
+        return TestImport.base_url + filename
+
+    def _start(self, url):
+        return logic.get_action('taxonomy_import_start')(
+            TestImport.sysadmin_context, {'url': url, 'name': 'imported'})
+
+    def _status(self, job_id):
+        return logic.get_action('taxonomy_import_status')(
+            TestImport.sysadmin_context, {'id': job_id})
+
+    def test_import(self):
+        base = 'http://localhost.local/imported/'
+        url = self._publish('first.jsonl', [
+            # A child may come before its parent
+            {'uri': base + 'tax', 'label': 'Tax',
+             'parent_uri': base + 'economy'},
+            {'uri': base + 'economy', 'label': 'Economy',
+             'labels': [{'label': u'Economie', 'lang': 'fr'}],
+             'alt_labels': [{'label': 'Trade', 'lang': None}]},
+            {'uri': base + 'health', 'label': 'Health'},
+        ])
+        job = self._start(url)
+        status = self._status(job['id'])
+        assert status['phase'] == 'queued', status
+
+        self.queue.run()
+        status = self._status(job['id'])
+        assert status['status'] == 'finished', status
+        assert status['phase'] == 'finished', status
+        assert status['terms'] == 3, status
+        assert status['labels'] == 5, status
+        assert status['errors'] == [], status
+
+        terms = logic.get_action('taxonomy_term_list')(
+            TestImport.sysadmin_context, {'id': 'imported'})
+        by_uri = dict((t['uri'], t) for t in terms)
+        assert by_uri[base + 'tax']['parent_id'] == \
+            by_uri[base + 'economy']['id'], terms
+        matches = logic.get_action('taxonomy_term_lookup')(
+            TestImport.sysadmin_context,
+            {'labels': ['trade'], 'id': 'imported'})
+        assert matches['trade'][0]['uri'] == base + 'economy', matches
+
+        # Importing again replaces the terms, keeping the taxonomy
+        url = self._publish('second.jsonl', [
+            {'uri': base + 'health', 'label': 'Health'},
+            {'uri': base + 'orphan', 'label': 'Orphan',
+             'parent_uri': base + 'missing'},
+            {'label': 'No uri'},
+        ])
+        job = self._start(url)
+        self.queue.run()
+        status = self._status(job['id'])
+        assert status['phase'] == 'finished', status
+        assert status['terms'] == 2, status
+        assert len(status['errors']) == 2, status
+        assert status['taxonomy_id'] == terms[0]['taxonomy_id'], status
+
+        terms = logic.get_action('taxonomy_term_list')(
+            TestImport.sysadmin_context, {'id': 'imported'})
+        assert sorted(t['label'] for t in terms) == ['Health', 'Orphan']
+
+    def test_reimport_refreshes_usage(self):
+        from ckanext.taxonomy import cache
+        from ckanext.taxonomy.models import TaxonomyTermPackage
+
+        base = 'http://localhost.local/reimported/'
+
+        def term(name, parent=None):
+            return {'uri': base + name, 'label': name.capitalize(),
+                    'parent_uri': parent and base + parent}
+
+        def dataset(name, uri):
+            return logic.get_action('package_create')(
+                TestImport.sysadmin_context,
+                {'name': name, 'extras': [{'key': 'theme', 'value': uri}]})
+
+        def counts():
+            terms = logic.get_action('taxonomy_term_list')(
+                TestImport.sysadmin_context,
+                {'id': 'reimported', 'include_counts': True})
+            return dict((t['label'],
+                         (t['dataset_count'], t['dataset_count_rollup']))
+                        for t in terms)
+
+        taxonomy, _ = importer.replace_taxonomy(
+            'reimported', 'Reimported', base,
+            [term('top'), term('dropped', 'top'), term('kept', 'top')])
+        dropped = dataset('reimport-dropped', base + 'dropped')
+        added = dataset('reimport-added', base + 'added')
+        assert counts() == {'Top': (0, 1), 'Dropped': (1, 1),
+                            'Kept': (0, 0)}, counts()
+
+        # Have this process hold the snapshot of the old terms
+        cache.get_snapshot(taxonomy['id'])
+
+        importer.replace_taxonomy(
+            'reimported', 'Reimported', base,
+            [term('top'), term('kept', 'top'), term('added', 'kept')])
+
+        def used(package_id):
+            return model.Session.query(TaxonomyTermPackage)\
+                .filter(TaxonomyTermPackage.package_id == package_id)\
+                .count()
+        assert used(dropped['id']) == 0
+        assert used(added['id']) == 1
+        assert counts() == {'Top': (0, 1), 'Kept': (0, 1),
+                            'Added': (1, 1)}, counts()
+
+        for pkg in (dropped, added):
+            logic.get_action('package_delete')(
+                TestImport.sysadmin_context, {'id': pkg['id']})
+        logic.get_action('taxonomy_delete')(
+            TestImport.sysadmin_context, {'id': taxonomy['id']})
+
+    def test_failed_import(self):
+        job = self._start(TestImport.base_url + 'missing.jsonl')
+        self.queue.run()
+        status = self._status(job['id'])
+        assert status['status'] == 'failed', status
+        assert status['phase'] == 'failed', status
+        assert status['errors'], status
+
+    def test_source_closed(self):
+        path = os.path.join(TestImport.directory, 'closed.jsonl')
+        with open(path, 'w') as f:
+            f.write('\n')
+        with importer._open_lines(path) as lines:
+            assert not lines.closed
+        assert lines.closed
+
+    def test_stalled_server(self):
+        import requests
+        # Accepts connections but never answers them
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        toolkit.config['ckanext.taxonomy.import.timeout'] = '0.5'
+        try:
+            with importer._open_lines('http://127.0.0.1:%d/stalled.jsonl'
+                                      % server.getsockname()[1]):
+                assert False, 'The server answered'
+        except requests.exceptions.Timeout:
+            pass
+        finally:
+            del toolkit.config['ckanext.taxonomy.import.timeout']
+            server.close()
+
+    @raises(logic.ValidationError)
+    def test_url_scheme(self):
+        self._start('file:///etc/passwd')
+
+    @raises(logic.NotFound)
+    def test_unknown_job(self):
+        self._status('missing')
+
+    @raises(logic.NotAuthorized)
+    def test_sysadmin_only(self):
+        logic.check_access('taxonomy_import_start',
+                           TestImport.normal_context, {})
@@ -0,0 +1,67 @@
+import json
+
+import ckan.logic as logic
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.indexing import (index_package, parse_term_uris,
+                                       URIS_FIELD, LABELS_FIELD)
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestIndexing(TaxonomyTestCase):
+
+    def _create_term(self, label, parent_id=None):
+        return logic.get_action('taxonomy_term_create')(
+            TestIndexing.sysadmin_context,
+            {'label': label,
+             'uri': 'http://localhost.local/index/%s' % label,
+             'taxonomy_id': TestIndexing.taxonomies[0]['id'],
+             'parent_id': parent_id})
+
+    def test_parse_term_uris(self):
+        assert parse_term_uris(None) == []
+        assert parse_term_uris('http://a') == ['http://a']
+        assert parse_term_uris(json.dumps(['http://a', 'http://b'])) == \
+            ['http://a', 'http://b']
+        assert parse_term_uris(['http://a']) == ['http://a']
+
+    def test_snapshot_ancestors(self):
+        rows = [('1', None, 'u1', 'one'),
+                ('2', '1', 'u2', 'two'),
+                ('3', '2', 'u3', 'three')]
+        snapshot = cache.TaxonomySnapshot('tx', 0, rows)
+        i = snapshot.index_of('u3')
+        assert [snapshot.uris[j] for j in snapshot.ancestors(i)] == \
+            ['u2', 'u1']
+        assert snapshot.ancestors(snapshot.index_of('1')) == []
+
+    def test_snapshot_cycle(self):
+        rows = [('1', '2', 'u1', 'one'),
+                ('2', '1', 'u2', 'two')]
+        snapshot = cache.TaxonomySnapshot('tx', 0, rows)
+        assert len(snapshot.ancestors(0)) == 2
+
+    def test_index_package(self):
+        top = self._create_term('economy')
+        middle = self._create_term('trade', top['id'])
+        leaf = self._create_term('exports', middle['id'])
+
+        pkg_dict = index_package({'extras_theme': json.dumps([leaf['uri']])})
+        assert pkg_dict[URIS_FIELD] == \
+            [leaf['uri'], middle['uri'], top['uri']], pkg_dict
+        assert pkg_dict[LABELS_FIELD] == \
+            ['exports', 'trade', 'economy'], pkg_dict
+
+        # Relabelling a term must not leave the cached parent map stale
+        top['label'] = 'economics'
+        logic.get_action('taxonomy_term_update')(
+            TestIndexing.sysadmin_context, top)
+        pkg_dict = index_package({'theme': leaf['uri']})
+        assert pkg_dict[LABELS_FIELD][-1] == 'economics', pkg_dict
+
+        logic.get_action('taxonomy_term_delete')(
+            TestIndexing.sysadmin_context, {'id': top['id']})
+
+    def test_index_package_unknown_term(self):
+        pkg_dict = index_package({'theme': 'http://localhost.local/none'})
+        assert URIS_FIELD not in pkg_dict, pkg_dict
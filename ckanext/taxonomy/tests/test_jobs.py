@@ -0,0 +1,36 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.jobs import affected_packages
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestReindexJob(TaxonomyTestCase):
+
+    def _create_term(self, label, parent_id=None):
+        return logic.get_action('taxonomy_term_create')(
+            TestReindexJob.sysadmin_context,
+            {'label': label,
+             'uri': 'http://localhost.local/jobs/%s' % label,
+             'taxonomy_id': TestReindexJob.taxonomies[0]['id'],
+             'parent_id': parent_id})
+
+    def _create_package(self, name, term):
+        return logic.get_action('package_create')(
+            dict(TestReindexJob.sysadmin_context),
+            {'name': name,
+             'extras': [{'key': 'theme', 'value': term['uri']}]})
+
+    def test_affected_packages(self):
+        top = self._create_term('top')
+        child = self._create_term('child', top['id'])
+        other = self._create_term('other')
+
+        under_top = self._create_package('jobs-top', top)
+        under_child = self._create_package('jobs-child', child)
+        self._create_package('jobs-other', other)
+
+        # Changing a term affects datasets using anything beneath it
+        assert affected_packages([top['id']]) == \
+            set([under_top['id'], under_child['id']])
+        assert affected_packages([child['id']]) == set([under_child['id']])
+        assert affected_packages([]) == set()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import ckan.logic as logic
+
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestLanguages(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestLanguages, cls).setup_class()
+        cls.term = logic.get_action('taxonomy_term_create')(
+            cls.sysadmin_context,
+            {'label': u'Economy',
+             'uri': 'http://localhost.local/languages/economy',
+             'taxonomy_id': cls.taxonomies[0]['id'],
+             'lang': 'en',
+             'labels': [{'label': u'Économie', 'language': 'fr'},
+                        {'label': u'Wirtschaft', 'lang': 'de'}],
+             'alt_labels': [{'label': u'Volkswirtschaft', 'lang': 'de'}]})
+
+    def test_show_in_language(self):
+        res = logic.get_action('taxonomy_term_show')(
+            TestLanguages.empty_context,
+            {'id': TestLanguages.term['id'], 'lang': 'fr'})
+        assert res['label'] == u'Économie', res
+
+    def test_regional_language_falls_back(self):
+        res = logic.get_action('taxonomy_term_show')(
+            TestLanguages.empty_context,
+            {'id': TestLanguages.term['id'], 'language': 'de-AT'})
+        assert res['label'] == u'Wirtschaft', res
+
+    def test_missing_language_falls_back(self):
+        res = logic.get_action('taxonomy_term_show')(
+            TestLanguages.empty_context,
+            {'id': TestLanguages.term['id'], 'lang': 'es'})
+        assert res['label'] == u'Economy', res
+
+    def test_list_in_language(self):
+        res = logic.get_action('taxonomy_term_list')(
+            TestLanguages.empty_context,
+            {'id': TestLanguages.taxonomies[0]['id'], 'lang': 'fr'})
+        labels = [t['label'] for t in res
+                  if t['id'] == TestLanguages.term['id']]
+        assert labels == [u'Économie'], res
+
+    def test_autocomplete_in_language(self):
+        res = logic.get_action('taxonomy_term_autocomplete')(
+            TestLanguages.empty_context,
+            {'q': u'volks', 'lang': 'de',
+             'taxonomy': TestLanguages.taxonomies[0]['name']})
+        assert [t['label'] for t in res] == [u'Wirtschaft'], res
+
+        res = logic.get_action('taxonomy_term_autocomplete')(
+            TestLanguages.empty_context,
+            {'q': u'volks', 'lang': 'fr',
+             'taxonomy': TestLanguages.taxonomies[0]['name']})
+        assert res == [], res
+
+    def test_update_keeps_translations(self):
+        term = dict(TestLanguages.term, label=u'Economics')
+        logic.get_action('taxonomy_term_update')(
+            TestLanguages.sysadmin_context, term)
+        res = logic.get_action('taxonomy_term_show')(
+            TestLanguages.empty_context,
+            {'id': TestLanguages.term['id'], 'lang': 'fr'})
+        assert res['label'] == u'Économie', res
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+
+import ckan.logic as logic
+
+from ckanext.taxonomy.lib import load_terms_and_extras
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestLoadTermsAndExtras(TaxonomyTestCase):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _load(self, terms):
+        path = os.path.join(self.directory, 'themes.json')
+        with open(path, 'w') as f:
+            json.dump(terms, f)
+        load_terms_and_extras(
+            path, TestLoadTermsAndExtras.taxonomies[1]['name'])
+
+    def _terms(self):
+        terms = logic.get_action('taxonomy_term_list')(
+            TestLoadTermsAndExtras.sysadmin_context,
+            {'id': TestLoadTermsAndExtras.taxonomies[1]['id']})
+        return dict((t['label'], t) for t in terms)
+
+    def test_title_of_a_synonym(self):
+        term = logic.get_action('taxonomy_term_create')(
+            TestLoadTermsAndExtras.sysadmin_context,
+            {'label': u'Water supply',
+             'uri': 'http://localhost.local/lib/water',
+             'taxonomy_id': TestLoadTermsAndExtras.taxonomies[1]['id'],
+             'alt_labels': [u'Rivers']})
+
+        self._load([{'title': u'Rivers', 'stored_as': 'rivers',
+                     'colour': 'blue'}])
+        terms = self._terms()
+        # The term with the synonym is left alone
+        assert terms[u'Water supply']['id'] == term['id'], terms
+        assert terms[u'Water supply']['uri'] == term['uri'], terms
+        assert terms[u'Rivers']['id'] != term['id'], terms
+        assert terms[u'Rivers']['uri'] == \
+            'http://data.gov.uk/data/theme/rivers', terms
+
+        # Loading again updates the term made the first time
+        self._load([{'title': u'Rivers', 'stored_as': 'rivers',
+                     'colour': 'green'}])
+        again = self._terms()
+        assert again[u'Rivers']['id'] == terms[u'Rivers']['id'], again
+        assert again[u'Rivers']['extras'] == {'colour': 'green'}, again
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import ckan.logic as logic
+
+from ckanext.taxonomy import importer
+from ckanext.taxonomy.locks import TaxonomyLocked, taxonomy_lock
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestLocks(TaxonomyTestCase):
+
+    @raises(TaxonomyLocked)
+    def test_fail(self):
+        with taxonomy_lock('locked'):
+            with taxonomy_lock('locked', policy='fail'):
+                pass
+
+    @raises(TaxonomyLocked)
+    def test_timeout(self):
+        with taxonomy_lock('locked'):
+            with taxonomy_lock('locked', policy='wait', timeout=1):
+                pass
+
+    def test_separate_taxonomies(self):
+        with taxonomy_lock('one'):
+            with taxonomy_lock('two', policy='fail'):
+                pass
+        # Released again afterwards
+        with taxonomy_lock('one', policy='fail'):
+            pass
+
+    def test_wait(self):
+        acquired = threading.Event()
+        order = []
+
+        def hold():
+            with taxonomy_lock('waited'):
+                acquired.set()
+                time.sleep(1)
+                order.append('first')
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        with taxonomy_lock('waited', policy='wait', timeout=10):
+            order.append('second')
+        thread.join(5)
+        assert order == ['first', 'second'], order
+
+    def test_import_while_locked(self):
+        taxonomy = TestLocks.taxonomies[0]
+        term = logic.get_action('taxonomy_term_create')(
+            TestLocks.sysadmin_context,
+            {'label': 'Kept', 'uri': 'http://localhost.local/locks/kept',
+             'taxonomy_id': taxonomy['id']})
+
+        with taxonomy_lock(taxonomy['name']):
+            try:
+                importer.replace_taxonomy(
+                    taxonomy['name'], None, taxonomy['uri'],
+                    iter([{'uri': 'http://localhost.local/locks/new',
+                           'label': 'New'}]),
+                    lock_policy='fail')
+            except TaxonomyLocked:
+                pass
+            else:
+                assert False, 'The import should not have run'
+
+        terms = logic.get_action('taxonomy_term_list')(
+            TestLocks.sysadmin_context, {'id': taxonomy['id']})
+        assert term['id'] in [t['id'] for t in terms], terms
@@ -0,0 +1,79 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.labels import normalise
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestTermLookup(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestTermLookup, cls).setup_class()
+        cls.term = logic.get_action('taxonomy_term_create')(
+            cls.sysadmin_context,
+            {'label': u'Économie',
+             'uri': 'http://localhost.local/lookup/economy',
+             'taxonomy_id': cls.taxonomies[0]['id'],
+             'alt_labels': [u'Economy', {'label': u'Wirtschaft',
+                                         'lang': 'de'}],
+             'hidden_labels': [u'Econmy']})
+
+    def test_normalise(self):
+        assert normalise(u'  Économie  Sociale ') == u'economie sociale'
+        assert normalise(None) == u''
+
+    def test_lookup_exact(self):
+        res = logic.get_action('taxonomy_term_lookup')(
+            TestTermLookup.empty_context,
+            {'labels': [u'Économie', u'Econmy', u'economie', u'missing'],
+             'match': 'exact'})
+        assert res[u'Économie'][0]['id'] == TestTermLookup.term['id'], res
+        assert res[u'Économie'][0]['label_kind'] == 'pref', res
+        assert res[u'Econmy'][0]['label_kind'] == 'hidden', res
+        assert res[u'economie'] == [], res
+        assert res[u'missing'] == [], res
+
+    def test_lookup_normalised(self):
+        res = logic.get_action('taxonomy_term_lookup')(
+            TestTermLookup.empty_context,
+            {'labels': [u'ECONOMIE', u'wirtschaft'],
+             'id': TestTermLookup.taxonomies[0]['name']})
+        assert res[u'ECONOMIE'][0]['match'] == 'normalised', res
+        assert res[u'ECONOMIE'][0]['id'] == TestTermLookup.term['id'], res
+        assert res[u'wirtschaft'][0]['matched_label'] == u'Wirtschaft', res
+
+    def test_lookup_other_taxonomy(self):
+        res = logic.get_action('taxonomy_term_lookup')(
+            TestTermLookup.empty_context,
+            {'labels': [u'Economy'],
+             'id': TestTermLookup.taxonomies[1]['id']})
+        assert res[u'Economy'] == [], res
+
+    def test_lookup_after_rename(self):
+        # A term of its own, so the other tests still find the shared one
+        term = logic.get_action('taxonomy_term_create')(
+            TestTermLookup.sysadmin_context,
+            {'label': u'Agriculture',
+             'uri': 'http://localhost.local/lookup/agriculture',
+             'taxonomy_id': TestTermLookup.taxonomies[0]['id'],
+             'alt_labels': [u'Farming']})
+        logic.get_action('taxonomy_term_update')(
+            TestTermLookup.sysadmin_context,
+            dict(term, label=u'Agronomy'))
+        res = logic.get_action('taxonomy_term_lookup')(
+            TestTermLookup.empty_context,
+            {'labels': [u'Agronomy', u'Agriculture', u'Farming']})
+        assert res[u'Agronomy'], res
+        assert res[u'Agriculture'] == [], res
+        # Synonyms are kept when they aren't part of the update
+        assert res[u'Farming'], res
+
+        logic.get_action('taxonomy_term_delete')(
+            TestTermLookup.sysadmin_context, {'id': term['id']})
+
+    @raises(logic.ValidationError)
+    def test_lookup_no_labels(self):
+        logic.get_action('taxonomy_term_lookup')(
+            TestTermLookup.empty_context, {})
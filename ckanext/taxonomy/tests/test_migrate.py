@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+import tempfile
+
+import ckan.logic as logic
+
+from ckanext.taxonomy import migrate
+from ckanext.taxonomy.migrate import migrate_package
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+MAPPING = {
+    (None, 'rail'): ['http://localhost.local/transport/rail'],
+    (None, 'trains'): ['http://localhost.local/transport/rail'],
+    ('vocab-1', 'road'): ['http://localhost.local/transport/road'],
+}
+
+
+class TestMigratePackage(object):
+
+    def test_free_tags(self):
+        pkg = {'tags': [{'name': 'rail'}, {'name': 'trains'},
+                        {'name': 'other'}],
+               'extras': []}
+        res = migrate_package(pkg, MAPPING, 'theme')
+        assert res['tags'] == [{'name': 'other'}], res
+        assert res['extras'] == [{
+            'key': 'theme',
+            'value': json.dumps(['http://localhost.local/transport/rail'])}]
+
+    def test_vocabulary_tags(self):
+        pkg = {'tags': [{'name': 'road', 'vocabulary_id': 'vocab-1'},
+                        {'name': 'road'}]}
+        res = migrate_package(pkg, MAPPING, 'theme')
+        assert res['tags'] == [{'name': 'road'}], res
+
+    def test_existing_terms_kept(self):
+        pkg = {'tags': [{'name': 'rail'}],
+               'theme': json.dumps(['http://localhost.local/other'])}
+        res = migrate_package(pkg, MAPPING, 'theme', keep_tags=True)
+        assert res['tags'] == [{'name': 'rail'}], res
+        assert json.loads(res['theme']) == [
+            'http://localhost.local/other',
+            'http://localhost.local/transport/rail'], res
+
+    def test_unchanged(self):
+        assert migrate_package({'tags': [{'name': 'other'}]},
+                               MAPPING, 'theme') is None
+        # Running again over a migrated dataset changes nothing
+        pkg = {'tags': [{'name': 'rail'}],
+               'theme': json.dumps(['http://localhost.local/transport/rail'])}
+        assert migrate_package(pkg, MAPPING, 'theme', keep_tags=True) is None
+
+
+class TestMigrateTags(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestMigrateTags, cls).setup_class()
+        context = dict(cls.sysadmin_context)
+        vocabulary = logic.get_action('vocabulary_create')(
+            context, {'name': 'migrate-vocabulary',
+                      'tags': [{'name': 'road'}]})
+        road = {'name': 'road', 'vocabulary_id': vocabulary['id']}
+        cls.mapping = {
+            (None, 'rail'): ['http://localhost.local/transport/rail'],
+            (vocabulary['id'], 'road'):
+                ['http://localhost.local/transport/road'],
+        }
+        # Some datasets match the queries of both free and vocabulary
+        # tags, and some match neither
+        tags = [[{'name': 'rail'}], [road], [{'name': 'rail'}, road],
+                [{'name': 'other'}]]
+        cls.ids = []
+        cls.mapped = []
+        for i in range(9):
+            pkg = logic.get_action('package_create')(
+                dict(cls.sysadmin_context),
+                {'name': 'migrate-%d' % i, 'tags': tags[i % len(tags)]})
+            cls.ids.append(pkg['id'])
+            if i % len(tags) != 3:
+                cls.mapped.append(pkg['id'])
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'checkpoint.json')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pages_visit_each_dataset_once(self):
+        for page_size in (1, 2, 4, 100):
+            pages = list(migrate._package_pages(
+                TestMigrateTags.mapping, page_size, None))
+            assert all(0 < len(page) <= page_size for page in pages), pages
+            visited = [id for page in pages for id in page]
+            assert visited == sorted(TestMigrateTags.mapped), \
+                (page_size, visited)
+
+        # Carrying on after a dataset visits only those after it
+        after = sorted(TestMigrateTags.mapped)[2]
+        pages = list(migrate._package_pages(TestMigrateTags.mapping, 2,
+                                            after))
+        assert [id for page in pages for id in page] == \
+            sorted(TestMigrateTags.mapped)[3:], pages
+
+    def test_resume_after_interruption(self):
+        calls = []
+        original = migrate._migrate_page
+
+        def interrupted(package_ids, *args):
+            calls.append(package_ids)
+            if len(calls) == 3:
+                raise RuntimeError('Interrupted')
+            return original(package_ids, *args)
+
+        migrate._migrate_page = interrupted
+        try:
+            migrate.migrate_tags(TestMigrateTags.mapping, field='theme',
+                                 page_size=2, workers=1,
+                                 checkpoint_path=self.checkpoint,
+                                 user='sysadmin')
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'The run was not interrupted'
+        finally:
+            migrate._migrate_page = original
+
+        checkpoint = migrate.read_checkpoint(self.checkpoint)
+        # Only the pages before the interrupted one are recorded
+        assert checkpoint['last_id'] == calls[1][-1], checkpoint
+        assert checkpoint['visited'] == 4, checkpoint
+        assert checkpoint['changed'] == 4, checkpoint
+        done = set(calls[0] + calls[1])
+
+        resumed = []
+
+        def recording(package_ids, *args):
+            resumed.append(package_ids)
+            return original(package_ids, *args)
+
+        migrate._migrate_page = recording
+        try:
+            result = migrate.migrate_tags(
+                TestMigrateTags.mapping, field='theme', page_size=2,
+                workers=1, checkpoint_path=self.checkpoint, user='sysadmin')
+        finally:
+            migrate._migrate_page = original
+
+        visited = [id for page in resumed for id in page]
+        assert not done.intersection(visited), (done, visited)
+        assert result['visited'] == len(TestMigrateTags.mapped), result
+
+        for id in TestMigrateTags.ids:
+            pkg = logic.get_action('package_show')(
+                dict(TestMigrateTags.sysadmin_context), {'id': id})
+            names = [t['name'] for t in pkg['tags']]
+            extras = dict((e['key'], e['value']) for e in pkg['extras'])
+            if id not in TestMigrateTags.mapped:
+                assert names == ['other'] and 'theme' not in extras, pkg
+                continue
+            assert names == [], pkg
+            # Each term was added once, however often the page was visited
+            uris = json.loads(extras['theme'])
+            assert len(uris) == len(set(uris)) > 0, uris
@@ -0,0 +1,122 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestMoveTerm(TaxonomyTestCase):
+
+    def _context(self):
+        return dict(TestMoveTerm.sysadmin_context)
+
+    def _create(self, label, parent=None):
+        return logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': label,
+             'uri': 'http://localhost.local/move/%s' % label,
+             'taxonomy_id': TestMoveTerm.taxonomies[1]['id'],
+             'parent_id': parent and parent['id']})
+
+    def _move(self, term, parent):
+        return logic.get_action('taxonomy_term_move')(
+            self._context(),
+            {'id': term['id'], 'parent_id': parent and parent['id']})
+
+    def _counts(self):
+        terms = logic.get_action('taxonomy_term_list')(
+            self._context(),
+            {'id': TestMoveTerm.taxonomies[1]['id'], 'include_counts': True})
+        return dict((t['label'],
+                     (t['dataset_count'], t['dataset_count_rollup']))
+                    for t in terms if t['uri'].startswith(
+                        'http://localhost.local/move/'))
+
+    def setup(self):
+        self.a = self._create('a')
+        self.b = self._create('b')
+        self.branch = self._create('branch', self.a)
+        self.leaf = self._create('leaf', self.branch)
+        self.other = self._create('other', self.a)
+
+    def teardown(self):
+        for term in (self.a, self.b):
+            logic.get_action('taxonomy_term_delete')(
+                self._context(), {'id': term['id']})
+
+    def test_move_branch(self):
+        moved = self._move(self.branch, self.b)
+        assert moved['parent_id'] == self.b['id'], moved
+
+        tree = logic.get_action('taxonomy_term_tree')(
+            self._context(), {'id': TestMoveTerm.taxonomies[1]['id']})
+        b = [t for t in tree if t['id'] == self.b['id']][0]
+        assert [t['id'] for t in b['children']] == [self.branch['id']]
+        assert [t['id'] for t in b['children'][0]['children']] == \
+            [self.leaf['id']]
+
+        self._move(self.branch, None)
+        term = logic.get_action('taxonomy_term_show')(
+            self._context(), {'id': self.branch['id']})
+        assert term['parent_id'] is None, term
+
+    def test_counts_follow_the_branch(self):
+        for name, uris in (('move-leaf', [self.leaf['uri']]),
+                           ('move-both', [self.leaf['uri'],
+                                          self.other['uri']])):
+            logic.get_action('package_create')(
+                self._context(),
+                {'name': name,
+                 'extras': [{'key': 'theme',
+                             'value': '["%s"]' % '", "'.join(uris)}]})
+        assert self._counts() == {
+            'a': (0, 2), 'b': (0, 0), 'branch': (0, 2), 'leaf': (2, 2),
+            'other': (1, 1)}, self._counts()
+
+        self._move(self.branch, self.b)
+        # The dataset also using 'other' still counts towards 'a'
+        assert self._counts() == {
+            'a': (0, 1), 'b': (0, 2), 'branch': (0, 2), 'leaf': (2, 2),
+            'other': (1, 1)}, self._counts()
+
+        for name in ('move-leaf', 'move-both'):
+            logic.get_action('package_delete')(self._context(), {'id': name})
+
+    @raises(logic.ValidationError)
+    def test_cannot_move_beneath_itself(self):
+        self._move(self.branch, self.leaf)
+
+    @raises(logic.ValidationError)
+    def test_cannot_move_to_itself(self):
+        self._move(self.branch, self.branch)
+
+    @raises(logic.ValidationError)
+    def test_update_cannot_make_a_cycle(self):
+        a = dict(self.a, parent_id=self.leaf['id'])
+        logic.get_action('taxonomy_term_update')(self._context(), a)
+
+    @raises(logic.ValidationError)
+    def test_parent_in_another_taxonomy(self):
+        other = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'elsewhere',
+             'uri': 'http://localhost.local/move-elsewhere',
+             'taxonomy_id': TestMoveTerm.taxonomies[0]['id']})
+        try:
+            self._move(self.branch, other)
+        finally:
+            logic.get_action('taxonomy_term_delete')(
+                self._context(), {'id': other['id']})
+
+    @raises(logic.NotFound)
+    def test_unknown_term(self):
+        self._move({'id': 'made-up'}, None)
+
+    def test_move_is_logged(self):
+        since = logic.get_action('taxonomy_changes_since')(
+            self._context(), {})['latest']
+        self._move(self.branch, self.b)
+        res = logic.get_action('taxonomy_changes_since')(
+            self._context(), {'since': since})
+        assert [(c['action'], c['term_id']) for c in res['changes']] == \
+            [('move', self.branch['id'])], res
@@ -0,0 +1,61 @@
+import threading
+
+import ckan.logic as logic
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache, preload
+from ckanext.taxonomy.plugin import TaxonomyPlugin
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestPreload(TaxonomyTestCase):
+
+    def test_preload(self):
+        taxonomy = TestPreload.taxonomies[0]
+        logic.get_action('taxonomy_term_create')(
+            TestPreload.sysadmin_context,
+            {'label': 'Economy', 'uri': 'http://localhost.local/preload/e',
+             'taxonomy_id': taxonomy['id']})
+        cache.invalidate()
+
+        thread = preload.start([taxonomy['name'], 'missing'])
+        # Requests made while preloading are still answered
+        terms = logic.get_action('taxonomy_term_autocomplete')(
+            TestPreload.sysadmin_context,
+            {'q': 'eco', 'taxonomy': taxonomy['name']})
+        assert [t['label'] for t in terms] == ['Economy'], terms
+        thread.join(10)
+
+        status = logic.get_action('taxonomy_preload_status')(
+            TestPreload.sysadmin_context, {})
+        assert status['ready'], status
+        assert status['finished'], status
+        state = status['taxonomies'][taxonomy['id']]
+        assert state == {'state': preload.LOADED, 'terms': 1}, state
+        assert status['taxonomies']['missing']['state'] == preload.FAILED
+
+    def test_first_request_starts_preloading(self):
+        taxonomy = TestPreload.taxonomies[0]
+        toolkit.config['ckanext.taxonomy.preload'] = taxonomy['name']
+        preload._started_in = None
+        try:
+            # Only requests start preloading, so commands and background
+            # jobs never do
+            app = TaxonomyPlugin().make_middleware(
+                lambda environ, start_response: ['ok'], {})
+            assert app({}, None) == ['ok']
+            assert preload._started_in is not None
+            for thread in threading.enumerate():
+                if thread.name == 'taxonomy-preload':
+                    thread.join(10)
+            assert preload.status()['ready'], preload.status()
+            # Nothing is started again for later requests
+            assert preload.request_started() is None
+        finally:
+            del toolkit.config['ckanext.taxonomy.preload']
+
+    def test_not_enabled(self):
+        status = logic.get_action('taxonomy_preload_status')(
+            TestPreload.sysadmin_context, {})
+        assert not status['enabled'], status
+        assert status['ready'], status
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+
+from ckanext.taxonomy.publish import taxonomy_files, write_files
+
+
+TERMS = [
+    {'id': 'a', 'label': 'Economy', 'uri': 'http://x/a', 'parent_id': None,
+     'description': '', 'extras': ''},
+    {'id': 'b', 'label': 'Trade', 'uri': 'http://x/b', 'parent_id': 'a',
+     'description': '', 'extras': ''},
+    {'id': 'c', 'label': 'Agriculture', 'uri': 'http://x/c',
+     'parent_id': 'a', 'description': '', 'extras': ''},
+]
+
+
+class TestPublish(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_taxonomy_files(self):
+        files = taxonomy_files(TERMS)
+        assert sorted(files) == ['children/a.json', 'children/root.json',
+                                 'terms.json', 'tree.json'], files
+
+        tree = json.loads(files['tree.json'].decode('utf-8'))
+        assert [t['label'] for t in tree[0]['children']] == \
+            ['Agriculture', 'Trade'], tree
+        root = json.loads(files['children/root.json'].decode('utf-8'))
+        assert root[0]['has_children'] is True, root
+        assert 'extras' not in root[0], root
+
+    def test_only_changes_written(self):
+        manifest, written, removed = write_files(self.directory,
+                                                 taxonomy_files(TERMS))
+        assert (written, removed) == (4, 0)
+        assert os.path.exists(os.path.join(self.directory, 'tree.json.gz'))
+
+        again, written, removed = write_files(self.directory,
+                                              taxonomy_files(TERMS))
+        assert (written, removed) == (0, 0)
+        assert again['version'] == manifest['version']
+
+        # Losing the only child of a term removes its children file
+        terms = [t for t in TERMS if t['parent_id'] is None]
+        changed, written, removed = write_files(self.directory,
+                                                taxonomy_files(terms))
+        assert (written, removed) == (3, 1), (written, removed)
+        assert changed['version'] != manifest['version']
+        assert not os.path.exists(
+            os.path.join(self.directory, 'children', 'a.json.gz'))
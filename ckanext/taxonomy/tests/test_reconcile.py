@@ -0,0 +1,66 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.reconcile import NgramIndex, ngrams
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestNgramIndex(object):
+
+    def test_ngrams(self):
+        assert ngrams(u'Ab') == set([u' ab', u'ab '])
+        assert ngrams(u'') == set([])
+
+    def test_match(self):
+        index = NgramIndex([(u'Environment', 1),
+                            (u'Environmental protection', 2),
+                            (u'Government', 3),
+                            (u'Climate', 4),
+                            (u'Climate change', 4)])
+        res = index.match(u'enviroment')
+        assert res[0][0] == 1, res
+        assert [r[0] for r in res] == [1, 2, 3][:len(res)], res
+
+        res = index.match(u'CLIMATE')
+        assert res[0] == (4, u'Climate', res[0][2]), res
+        assert abs(res[0][2] - 1.0) < 1e-6, res
+        # Each term only appears once, however many labels match
+        assert len([r for r in res if r[0] == 4]) == 1, res
+
+        assert index.match(u'climate', threshold=0.99) == \
+            [(4, u'Climate', res[0][2])]
+        assert index.match(u'xyz') == []
+
+    def test_match_short_label_in_large_index(self):
+        # Every trigram of 'Water' is in most labels, so none of their
+        # postings are walked
+        entries = [(u'Water %d' % i, i + 1) for i in range(2000)]
+        index = NgramIndex([(u'Water', 0)] + entries)
+        res = index.match(u'Water')
+        assert res[0][:2] == (0, u'Water'), res
+        assert abs(res[0][2] - 1.0) < 1e-6, res
+        assert len(res) == 3, res
+
+
+class TestReconcile(TaxonomyTestCase):
+
+    def test_reconcile(self):
+        term = logic.get_action('taxonomy_term_create')(
+            TestReconcile.sysadmin_context,
+            {'label': u'Public transport',
+             'uri': 'http://localhost.local/reconcile/transport',
+             'taxonomy_id': TestReconcile.taxonomies[0]['id'],
+             'alt_labels': [u'Buses']})
+
+        res = logic.get_action('taxonomy_term_reconcile')(
+            TestReconcile.empty_context,
+            {'strings': [u'public-transport', u'bus', u'unrelated']})
+        assert res[u'public-transport'][0]['id'] == term['id'], res
+        assert res[u'bus'][0]['match'] == u'Buses', res
+        assert res[u'unrelated'] == [], res
+
+    @raises(logic.ValidationError)
+    def test_reconcile_no_strings(self):
+        logic.get_action('taxonomy_term_reconcile')(
+            TestReconcile.empty_context, {})
@@ -0,0 +1,71 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.search import InvertedIndex
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestInvertedIndex(object):
+
+    def test_search(self):
+        index = InvertedIndex([(u'Rail transport', u'Trains and railways'),
+                               (u'Road transport', u'Cars, buses and lorries'),
+                               (u'Buses', None)])
+        assert [i for i, _ in index.search(u'transport')] == [0, 1]
+        assert [i for i, _ in index.search(u'road TRANSPORT')] == [1]
+        # A label match outranks a description match
+        assert [i for i, _ in index.search(u'buses')] == [2, 1]
+        assert index.search(u'planes') == []
+        assert index.search(u'') == []
+
+
+class TestTermSearch(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestTermSearch, cls).setup_class()
+        for taxonomy, label, description in (
+                (0, u'Health', u'Hospitals and public health'),
+                (0, u'Hospitals', u'Hospital waiting times'),
+                (1, u'Public spending', u'Spending on health')):
+            logic.get_action('taxonomy_term_create')(
+                cls.sysadmin_context,
+                {'label': label,
+                 'description': description,
+                 'uri': 'http://localhost.local/search/%s' % label,
+                 'taxonomy_id': cls.taxonomies[taxonomy]['id']})
+
+    def test_search(self):
+        res = logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context, {'q': u'health'})
+        assert res['count'] == 2, res
+        assert res['results'][0]['label'] == u'Health', res
+
+    def test_search_taxonomy(self):
+        res = logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context,
+            {'q': u'health', 'taxonomy': TestTermSearch.taxonomies[1]['name']})
+        assert [t['label'] for t in res['results']] == [u'Public spending']
+
+    def test_search_paged(self):
+        res = logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context,
+            {'q': u'health', 'limit': 1, 'offset': 1})
+        assert res['count'] == 2, res
+        assert len(res['results']) == 1, res
+
+    @raises(logic.ValidationError)
+    def test_search_no_query(self):
+        logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context, {})
+
+    @raises(logic.ValidationError)
+    def test_search_negative_offset(self):
+        logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context, {'q': u'health', 'offset': -1})
+
+    @raises(logic.ValidationError)
+    def test_search_limit_must_be_positive(self):
+        logic.get_action('taxonomy_term_search')(
+            TestTermSearch.empty_context, {'q': u'health', 'limit': 0})
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import ckan.logic as logic
+from ckan.plugins import toolkit
+
+from ckanext.taxonomy import cache, shared
+from ckanext.taxonomy.binary import MappedSnapshot
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestSharedSnapshots(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestSharedSnapshots, cls).setup_class()
+        cls.term = logic.get_action('taxonomy_term_create')(
+            cls.sysadmin_context,
+            {'label': 'Economy', 'uri': 'http://localhost.local/shared/e',
+             'taxonomy_id': cls.taxonomies[0]['id']})
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        toolkit.config['ckanext.taxonomy.snapshot.directory'] = \
+            self.directory
+        toolkit.config['ckanext.taxonomy.snapshot.check_interval'] = '0'
+        cache.invalidate()
+
+    def teardown(self):
+        del toolkit.config['ckanext.taxonomy.snapshot.directory']
+        del toolkit.config['ckanext.taxonomy.snapshot.check_interval']
+        shutil.rmtree(self.directory)
+        cache.invalidate()
+
+    def test_snapshot_is_mapped(self):
+        taxonomy_id = TestSharedSnapshots.taxonomies[0]['id']
+        snapshot = cache.get_snapshot(taxonomy_id)
+        assert isinstance(snapshot, MappedSnapshot), snapshot
+        assert snapshot.by_id.get(TestSharedSnapshots.term['id']) is not None
+        assert os.path.exists(shared.snapshot_file(taxonomy_id, 0))
+
+    def test_version_bump(self):
+        taxonomy_id = TestSharedSnapshots.taxonomies[0]['id']
+        cache.get_snapshot(taxonomy_id)
+        assert shared.bump_version(taxonomy_id) == 1
+        assert shared.read_version(taxonomy_id) == 1
+        assert not os.path.exists(shared.snapshot_file(taxonomy_id, 0))
+
+    def test_change_by_another_process(self):
+        taxonomy_id = TestSharedSnapshots.taxonomies[0]['id']
+        snapshot = cache.get_snapshot(taxonomy_id)
+        assert cache.get_snapshot(taxonomy_id) is snapshot
+
+        # Another process changing the taxonomy only moves the shared
+        # version on, which this one notices on its next check.
+        version = shared.read_version(taxonomy_id)
+        shared.bump_version(taxonomy_id)
+        shared._checked.pop(taxonomy_id)
+        again = cache.get_snapshot(taxonomy_id)
+        assert again is not snapshot
+        assert again.shared_version == version + 1, again.shared_version
+
+    def test_term_update_moves_version(self):
+        taxonomy_id = TestSharedSnapshots.taxonomies[0]['id']
+        before = shared.read_version(taxonomy_id)
+        logic.get_action('taxonomy_term_update')(
+            TestSharedSnapshots.sysadmin_context,
+            dict(TestSharedSnapshots.term, label='Economics'))
+        assert shared.read_version(taxonomy_id) == before + 1
+        snapshot = cache.get_snapshot(taxonomy_id)
+        i = snapshot.by_id.get(TestSharedSnapshots.term['id'])
+        assert snapshot.labels[i] == 'Economics'
+
+    def test_only_one_process_builds(self):
+        taxonomy_id = TestSharedSnapshots.taxonomies[0]['id']
+        snapshot = cache.build_snapshot(taxonomy_id)
+        fetched = []
+
+        def fetch_snapshot(taxonomy_id, version=0):
+            fetched.append(taxonomy_id)
+            # Long enough for the others to find the file missing
+            time.sleep(0.2)
+            return snapshot
+
+        loaded = []
+        original = cache.fetch_snapshot
+        cache.fetch_snapshot = fetch_snapshot
+        try:
+            threads = [threading.Thread(
+                target=lambda: loaded.append(
+                    shared.load_snapshot(taxonomy_id, 0)))
+                for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+        finally:
+            cache.fetch_snapshot = original
+
+        assert fetched == [taxonomy_id], fetched
+        assert len(loaded) == 4, loaded
+        assert all(isinstance(s, MappedSnapshot) for s in loaded), loaded
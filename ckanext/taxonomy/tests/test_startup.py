@@ -0,0 +1,18 @@
+import json
+import subprocess
+import sys
+
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+class TestStartup(object):
+
+    def test_plugin_does_not_load_commands(self):
+        # A fresh interpreter, as this one has loaded everything already
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'ckanext.taxonomy.tests.startup'])
+        result = json.loads(output.decode('utf-8'))
+        log.info('Plugin startup: %s', result)
+        assert result['command_modules'] == [], result
@@ -0,0 +1,43 @@
+import json
+
+import ckan.logic as logic
+
+from ckanext.taxonomy import streaming
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestStreaming(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestStreaming, cls).setup_class()
+        for i in range(25):
+            logic.get_action('taxonomy_term_create')(
+                cls.sysadmin_context,
+                {'label': 'Term %02d' % (24 - i),
+                 'uri': 'http://localhost.local/streaming/%d' % i,
+                 'taxonomy_id': cls.taxonomies[1]['id']})
+
+    def test_list_matches_action(self):
+        taxonomy_id = TestStreaming.taxonomies[1]['id']
+        chunks = list(streaming.iter_json_list(
+            streaming.iter_terms(taxonomy_id, batch_size=4), chunk_size=256))
+        assert len(chunks) > 1, chunks
+        res = json.loads(b''.join(chunks).decode('utf-8'))
+
+        expected = logic.get_action('taxonomy_term_list')(
+            TestStreaming.empty_context, {'id': taxonomy_id})
+        assert res == expected, res
+
+    def test_lines_in_id_order(self):
+        taxonomy_id = TestStreaming.taxonomies[1]['id']
+        body = b''.join(streaming.iter_json_lines(
+            streaming.iter_terms(taxonomy_id, order_by='id')))
+        ids = [json.loads(line)['id'] for line in body.splitlines()]
+        assert len(ids) == 25, ids
+        assert ids == sorted(ids), ids
+
+    def test_empty(self):
+        body = b''.join(streaming.iter_json_list(
+            streaming.iter_terms('no-such-taxonomy')))
+        assert json.loads(body.decode('utf-8')) == []
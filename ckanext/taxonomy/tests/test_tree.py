@@ -0,0 +1,69 @@
+import ckan.logic as logic
+
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+from nose.tools import raises
+
+
+class TestFlatTree(TaxonomyTestCase):
+
+    @classmethod
+    def setup_class(cls):
+        super(TestFlatTree, cls).setup_class()
+        create = logic.get_action('taxonomy_term_create')
+        taxonomy_id = cls.taxonomies[1]['id']
+        top = create(cls.sysadmin_context,
+                     {'label': 'Economy', 'uri': 'http://localhost.local/e',
+                      'taxonomy_id': taxonomy_id})
+        create(cls.sysadmin_context,
+               {'label': 'Trade', 'uri': 'http://localhost.local/e/t',
+                'taxonomy_id': taxonomy_id, 'parent_id': top['id'],
+                'description': 'Imports and exports'})
+        create(cls.sysadmin_context,
+               {'label': 'Agriculture', 'uri': 'http://localhost.local/a',
+                'taxonomy_id': taxonomy_id})
+
+    def test_flat(self):
+        res = logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id'], 'format': 'flat'})
+        assert res['labels'] == ['Agriculture', 'Economy', 'Trade'], res
+        assert res['parents'] == [-1, -1, 1], res
+        assert res['fields'] == [], res
+        assert 'description' not in res, res
+
+    def test_flat_fields(self):
+        res = logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id'], 'format': 'flat',
+             'fields': 'description,dataset_count'})
+        assert res['description'][2] == 'Imports and exports', res
+        assert res['dataset_count'] == [0, 0, 0], res
+
+    def test_flat_matches_nested(self):
+        nested = logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id']})
+        flat = logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id'], 'format': 'flat'})
+
+        def walk(terms):
+            for t in terms:
+                yield t['id']
+                for id in walk(t['children']):
+                    yield id
+        assert list(walk(nested)) == flat['ids']
+
+    @raises(logic.ValidationError)
+    def test_unknown_field(self):
+        logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id'], 'format': 'flat',
+             'fields': 'colour'})
+
+    @raises(logic.ValidationError)
+    def test_unknown_format(self):
+        logic.get_action('taxonomy_term_tree')(
+            TestFlatTree.empty_context,
+            {'id': TestFlatTree.taxonomies[1]['id'], 'format': 'xml'})
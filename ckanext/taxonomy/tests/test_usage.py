@@ -0,0 +1,202 @@
+import ckan.logic as logic
+import ckan.model as model
+
+from ckanext.taxonomy.tests.test_helpers import TaxonomyTestCase
+
+
+class TestTermUsage(TaxonomyTestCase):
+
+    def _context(self):
+        return dict(TestTermUsage.sysadmin_context)
+
+    def test_usage(self):
+        term = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'used',
+             'uri': 'http://localhost.local/usage/used',
+             'taxonomy_id': TestTermUsage.taxonomies[0]['id']})
+
+        pkg = logic.get_action('package_create')(
+            self._context(),
+            {'name': 'usage-test',
+             'extras': [{'key': 'theme', 'value': term['uri']}]})
+
+        res = logic.get_action('taxonomy_term_usage')(
+            self._context(), {'id': term['id']})
+        assert res == [{'id': pkg['id'], 'name': 'usage-test'}], res
+
+        count = logic.get_action('taxonomy_term_usage_count')(
+            self._context(), {'uri': term['uri']})
+        assert count == 1, count
+
+        pkg['extras'] = []
+        logic.get_action('package_update')(self._context(), pkg)
+        count = logic.get_action('taxonomy_term_usage_count')(
+            self._context(), {'id': term['id']})
+        assert count == 0, count
+
+        pkg['extras'] = [{'key': 'theme', 'value': term['uri']}]
+        logic.get_action('package_update')(self._context(), pkg)
+        logic.get_action('package_delete')(self._context(), {'id': pkg['id']})
+        count = logic.get_action('taxonomy_term_usage_count')(
+            self._context(), {'id': term['id']})
+        assert count == 0, count
+
+        logic.get_action('taxonomy_term_delete')(
+            self._context(), {'id': term['id']})
+
+    def test_usage_paging(self):
+        term = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'paged',
+             'uri': 'http://localhost.local/usage/paged',
+             'taxonomy_id': TestTermUsage.taxonomies[0]['id']})
+        for name in ('usage-paged-a', 'usage-paged-b'):
+            logic.get_action('package_create')(
+                self._context(),
+                {'name': name,
+                 'extras': [{'key': 'theme', 'value': term['uri']}]})
+
+        res = logic.get_action('taxonomy_term_usage')(
+            self._context(), {'id': term['id'], 'limit': 1, 'offset': 1})
+        assert [d['name'] for d in res] == ['usage-paged-b'], res
+
+        for data in ({'limit': 'all'}, {'limit': 0}, {'offset': -1}):
+            try:
+                logic.get_action('taxonomy_term_usage')(
+                    self._context(), dict(data, id=term['id']))
+            except logic.ValidationError:
+                pass
+            else:
+                assert False, 'No ValidationError for %s' % data
+
+        for name in ('usage-paged-a', 'usage-paged-b'):
+            logic.get_action('package_delete')(self._context(), {'id': name})
+        logic.get_action('taxonomy_term_delete')(
+            self._context(), {'id': term['id']})
+
+    def test_delete_by_name(self):
+        term = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'deleted by name',
+             'uri': 'http://localhost.local/usage/deleted-by-name',
+             'taxonomy_id': TestTermUsage.taxonomies[0]['id']})
+        pkg = logic.get_action('package_create')(
+            self._context(),
+            {'name': 'usage-delete-by-name',
+             'extras': [{'key': 'theme', 'value': term['uri']}]})
+
+        logic.get_action('package_delete')(
+            self._context(), {'id': 'usage-delete-by-name'})
+        # Deleted datasets aren't shown as using terms anyway, so look at
+        # the records and counts themselves
+        from ckanext.taxonomy.models import TaxonomyTermPackage
+        rows = model.Session.query(TaxonomyTermPackage)\
+            .filter(TaxonomyTermPackage.package_id == pkg['id']).count()
+        assert rows == 0, rows
+        terms = logic.get_action('taxonomy_term_list')(
+            self._context(),
+            {'id': TestTermUsage.taxonomies[0]['id'],
+             'include_counts': True})
+        counted = [t for t in terms if t['id'] == term['id']][0]
+        assert counted['dataset_count'] == 0, counted
+        assert counted['dataset_count_rollup'] == 0, counted
+
+        logic.get_action('taxonomy_term_delete')(
+            self._context(), {'id': term['id']})
+
+    def test_adjust_counts(self):
+        from ckanext.taxonomy.models import TaxonomyTermCount
+        from ckanext.taxonomy.usage import adjust_counts
+
+        term = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'adjusted',
+             'uri': 'http://localhost.local/usage/adjusted',
+             'taxonomy_id': TestTermUsage.taxonomies[0]['id']})
+
+        # The first adjustment creates the row, the next add to it
+        adjust_counts({term['id']: 1}, {term['id']: 1})
+        adjust_counts({term['id']: 1}, {term['id']: 2})
+        row = model.Session.query(TaxonomyTermCount.direct,
+                                  TaxonomyTermCount.rollup)\
+            .filter(TaxonomyTermCount.term_id == term['id']).one()
+        assert tuple(row) == (2, 3), row
+        model.Session.rollback()
+
+        logic.get_action('taxonomy_term_delete')(
+            self._context(), {'id': term['id']})
+
+    def test_backfill(self):
+        from ckanext.taxonomy.models import TaxonomyTermPackage
+        from ckanext.taxonomy.usage import backfill
+
+        term = logic.get_action('taxonomy_term_create')(
+            self._context(),
+            {'label': 'backfilled',
+             'uri': 'http://localhost.local/usage/backfilled',
+             'taxonomy_id': TestTermUsage.taxonomies[0]['id']})
+        for n in range(3):
+            logic.get_action('package_create')(
+                self._context(),
+                {'name': 'backfill-%d' % n,
+                 'extras': [{'key': 'theme', 'value': term['uri']}]})
+
+        model.Session.query(TaxonomyTermPackage).delete()
+        model.Session.commit()
+
+        backfill(batch_size=2, workers=2)
+
+        count = logic.get_action('taxonomy_term_usage_count')(
+            self._context(), {'id': term['id']})
+        assert count == 3, count
+
+    def test_counts(self):
+        def create_term(label, parent_id=None):
+            return logic.get_action('taxonomy_term_create')(
+                self._context(),
+                {'label': label,
+                 'uri': 'http://localhost.local/counts/%s' % label,
+                 'taxonomy_id': TestTermUsage.taxonomies[1]['id'],
+                 'parent_id': parent_id})
+
+        def counts():
+            terms = logic.get_action('taxonomy_term_list')(
+                self._context(),
+                {'id': TestTermUsage.taxonomies[1]['id'],
+                 'include_counts': True})
+            return dict((t['label'],
+                         (t['dataset_count'], t['dataset_count_rollup']))
+                        for t in terms)
+
+        top = create_term('top')
+        left = create_term('left', top['id'])
+        right = create_term('right', top['id'])
+
+        pkg = logic.get_action('package_create')(
+            self._context(),
+            {'name': 'counts-both',
+             'extras': [{'key': 'theme',
+                         'value': '["%s", "%s"]' % (left['uri'],
+                                                    right['uri'])}]})
+        logic.get_action('package_create')(
+            self._context(),
+            {'name': 'counts-left',
+             'extras': [{'key': 'theme', 'value': left['uri']}]})
+
+        # The dataset using both children only counts once for the parent
+        assert counts() == {'top': (0, 2), 'left': (2, 2),
+                            'right': (1, 1)}, counts()
+
+        logic.get_action('package_delete')(self._context(), {'id': pkg['id']})
+        assert counts() == {'top': (0, 1), 'left': (1, 1),
+                            'right': (0, 0)}, counts()
+
+        logic.get_action('taxonomy_term_delete')(
+            self._context(), {'id': left['id']})
+        assert counts() == {'top': (0, 0), 'right': (0, 0)}, counts()
+
+        tree = logic.get_action('taxonomy_term_tree')(
+            self._context(),
+            {'id': TestTermUsage.taxonomies[1]['id'], 'include_counts': True})
+        assert tree[0]['dataset_count_rollup'] == 0, tree
@@ -0,0 +1,356 @@
+"""
+Maintains the taxonomy_term_package table, which records the terms used
+by each dataset, and the taxonomy_term_count table of how many datasets
+use each term and each branch of a taxonomy.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import ckan.model as model
+
+from ckanext.taxonomy import cache
+from ckanext.taxonomy.indexing import package_fields, package_term_uris, \
+    parse_term_uris
+from ckanext.taxonomy.models import TaxonomyTerm, TaxonomyTermPackage, \
+    TaxonomyTermCount
+
+log = getLogger(__name__)
+
+
+def term_ids_for_uris(uris, replacing=None):
+    """
+    Resolves term uris to the ids of the terms in every taxonomy. See
+    `cache.get_snapshots` for `replacing`.
+    """
+    return set(snapshot.ids[i]
+               for snapshot, i in cache.find_terms(uris, replacing))
+
+
+def ancestor_closure(term_ids, replacing=None):
+    """
+    Returns the given term ids along with the ids of all of the terms
+    above them.
+    """
+    res = set()
+    if not term_ids:
+        return res
+    for snapshot in cache.get_snapshots(replacing):
+        for term_id in term_ids:
+            i = snapshot.by_id.get(term_id)
+            if i is not None:
+                res.add(term_id)
+                res.update(snapshot.ids[j] for j in snapshot.ancestors(i))
+    return res
+
+
+def _increment_count(session, term_id, d, r):
+    """
+    Adds to the counts of a term, creating its row if there isn't one.
+    Two transactions may both be first to count a term, so on PostgreSQL
+    this is a single upsert, and elsewhere the insert is retried as an
+    update if it collides.
+    """
+    table = TaxonomyTermCount.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(term_id=term_id, direct=d, rollup=r)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.term_id],
+            set_={'direct': table.c.direct + stmt.excluded.direct,
+                  'rollup': table.c.rollup + stmt.excluded.rollup}))
+        return
+
+    def update():
+        return session.query(TaxonomyTermCount)\
+            .filter(TaxonomyTermCount.term_id == term_id)\
+            .update({TaxonomyTermCount.direct: TaxonomyTermCount.direct + d,
+                     TaxonomyTermCount.rollup: TaxonomyTermCount.rollup + r},
+                    synchronize_session=False)
+
+    if update():
+        return
+    from sqlalchemy.exc import IntegrityError
+    try:
+        with session.begin_nested():
+            session.add(TaxonomyTermCount(term_id=term_id, direct=d,
+                                          rollup=r))
+    except IntegrityError:
+        update()
+
+
+def adjust_counts(direct, rollup):
+    """
+    Applies the {term_id: delta} changes in `direct` and `rollup` to the
+    stored counts, using in-place increments so that concurrent updates
+    don't overwrite each other.
+    """
+    session = model.Session
+    for term_id in set(direct) | set(rollup):
+        d = direct.get(term_id, 0)
+        r = rollup.get(term_id, 0)
+        if not d and not r:
+            continue
+        _increment_count(session, term_id, d, r)
+    changed = [t for t in set(direct) | set(rollup)
+               if direct.get(t) or rollup.get(t)]
+    if changed:
+        cache.counts_changed(id for id, in session.query(
+            TaxonomyTerm.taxonomy_id)
+            .filter(TaxonomyTerm.id.in_(changed)).distinct())
+
+
+def set_package_terms(package_id, term_ids, counts=True, replacing=None):
+    """
+    Makes the stored terms for a dataset match `term_ids`, touching only
+    the rows which have changed, and unless `counts` is False adjusts the
+    counts of the terms affected and of the terms above them. The caller
+    is responsible for committing.
+
+    A taxonomy which is being changed in the same transaction must be
+    given as a snapshot in `replacing`, see `cache.get_snapshots`.
+
+    :returns: The term ids which were added and removed
+    :rtype: A tuple of two sets
+    """
+    session = model.Session
+    current = set(term_id for term_id, in session.query(
+        TaxonomyTermPackage.term_id)
+        .filter(TaxonomyTermPackage.package_id == package_id))
+
+    added = set(term_ids) - current
+    removed = current - set(term_ids)
+
+    if removed:
+        session.query(TaxonomyTermPackage)\
+            .filter(TaxonomyTermPackage.package_id == package_id)\
+            .filter(TaxonomyTermPackage.term_id.in_(removed))\
+            .delete(synchronize_session=False)
+    for term_id in added:
+        session.add(TaxonomyTermPackage(term_id=term_id,
+                                        package_id=package_id))
+
+    if counts and (added or removed):
+        # A dataset counts once towards a branch however many of the
+        # terms within that branch it uses.
+        old = ancestor_closure(current, replacing)
+        new = ancestor_closure(set(term_ids), replacing)
+        direct = dict((t, 1) for t in added)
+        direct.update((t, -1) for t in removed)
+        rollup = dict((t, 1) for t in new - old)
+        rollup.update((t, -1) for t in old - new)
+        adjust_counts(direct, rollup)
+    return added, removed
+
+
+def update_package(pkg_dict):
+    """ Records the terms used by a dataset after it is created/updated """
+    if pkg_dict.get('state', 'active') != 'active':
+        return remove_package(pkg_dict)
+    term_ids = term_ids_for_uris(package_term_uris(pkg_dict))
+    return set_package_terms(pkg_dict['id'], term_ids)
+
+
+def remove_package(pkg_dict):
+    """
+    Forgets the terms used by a dataset after it is deleted. The dict
+    given to after_delete is the caller's, whose 'id' may be the name.
+    """
+    package = model.Package.get(pkg_dict['id'])
+    package_id = package.id if package else pkg_dict['id']
+    return set_package_terms(package_id, set())
+
+
+def remove_terms(term_ids):
+    """
+    Removes the usage records and counts for terms which are being
+    deleted. This must be called while the terms still exist, so that the
+    counts of the terms above them can be adjusted.
+    """
+    if not term_ids:
+        return
+    term_ids = set(term_ids)
+    session = model.Session
+
+    package_ids = set(id for id, in session.query(
+        TaxonomyTermPackage.package_id)
+        .filter(TaxonomyTermPackage.term_id.in_(term_ids)))
+    for package_id in package_ids:
+        current = set(id for id, in session.query(
+            TaxonomyTermPackage.term_id)
+            .filter(TaxonomyTermPackage.package_id == package_id))
+        set_package_terms(package_id, current - term_ids)
+
+    session.query(TaxonomyTermCount)\
+        .filter(TaxonomyTermCount.term_id.in_(term_ids))\
+        .delete(synchronize_session=False)
+
+
+def move_branch(term_ids, old_ancestors, new_ancestors):
+    """
+    Adjusts the rollup counts for a branch of terms, given by all of their
+    ids, moving from beneath `old_ancestors` to beneath `new_ancestors`.
+    Only the counts of the ancestors the branch leaves or joins change,
+    and only by the datasets using the branch. The caller is responsible
+    for committing.
+    """
+    term_ids = set(term_ids)
+    left = set(old_ancestors) - set(new_ancestors)
+    joined = set(new_ancestors) - set(old_ancestors)
+    if not left and not joined:
+        return
+
+    package_ids = list(packages_for_terms(term_ids))
+    terms_by_package = {}
+    for i in range(0, len(package_ids), 500):
+        for term_id, package_id in model.Session.query(
+                TaxonomyTermPackage.term_id, TaxonomyTermPackage.package_id)\
+                .filter(TaxonomyTermPackage.package_id.in_(
+                    package_ids[i:i + 500])):
+            terms_by_package.setdefault(package_id, set()).add(term_id)
+
+    rollup = {}
+    for package_id, package_terms in terms_by_package.items():
+        # A dataset still counts towards an ancestor if it uses another of
+        # the terms beneath it, which the move doesn't affect.
+        elsewhere = ancestor_closure(package_terms - term_ids)
+        for t in left - elsewhere:
+            rollup[t] = rollup.get(t, 0) - 1
+        for t in joined - elsewhere:
+            rollup[t] = rollup.get(t, 0) + 1
+    adjust_counts({}, rollup)
+
+
+def packages_for_terms(term_ids):
+    """ Returns the ids of the datasets using any of the given terms """
+    term_ids = list(term_ids)
+    res = set()
+    for i in range(0, len(term_ids), 500):
+        res.update(id for id, in model.Session.query(
+            TaxonomyTermPackage.package_id)
+            .filter(TaxonomyTermPackage.term_id.in_(term_ids[i:i + 500])))
+    return res
+
+
+def packages_using_uris(uris):
+    """
+    Returns the ids of the active datasets with any of the given term
+    uris in their taxonomy fields, whether or not they are recorded as
+    using them. This reads the fields of every dataset, so it is only
+    meant for imports.
+    """
+    uris = set(uris)
+    res = set()
+    if not uris:
+        return res
+    rows = model.Session.query(model.PackageExtra.package_id,
+                               model.PackageExtra.value)\
+        .join(model.Package,
+              model.Package.id == model.PackageExtra.package_id)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.PackageExtra.key.in_(package_fields()))\
+        .yield_per(1000)
+    for package_id, value in rows:
+        if uris.intersection(parse_term_uris(value)):
+            res.add(package_id)
+    return res
+
+
+def refresh_packages(package_ids, counts=True, replacing=None):
+    """
+    Records the terms used by the given datasets, reading the term uris
+    straight from their extras rather than building full dataset dicts.
+    The caller is responsible for committing. See `set_package_terms` for
+    `replacing`.
+    """
+    extras = {}
+    rows = model.Session.query(model.PackageExtra.package_id,
+                               model.PackageExtra.key,
+                               model.PackageExtra.value)\
+        .filter(model.PackageExtra.package_id.in_(list(package_ids)))\
+        .filter(model.PackageExtra.key.in_(package_fields()))
+    for package_id, key, value in rows:
+        extras.setdefault(package_id, []).append({'key': key, 'value': value})
+
+    for package_id in package_ids:
+        set_package_terms(package_id, term_ids_for_uris(
+            package_term_uris({'extras': extras.get(package_id)}),
+            replacing), counts=counts, replacing=replacing)
+
+
+def recount():
+    """
+    Recalculates every stored count from the taxonomy_term_package table.
+    This is only needed after the usage records have been rebuilt.
+    """
+    session = model.Session
+    terms_by_package = {}
+    for term_id, package_id in session.query(
+            TaxonomyTermPackage.term_id, TaxonomyTermPackage.package_id):
+        terms_by_package.setdefault(package_id, set()).add(term_id)
+
+    direct = {}
+    rollup = {}
+    for term_ids in terms_by_package.values():
+        for t in term_ids:
+            direct[t] = direct.get(t, 0) + 1
+        for t in ancestor_closure(term_ids):
+            rollup[t] = rollup.get(t, 0) + 1
+
+    session.query(TaxonomyTermCount).delete(synchronize_session=False)
+    for term_id in set(direct) | set(rollup):
+        session.add(TaxonomyTermCount(term_id=term_id,
+                                      direct=direct.get(term_id, 0),
+                                      rollup=rollup.get(term_id, 0)))
+    cache.counts_changed(cache.taxonomy_ids())
+    session.commit()
+
+
+def backfill(batch_size=500, workers=4):
+    """
+    Rebuilds the usage records of every active dataset. Dataset ids are
+    paged through in batches which are processed by a pool of threads,
+    each using its own database session.
+
+    :returns: The number of datasets processed
+    """
+    # Load the snapshots once up front, rather than in every worker
+    cache.get_snapshots()
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done in pool.map(_backfill_batch,
+                             _package_id_batches(batch_size)):
+            total += done
+            log.info('Processed %d datasets', total)
+
+    # Batches running at the same time can't safely share the incremental
+    # count updates, so they are worked out once at the end.
+    recount()
+    return total
+
+
+def _package_id_batches(batch_size):
+    last_id = ''
+    while True:
+        ids = [id for id, in model.Session.query(model.Package.id)
+               .filter(model.Package.state == 'active')
+               .filter(model.Package.id > last_id)
+               .order_by(model.Package.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        yield ids
+        last_id = ids[-1]
+
+
+def _backfill_batch(package_ids):
+    session = model.Session
+    try:
+        refresh_packages(package_ids, counts=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+    return len(package_ids)